@@ -1,43 +1,693 @@
 
+import io
+import bisect
+import logging
+import os
+import fnmatch
+import shutil
+import struct
+import sys
+import tarfile
+import tempfile
+import time
+import threading
 import zipfile
+import zlib
+
+logger = logging.getLogger("dumprestore")
+
+# Files are copied in and out of archives this many bytes at a time
+CHUNK_SIZE = 1024 * 1024
+
+class ArchiveException(Exception):
+    pass
+
+methods = {
+    'stored': zipfile.ZIP_STORED,
+    'deflated': zipfile.ZIP_DEFLATED,
+}
+if hasattr(zipfile, 'ZIP_BZIP2'):
+    methods['bzip2'] = zipfile.ZIP_BZIP2
+if hasattr(zipfile, 'ZIP_LZMA'):
+    methods['lzma'] = zipfile.ZIP_LZMA
+
+def _compressor(compress_type, level):
+    if hasattr(zipfile, '_get_compressor'):
+        # python 3 knows how to make every compressor it supports
+        return zipfile._get_compressor(compress_type, level)
+    if compress_type == zipfile.ZIP_DEFLATED:
+        if level is None:
+            level = zlib.Z_DEFAULT_COMPRESSION
+        return zlib.compressobj(level, zlib.DEFLATED, -15)
+    return None
+
+def _copy_compressed(fileobj, out, chunk_size, compressor, head=b""):
+    """ Write head followed by the contents of fileobj to out, through
+    compressor if there is one. Returns the CRC, uncompressed size and
+    compressed size of what was written. """
+    crc = file_size = compress_size = 0
+    buf = head
+    while True:
+        if not buf:
+            buf = fileobj.read(chunk_size)
+        if not buf:
+            break
+        file_size += len(buf)
+        crc = zlib.crc32(buf, crc) & 0xffffffff
+        if compressor is not None:
+            buf = compressor.compress(buf)
+        compress_size += len(buf)
+        out.write(buf)
+        buf = None
+    if compressor is not None:
+        buf = compressor.flush()
+        compress_size += len(buf)
+        out.write(buf)
+    return crc, file_size, compress_size
+
+def _start_entry(zf, zinfo, zip64):
+    zinfo.flag_bits = 0x00
+    zinfo.header_offset = zf.fp.tell()
+    zf._writecheck(zinfo)
+    zf._didModify = True
+    zf.fp.write(zinfo.FileHeader(zip64))
+
+def _finish_entry(zf, zinfo):
+    position = zf.fp.tell()
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[zinfo.filename] = zinfo
+    if hasattr(zf, 'start_dir'):
+        # python 3 writes the central directory from here on close
+        zf.start_dir = position
+
+def _write_stream(zf, zinfo, fileobj, chunk_size, level=None, head=b""):
+    """ Write head followed by the contents of fileobj into zf as zinfo.
+    This is ZipFile.write for a file object of unknown length: a zip64
+    header is written first and rewritten once the CRC and sizes are known. """
+    compressor = _compressor(zinfo.compress_type, level)
+    zinfo.CRC = zinfo.file_size = zinfo.compress_size = 0
+    _start_entry(zf, zinfo, True)
+    zinfo.CRC, zinfo.file_size, zinfo.compress_size = _copy_compressed(fileobj, zf.fp, chunk_size, compressor, head)
+    position = zf.fp.tell()
+    zf.fp.seek(zinfo.header_offset, 0)
+    zf.fp.write(zinfo.FileHeader(True))
+    zf.fp.seek(position, 0)
+    _finish_entry(zf, zinfo)
+
+def _write_staged(zf, zinfo, staged, chunk_size):
+    """ Append staged, which already holds the compressed contents of zinfo
+    with its CRC and sizes filled in, to zf. """
+    _start_entry(zf, zinfo, None)
+    shutil.copyfileobj(staged, zf.fp, chunk_size)
+    _finish_entry(zf, zinfo)
+
+def _remaining(fileobj):
+    """ The number of bytes left to read in fileobj, or None if it can't be
+    known without reading them, as in a pipe. """
+    try:
+        position = fileobj.tell()
+        fileobj.seek(0, 2)
+        size = fileobj.tell() - position
+        fileobj.seek(position)
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+    return size
+
+def _fsname(name):
+    """ name as python 2 passes it to the filesystem: in UTF-8 bytes, as zip
+    and tar archives keep names, whatever the locale. """
+    if bytes is str and not isinstance(name, bytes):
+        return name.encode("utf-8")
+    return name
+
+def _text(name):
+    """ A name python 2 read from a tar or the filesystem, as text, like the
+    names zipfile and the manifests give. """
+    if isinstance(name, bytes):
+        return name.decode("utf-8")
+    return name
+
+def _copyfile(source, target, chunk_size=CHUNK_SIZE):
+    """ Copy the file object source to target, inside the kernel where the
+    platform allows, and chunk_size bytes at a time otherwise. """
+    for name in ('copy_file_range', 'sendfile'):
+        copy = getattr(os, name, None)
+        if copy is None:
+            continue
+        try:
+            if name == 'sendfile':
+                while copy(target.fileno(), source.fileno(), None, chunk_size):
+                    pass
+            else:
+                while copy(source.fileno(), target.fileno(), chunk_size):
+                    pass
+            return
+        except OSError:
+            # not between these files or on this filesystem; nothing has been
+            # written unless it failed part way, so start again the slow way
+            source.seek(0)
+            target.seek(0)
+            target.truncate()
+    shutil.copyfileobj(source, target, chunk_size)
+
+def _recover_zip(filename):
+    """ Make a zip that was never closed, and so has no central directory,
+    whole again, by rebuilding the directory from the local header of each
+    entry. An entry written in part is cut off. Returns the number of
+    entries kept. """
+    infos = []
+    with open(filename, "r+b") as f:
+        size = os.fstat(f.fileno()).st_size
+        offset = 0
+        while True:
+            f.seek(offset)
+            header = f.read(struct.calcsize(zipfile.structFileHeader))
+            if len(header) < struct.calcsize(zipfile.structFileHeader) or header[:4] != zipfile.stringFileHeader:
+                break
+            (_, version, _, flags, method, dostime, dosdate, crc, compress_size, file_size,
+             name_length, extra_length) = struct.unpack(zipfile.structFileHeader, header)
+            name = f.read(name_length)
+            extra = f.read(extra_length)
+            if flags & 0x08:
+                # sizes in a data descriptor after the data, which this
+                # module never writes
+                break
+            if 0xffffffff in (compress_size, file_size):
+                sizes = []
+                i = 0
+                while i + 4 <= len(extra):
+                    field, length = struct.unpack("<HH", extra[i:i + 4])
+                    if field == 1:
+                        sizes = list(struct.unpack("<%dQ" % (length // 8), extra[i + 4:i + 4 + length // 8 * 8]))
+                    i += 4 + length
+                if file_size == 0xffffffff and sizes:
+                    file_size = sizes.pop(0)
+                if compress_size == 0xffffffff and sizes:
+                    compress_size = sizes.pop(0)
+            end = f.tell() + compress_size
+            # an entry is only finished once something follows it, or it
+            # reaches exactly to the end; a streamed entry whose header was
+            # never rewritten claims no data, and its data follows instead
+            f.seek(end)
+            if end > size or (end < size and f.read(4) != zipfile.stringFileHeader):
+                break
+            if flags & 0x800:
+                name = name.decode("utf-8")
+            elif not isinstance(name, str):
+                name = name.decode("cp437")
+            zinfo = zipfile.ZipInfo(name, ((dosdate >> 9) + 1980, (dosdate >> 5) & 0xf, dosdate & 0x1f,
+                                           dostime >> 11, (dostime >> 5) & 0x3f, (dostime & 0x1f) * 2))
+            zinfo.compress_type = method
+            zinfo.flag_bits = flags
+            zinfo.CRC = crc
+            zinfo.compress_size = compress_size
+            zinfo.file_size = file_size
+            zinfo.header_offset = offset
+            zinfo.external_attr = 0o600 << 16
+            infos.append(zinfo)
+            offset = end
+        if not infos and size:
+            raise ArchiveException("%s is not a zip file" % filename)
+        logger.warning("%s was not closed: recovered %d entries, and cut off %d bytes written in part" % (
+            filename, len(infos), size - offset))
+        f.truncate(offset)
+        f.seek(offset)
+        # writes a central directory of the entries found where it is closed
+        zf = zipfile.ZipFile(f, "w", allowZip64=True)
+        zf.filelist = infos
+        zf.NameToInfo = dict((i.filename, i) for i in infos)
+        zf.close()
+    return len(infos)
+
+class ZipWriter:
+
+    """ Appends entries to a zipfile on behalf of any number of threads.
+
+    A zip can only take one entry at a time. A writer of an entry of known
+    size, such as a file, that finds the zip free streams straight into it.
+    One of unknown length, like the output of pg_dump, is always staged, so
+    the zip isn't held for as long as its producer takes. So is one that
+    finds the zip busy: it compresses its entry into a staging file instead, so the work is done in parallel, and only
+    holds the lock to copy the finished bytes in. Each staging file keeps up
+    to spool_size bytes in memory before spilling to tempdir, and at most
+    max_staged of them exist at once, so memory use stays bounded however
+    many threads are writing. """
+
+    def __init__(self, zipfile, tempdir=None, spool_size=8 * CHUNK_SIZE, max_staged=4):
+        self.zipfile = zipfile
+        self.tempdir = tempdir
+        self.spool_size = spool_size
+        self.lock = threading.RLock()
+        self.staging = threading.BoundedSemaphore(max_staged)
+
+    def write(self, zinfo, fileobj, chunk_size=CHUNK_SIZE, level=None, head=b""):
+        if _remaining(fileobj) is not None and self.lock.acquire(False):
+            try:
+                _write_stream(self.zipfile, zinfo, fileobj, chunk_size, level, head)
+            finally:
+                self.lock.release()
+            return
+        with self.staging:
+            with tempfile.SpooledTemporaryFile(self.spool_size, dir=self.tempdir) as staged:
+                compressor = _compressor(zinfo.compress_type, level)
+                zinfo.CRC, zinfo.file_size, zinfo.compress_size = _copy_compressed(fileobj, staged, chunk_size, compressor, head)
+                staged.seek(0)
+                with self.lock:
+                    _write_staged(self.zipfile, zinfo, staged, chunk_size)
+
+class CompressionPolicy:
+
+    """ Decides how each entry written to an archive is compressed.
+
+    method is "stored", "deflated", "bzip2" or "lzma" (the last two need
+    python 3), or "auto", which deflates an entry unless it looks already
+    compressed: either its extension is in compressed_extensions, or
+    deflating its first probe_size bytes saves less than probe_ratio. Every
+    database dump is named .dmp, SQL text as well as pg_dump's compressed
+    format, so dumps are left to the probe.
+    rules is a list of (pattern, method) pairs matched in order against the
+    full name of each entry, so "database/*" matches everything a database
+    driver writes under the default backup set. The first match overrides
+    method. level is passed to the compressor. """
+
+    compressed_extensions = frozenset([
+        '7z', 'aac', 'avi', 'avif', 'bz2', 'docx', 'flac', 'gif', 'gz',
+        'heic', 'jar', 'jpeg', 'jpg', 'm4a', 'm4v', 'mkv', 'mov', 'mp3', 'mp4',
+        'odp', 'ods', 'odt', 'ogg', 'opus', 'png', 'pptx', 'rar', 'tgz', 'webm',
+        'webp', 'woff', 'woff2', 'xlsx', 'xz', 'zip', 'zst',
+    ])
+
+    def __init__(self, method="stored", level=None, rules=(), probe_size=64 * 1024, probe_ratio=0.9):
+        self.method = method
+        self.level = level
+        self.rules = list(rules)
+        self.probe_size = probe_size
+        self.probe_ratio = probe_ratio
+        for m in [method] + [m for pattern, m in self.rules]:
+            if m != "auto" and m not in methods:
+                raise ArchiveException("Compression method %r is not supported" % (m,))
+
+    @classmethod
+    def from_settings(klass, settings, method=None, level=None):
+        """ Build a policy from the DUMPRESTORE_COMPRESSION,
+        DUMPRESTORE_COMPRESSION_LEVEL and DUMPRESTORE_COMPRESSION_RULES
+        settings, overridden by method and level if they are given. """
+        if method is None:
+            method = getattr(settings, 'DUMPRESTORE_COMPRESSION', "stored")
+        if level is None:
+            level = getattr(settings, 'DUMPRESTORE_COMPRESSION_LEVEL', None)
+        rules = getattr(settings, 'DUMPRESTORE_COMPRESSION_RULES', ())
+        return klass(method, level, rules)
+
+    def compressible(self, name, sample):
+        """ Guess whether an entry called name, starting with sample, is worth compressing. """
+        if os.path.splitext(name)[1].lower().lstrip(".") in self.compressed_extensions:
+            return False
+        sample = sample[:self.probe_size]
+        if not sample:
+            return False
+        return len(zlib.compress(sample, 1)) < len(sample) * self.probe_ratio
+
+    def choose(self, name, sample):
+        """ Return the zipfile compression type and level for an entry
+        called name, whose contents start with sample. """
+        method = self.method
+        for pattern, m in self.rules:
+            if fnmatch.fnmatch(name, pattern):
+                method = m
+                break
+        if method == "auto":
+            method = "deflated" if self.compressible(name, sample) else "stored"
+        return methods[method], self.level
+
+class ZipBackend:
+
+    """ Keeps an archive in a zip file. Entries can be read in any order and
+    compressed one by one, but the zip has to be seekable while it is
+    written, because the directory of entries goes at the end. """
+
+    def __init__(self, zipfile, tempdir=None):
+        self.zipfile = zipfile
+        self.writer = ZipWriter(zipfile, tempdir)
+        self.lock = self.writer.lock
+        self.readonly = zipfile.mode == "r"
+
+    @classmethod
+    def new(klass, filename, mode, tempdir=None):
+        if mode == "a" and os.path.exists(filename) and not zipfile.is_zipfile(filename):
+            # zipfile would start a new archive after the old one
+            _recover_zip(filename)
+        return klass(zipfile.ZipFile(filename, mode, allowZip64=True), tempdir)
+
+    def writefile(self, name, fileobj, chunk_size, compression=None):
+        zinfo = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+        zinfo.external_attr = 0o600 << 16
+        head = fileobj.read(chunk_size)
+        if compression is None:
+            zinfo.compress_type, level = self.zipfile.compression, None
+        else:
+            zinfo.compress_type, level = compression.choose(name, head)
+        self.writer.write(zinfo, fileobj, chunk_size, level, head)
+
+    def names(self):
+        return self.zipfile.namelist()
+
+    def open(self, name, *a, **kw):
+        return self.zipfile.open(name, *a, **kw)
+
+    def size(self, name):
+        return self.zipfile.getinfo(name).file_size
+
+    def close(self):
+        self.zipfile.close()
+
+class _Section(io.RawIOBase):
+
+    """ A read only file object for size bytes of path, starting at offset. """
+
+    def __init__(self, path, offset, size):
+        io.RawIOBase.__init__(self)
+        self.fileobj = open(path, "rb")
+        self.fileobj.seek(offset)
+        self.remaining = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.fileobj.read(min(len(b), self.remaining))
+        self.remaining -= len(data)
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self.fileobj.close()
+        io.RawIOBase.close(self)
+
+class TarBackend:
+
+    """ Keeps an archive in a tar file, or streams one to stdout if the
+    filename is "-", so a dump can be piped straight into ssh, a compressor
+    or an uploader. A tar is written front to back and each entry's size
+    goes before its contents, so an entry of unknown length is spooled
+    first to measure it, just as ZipWriter stages entries. Files called
+    .tar.gz, .tgz, .tar.bz2 or .tar.xz are compressed as a whole.
+
+    Restoring needs an uncompressed tar file, so entries can be read in any
+    order, and by several threads at once, from where they lie in the file. """
+
+    streams = {
+        '.tar.gz': 'gz',
+        '.tgz': 'gz',
+        '.tar.bz2': 'bz2',
+        '.tar.xz': 'xz',
+    }
+
+    def __init__(self, tar, path=None, tempdir=None, spool_size=8 * CHUNK_SIZE, max_staged=4):
+        self.tar = tar
+        self.path = path
+        self.tempdir = tempdir
+        self.spool_size = spool_size
+        self.lock = threading.RLock()
+        self.staging = threading.BoundedSemaphore(max_staged)
+        self.readonly = tar.mode == "r"
+        self.written = []
+        self.members = {}
+        if self.readonly:
+            for member in tar.getmembers():
+                if member.isreg():
+                    self.members[_text(member.name)] = member
+
+    @classmethod
+    def new(klass, filename, mode, tempdir=None):
+        if mode == "r":
+            try:
+                tar = tarfile.open(filename, "r:", encoding="utf-8")
+            except tarfile.ReadError:
+                raise ArchiveException("%s is not an uncompressed tar file" % filename)
+            return klass(tar, filename, tempdir)
+        if mode != "w":
+            raise ArchiveException("A tar archive can only be written from the start")
+        if filename == "-":
+            fileobj = getattr(sys.stdout, 'buffer', sys.stdout)
+            return klass(tarfile.open(fileobj=fileobj, mode="w|", encoding="utf-8"), tempdir=tempdir)
+        stream = ""
+        for extension, compression in klass.streams.items():
+            if filename.endswith(extension):
+                stream = compression
+        return klass(tarfile.open(filename, "w|" + stream, encoding="utf-8"), filename, tempdir)
+
+    def writefile(self, name, fileobj, chunk_size, compression=None):
+        tarinfo = tarfile.TarInfo(name)
+        tarinfo.mtime = int(time.time())
+        tarinfo.mode = 0o600
+        tarinfo.size = _remaining(fileobj)
+        if tarinfo.size is None:
+            # a pipe, or something like one, that has to be measured by reading it
+            with self.staging:
+                with tempfile.SpooledTemporaryFile(self.spool_size, dir=self.tempdir) as staged:
+                    shutil.copyfileobj(fileobj, staged, chunk_size)
+                    tarinfo.size = staged.tell()
+                    staged.seek(0)
+                    with self.lock:
+                        self.tar.addfile(tarinfo, staged)
+                        self.written.append(name)
+            return
+        with self.lock:
+            self.tar.addfile(tarinfo, fileobj)
+            self.written.append(name)
+
+    def names(self):
+        if self.readonly:
+            return list(self.members)
+        return self.written
+
+    def open(self, name):
+        member = self.members[name]
+        return io.BufferedReader(_Section(self.path, member.offset_data, member.size), CHUNK_SIZE)
+
+    def size(self, name):
+        return self.members[name].size
+
+    def close(self):
+        self.tar.close()
+
+class DirectoryBackend:
+
+    """ Keeps an archive as a directory, with one file for each entry. Any
+    number of entries can be written or read at once, and no space is spent
+    on anything but their contents. """
+
+    def __init__(self, root, mode):
+        self.root = _fsname(root)
+        self.lock = threading.RLock()
+        self.readonly = mode == "r"
+
+    @classmethod
+    def new(klass, filename, mode, tempdir=None):
+        if mode == "r" and not os.path.isdir(filename):
+            raise ArchiveException("%s is not a directory" % filename)
+        if mode == "w" and os.path.isdir(filename) and os.listdir(filename):
+            # entries left from an earlier dump would be taken for this one's
+            raise ArchiveException("%s is not empty; a new dump needs a new or empty directory" % filename)
+        if mode != "r" and not os.path.isdir(filename):
+            os.makedirs(filename)
+        return klass(filename, mode)
+
+    def path(self, name):
+        """ The filename of the entry called name. """
+        path = os.path.normpath(os.path.join(self.root, *_fsname(name).split("/")))
+        if not path.startswith(os.path.join(os.path.normpath(self.root), "")):
+            raise ArchiveException("%r is outside the archive" % (name,))
+        return path
+
+    def create(self, name):
+        """ Open the file for the entry called name for writing, creating its directory. """
+        path = self.path(name)
+        parent = os.path.dirname(path)
+        try:
+            os.makedirs(parent)
+        except OSError:
+            if not os.path.isdir(parent):
+                raise
+        return open(path, "wb")
+
+    def writefile(self, name, fileobj, chunk_size, compression=None):
+        try:
+            with self.create(name) as f:
+                shutil.copyfileobj(fileobj, f, chunk_size)
+        except:
+            self.discard(name)
+            raise
+
+    def write(self, filename, name):
+        """ Copy filename into the archive as name, without it passing
+        through python where the platform allows. """
+        with open(filename, "rb") as source:
+            try:
+                with self.create(name) as target:
+                    _copyfile(source, target)
+            except:
+                self.discard(name)
+                raise
+
+    def discard(self, name):
+        """ Remove the entry called name, if it is there, so one that failed
+        part way isn't taken for a whole one. """
+        try:
+            os.unlink(self.path(name))
+        except OSError:
+            pass
+
+    def extract(self, name, filename):
+        with open(self.path(name), "rb") as source:
+            with open(filename, "wb") as target:
+                _copyfile(source, target)
+
+    def names(self):
+        names = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            relative = os.path.relpath(dirpath, self.root)
+            for filename in filenames:
+                if relative == ".":
+                    names.append(_text(filename))
+                else:
+                    names.append(_text(relative.replace(os.sep, "/") + "/" + filename))
+        return names
+
+    def open(self, name):
+        return open(self.path(name), "rb")
+
+    def size(self, name):
+        return os.path.getsize(self.path(name))
+
+    def close(self):
+        pass
+
+backends = {
+    'zip': ZipBackend,
+    'tar': TarBackend,
+    'directory': DirectoryBackend,
+}
+
+def backend_for(filename):
+    """ Guess which backend an archive called filename uses. """
+    if filename == "-" or filename.endswith(".tar") or any(filename.endswith(e) for e in TarBackend.streams):
+        return 'tar'
+    if filename.endswith("/") or os.path.isdir(filename):
+        return 'directory'
+    return 'zip'
 
 class Archive:
-    
-    """ Represents an archive to backup to or restore from.  Just acts as a proxy for zipfile.ZipFile right now. """
-    
-    def __init__(self, zipfile, prefix=""):
+
+    """ Represents an archive to backup to or restore from. The entries are
+    kept by one of the backends: a zip file, a tar file or stream, or a
+    directory.
+
+    Entries in a zip are compressed as the CompressionPolicy compression
+    decides, or as the zipfile's default if there is none.
+
+    When reading, the names in the archive are sorted into an index once,
+    shared by all subarchives, so listing the names under a prefix only
+    touches those names.
+
+    Any number of threads may write at once. """
+
+    def __init__(self, backend, prefix="", compression=None, index=None):
+        if isinstance(backend, zipfile.ZipFile):
+            backend = ZipBackend(backend)
+        self.backend = backend
         self.prefix = prefix
-        self.zipfile = zipfile
-        
+        self.compression = compression
+        if index is None:
+            index = []
+        self.index = index
+        self.lock = backend.lock
+
     @classmethod
-    def new(klass, filename, mode):
-        return klass(zipfile.ZipFile(filename, mode, allowZip64=True))
-    
+    def new(klass, filename, mode, compression=None, tempdir=None, backend=None):
+        """ Open the archive called filename, kept by the named backend, or
+        by the one backend_for guesses from the filename. """
+        if backend is None:
+            backend = backend_for(filename)
+        if backend not in backends:
+            raise ArchiveException("Archive format %r is not supported" % (backend,))
+        return klass(backends[backend].new(filename, mode, tempdir), compression=compression)
+
     def subarchive(self, prefix):
         if self.prefix:
             newprefix = self.prefix + "/" + prefix
         else:
             newprefix = prefix
-        return self.__class__(self.zipfile, newprefix)
-    
+        return self.__class__(self.backend, newprefix, self.compression, self.index)
+
     def _name(self, name):
         if self.prefix == "":
             return name
         else:
             return self.prefix + "/" + name
-    
+
     def writestr(self, name, data):
-        self.zipfile.writestr(self._name(name), data)
-        
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        self.writefile(name, io.BytesIO(data))
+
     def write(self, filename, arcname):
-        self.writestr(arcname, open(filename).read())
-        
-    def namelist(self):
-        for n in self.zipfile.namelist():
-            if n.startswith(self.prefix):
-                yield n[len(self.prefix)+1:]
-                
-    def open(self, name, *a, **kw):
-        return self.zipfile.open(self._name(name), *a, **kw)
-            
-        
+        if hasattr(self.backend, 'write'):
+            self.backend.write(filename, self._name(arcname))
+            return
+        with open(filename, "rb") as f:
+            self.writefile(arcname, f)
+
+    def writefile(self, name, fileobj, chunk_size=CHUNK_SIZE):
+        """ Copy the contents of fileobj into the archive as name, chunk_size
+        bytes at a time, so memory use does not depend on the size of the file. """
+        self.backend.writefile(self._name(name), fileobj, chunk_size, self.compression)
+
+    def _names(self):
+        """ Every name in the archive, sorted. """
+        with self.lock:
+            if not self.backend.readonly:
+                return sorted(set(self.backend.names()))
+            if not self.index:
+                self.index.extend(sorted(set(self.backend.names())))
+            return self.index
+
+    def namelist(self, prefix=""):
+        """ Yield the names in this archive that start with prefix. """
+        start = self._name(prefix)
+        strip = len(self._name(""))
+        names = self._names()
+        i = bisect.bisect_left(names, start)
+        while i < len(names) and names[i].startswith(start):
+            yield names[i][strip:]
+            i += 1
+
+    def exists(self, name):
+        names = self._names()
+        i = bisect.bisect_left(names, self._name(name))
+        return i < len(names) and names[i] == self._name(name)
+
+    def open(self, name):
+        return self.backend.open(self._name(name))
+
+    def size(self, name):
+        """ The uncompressed size of name, in bytes. """
+        return self.backend.size(self._name(name))
+
+    def extractfile(self, name, fileobj, chunk_size=CHUNK_SIZE):
+        """ Copy name out of the archive into fileobj, chunk_size bytes at a time. """
+        with self.open(name) as source:
+            shutil.copyfileobj(source, fileobj, chunk_size)
+
+    def extract(self, name, filename):
+        """ Copy name out of the archive into a new file called filename. """
+        if hasattr(self.backend, 'extract'):
+            self.backend.extract(self._name(name), filename)
+            return
+        with open(filename, "wb") as f:
+            self.extractfile(name, f)
+
+    def close(self):
+        """ Finish writing the archive. Subarchives share it, so closing any of them closes them all. """
+        self.backend.close()
@@ -2,11 +2,33 @@
 """ A backup set orchestrates collections of backups """
 
 import logging
+import contextlib
+
+from .parallel import run_graph
 
 logger = logging.getLogger("dumprestore")
 
 class BackupDriver:
 
+    # Set by the backup set before dump and restore when there is a journal,
+    # to a journal.Checkpoint for recording which units of work are finished.
+    checkpoint = None
+
+    # Set by the backup set when there is a monitor, to a progress.Progress
+    # that counts the files and bytes dealt with.
+    progress = None
+
+    # Set by the backup set when it, or a set it is inside, has one, to a
+    # throttle.Throttle limiting how hard the driver works the storage.
+    throttle = None
+
+    # The management command options that, given without --set, limit a
+    # restore or verify to the sets with this driver.
+    selecting = ()
+
+    def configure(self, **options):
+        """ Receives the options given to the management command. Drivers pick out the ones they understand and ignore the rest. """
+
     def before_dump(self, archive):
         """ Check that everything is ok to back up to the specified archive. """
 
@@ -25,21 +47,88 @@ class BackupDriver:
     def after_restore(self, archive):
         """ Perform cleanup operations """
 
+    def verify(self, archive):
+        """ Check this driver's entries in the archive. Return a list of the problems found. """
+        return []
+
+    def expect(self, files=None, bytes=None):
+        """ Say how many files and bytes there are to deal with in all, for the ETA. """
+        if self.progress is not None:
+            self.progress.expect(files, bytes)
+
+    def count(self, files=0, bytes=0):
+        """ Count files and bytes dealt with towards the progress reports. """
+        if self.progress is not None:
+            self.progress.add(files, bytes)
+
+    @contextlib.contextmanager
+    def request(self):
+        """ Make a request to the storage inside the block, once the throttle allows it. """
+        if self.throttle is None:
+            yield
+            return
+        with self.throttle.request():
+            yield
+
+    def throttled(self, fileobj):
+        """ fileobj, read no faster than the throttle allows. """
+        if self.throttle is None:
+            return fileobj
+        return self.throttle.reader(fileobj)
+
+    def opened(self, fileobj):
+        """ fileobj, just opened from the storage, read under the throttle
+        with its first read made as a request. """
+        if self.throttle is None:
+            return fileobj
+        return self.throttle.opened(fileobj)
+
+    def write_file(self, archive, filename, arcname):
+        """ archive.write, unless the throttle limits bytes, when filename is
+        read through it instead of being copied in the kernel. """
+        if self.throttle is None or self.throttle.bytes is None:
+            archive.write(filename, arcname)
+            return
+        with open(filename, "rb") as f:
+            archive.writefile(arcname, self.throttle.reader(f))
+
 class BackupSet:
 
     """ Orchestrates a collection of backups. First performs operations on it's children, then uses it's driver if required """
 
-    def __init__(self, name="master", driver=None):
+    def __init__(self, name="master", driver=None, parallel=False, throttle=None):
         self.name = name
         self.__archive = None
+        self.__journal = None
+        self.__monitor = None
+        self.__throttle = throttle
         self.children = []
         self.parent = None
         self.driver = driver
+        self.parallel = parallel
+        self.after = []
+        self.sets = []
 
-    def addChild(self, child):
+    def addChild(self, child, after=()):
+        names = [c.name for c in self.children]
+        for a in after:
+            if a not in names:
+                raise ValueError("%r must be added before %r can come after it" % (a, child.name))
         child.parent = self
+        child.after = list(after)
         self.children.append(child)
 
+    def _children(self, method):
+        """ Call method on each child, one after another in the order they
+        were added, or if the set is parallel, all at once, except that a
+        child added with after=[names] waits for those siblings to finish. """
+        if not self.parallel:
+            for c in self.children:
+                getattr(c, method)()
+            return
+        logger.info("%s running %s on %s in parallel" % (self.name, method, ", ".join(c.name for c in self.children)))
+        run_graph([(c.name, getattr(c, method), c.after) for c in self.children])
+
     def _get_archive(self):
         if self.__archive is None:
             return self.parent.archive.subarchive(self.name)
@@ -51,48 +140,191 @@ class BackupSet:
 
     archive = property(_get_archive, _set_archive)
 
+    def _get_journal(self):
+        if self.__journal is None and self.parent is not None:
+            return self.parent.journal
+        return self.__journal
+
+    def _set_journal(self, journal):
+        self.__journal = journal
+
+    journal = property(_get_journal, _set_journal)
+
+    def _get_monitor(self):
+        if self.__monitor is None and self.parent is not None:
+            return self.parent.monitor
+        return self.__monitor
+
+    def _set_monitor(self, monitor):
+        self.__monitor = monitor
+
+    monitor = property(_get_monitor, _set_monitor)
+
+    def _get_throttle(self):
+        """ The throttle of this set (see dumprestore.throttle), or else that
+        of the set it is inside, shared by their drivers. """
+        if self.__throttle is None and self.parent is not None:
+            return self.parent.throttle
+        return self.__throttle
+
+    def _set_throttle(self, throttle):
+        self.__throttle = throttle
+
+    throttle = property(_get_throttle, _set_throttle)
+
+    @property
+    def path(self):
+        """ The names of this set and its parents, like "master/media". """
+        if self.parent is None:
+            return self.name
+        return self.parent.path + "/" + self.name
+
+    def _finished(self, operation):
+        """ Whether the journal says operation has already been done on this
+        set. Each set that finishes is recorded in the journal (see
+        dumprestore.journal), so an interrupted dump or restore can be resumed. """
+        if self.journal is not None and self.journal.done(self.path):
+            logger.info("%s already finished its %s, skipping" % (self.path, operation))
+            return True
+        return False
+
+    @contextlib.contextmanager
+    def _phase(self, phase):
+        """ Time phase of this set, if there is a monitor (see
+        dumprestore.progress). Drivers count their work towards its report. """
+        if self.monitor is None:
+            yield
+            return
+        with self.monitor.phase(self.path, phase):
+            yield
+
+    def _run_driver(self, method):
+        if self.journal is not None:
+            self.driver.checkpoint = self.journal.checkpoint(self.path)
+        if self.monitor is not None:
+            self.driver.progress = self.monitor.progress(self.path)
+        self.driver.throttle = self.throttle
+        return getattr(self.driver, method)(self.archive)
+
+    def _record(self):
+        if self.journal is not None and self._selected():
+            self.journal.record(self.path)
+
+    def _selected(self):
+        """ Whether this set, or one it is inside, was selected. """
+        s = self
+        while s is not None:
+            if s.name in self.sets or s.path in self.sets:
+                return True
+            s = s.parent
+        return not self.sets
+
+    def _involved(self):
+        """ Whether this set or one inside it was selected. """
+        return self._selected() or any(c._involved() for c in self.children)
+
+    def walk(self):
+        """ This set and every set inside it. """
+        yield self
+        for c in self.children:
+            for s in c.walk():
+                yield s
+
+    def unknown(self, names):
+        """ Those of names that are neither the name nor the path of a set. """
+        known = set()
+        for s in self.walk():
+            known.update([s.name, s.path])
+        return [n for n in names if n not in known]
+
+    def implied(self, options):
+        """ The paths of the sets whose drivers are selected by options. """
+        return [s.path for s in self.walk() if s.driver is not None and
+                any(options.get(o) is not None for o in getattr(s.driver, "selecting", ()))]
+
+    def configure(self, sets=None, **options):
+        """ Pass the management command options on to every driver in the
+        set. sets limits restores and verifies to the sets it names, by name
+        or path, or without it, to those implied by the options, like
+        --database. Only those sets, the sets inside them, and the sets that
+        lead to them are visited, and only the selected sets' drivers used. """
+        if sets is None and self.parent is None:
+            sets = self.implied(options) or None
+        if sets is not None:
+            self.sets = list(sets)
+        for c in self.children:
+            c.configure(sets=sets, **options)
+        if self.driver is not None:
+            self.driver.configure(**options)
+
     def before_dump(self):
         """ Perform pre-flight checks. Return True if they passed, or False if they failed. """
         logger.info("%s performing pre-dump checks" % self.name)
-        checks = []
-        for c in self.children:
-            checks.append(c.before_dump())
-        if self.driver is not None:
-            checks.append(self.driver.before_dump(self.archive))
+        with self._phase("before_dump"):
+            checks = []
+            for c in self.children:
+                checks.append(c.before_dump())
+            if self.driver is not None:
+                checks.append(self._run_driver("before_dump"))
         return False not in checks
 
     def dump(self):
         """ Backup source data to temporary files, and return the names of the files. """
-        for c in self.children:
-            c.dump()
-        if self.driver is not None:
-            self.driver.dump(self.archive)
+        if self._finished("dump"):
+            return
+        with self._phase("dump"):
+            self._children("dump")
+            if self.driver is not None:
+                self._run_driver("dump")
+        self._record()
 
     def after_dump(self):
         """ Perform cleanup operations """
-        for c in self.children:
-            c.after_dump()
-        if self.driver is not None:
-            self.driver.after_dump(self.archive)
+        with self._phase("after_dump"):
+            for c in self.children:
+                c.after_dump()
+            if self.driver is not None:
+                self._run_driver("after_dump")
 
     def before_restore(self):
         """ Perform any checks required before restoring, return True on success, False on failure. """
-        checks = []
-        for c in self.children:
-            checks.append(c.before_restore())
-        if self.driver is not None:
-            checks.append(self.driver.before_restore(self.archive))
+        if not self._involved():
+            return True
+        with self._phase("before_restore"):
+            checks = []
+            for c in self.children:
+                checks.append(c.before_restore())
+            if self.driver is not None and self._selected():
+                checks.append(self._run_driver("before_restore"))
         return False not in checks
 
     def restore(self):
-        for c in self.children:
-            c.restore()
-        if self.driver is not None:
-            self.driver.restore(self.archive)
+        if not self._involved() or self._finished("restore"):
+            return
+        with self._phase("restore"):
+            self._children("restore")
+            if self.driver is not None and self._selected():
+                self._run_driver("restore")
+        self._record()
 
     def after_restore(self):
         """ Perform cleanup operations """
-        for c in self.children:
-            c.after_restore()
-        if self.driver is not None:
-            self.driver.after_restore(self.archive)
+        if not self._involved():
+            return
+        with self._phase("after_restore"):
+            for c in self.children:
+                c.after_restore()
+            if self.driver is not None and self._selected():
+                self._run_driver("after_restore")
+
+    def verify(self):
+        """ Check the archive can be restored from. Returns a list of the problems found. """
+        problems = []
+        if not self._involved():
+            return problems
+        with self._phase("verify"):
+            for c in self.children:
+                problems.extend(c.verify())
+            if self.driver is not None and self._selected():
+                problems.extend(self._run_driver("verify"))
+        return problems
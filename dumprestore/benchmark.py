@@ -0,0 +1,336 @@
+
+""" Benchmarks for dumping and restoring
+
+Builds a synthetic media tree of a given shape, then times the archive
+write and read paths, a media dump and restore through MediaDriver, and a
+database dump through DatabaseDriver against a stand-in for pg_dump. Run
+it as::
+
+    python -m dumprestore.benchmark --shape small --output before.json
+    python -m dumprestore.benchmark --shape small --compare before.json
+
+Each benchmark runs in a child process, where there is fork, and reports
+files/s, MB/s, the peak RSS of that child, and the read and write syscalls
+it made, where /proc/self/io has them. """
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import tempfile
+from optparse import OptionParser
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from django.conf import settings
+
+from .archive import Archive, CHUNK_SIZE
+from .database import DatabaseDriver, Postgres
+from .media import MediaDriver
+from .parallel import imap_bounded
+
+logger = logging.getLogger("dumprestore")
+
+MB = 1024.0 * 1024
+
+# files: how many, size: bytes each, depth and fanout: how they are spread
+# over a tree of directories fanout wide and depth deep
+shapes = {
+    'small': dict(files=10000, size=4 * 1024, depth=2, fanout=10),
+    'huge': dict(files=4, size=256 * 1024 * 1024, depth=0, fanout=1),
+    'deep': dict(files=2000, size=16 * 1024, depth=8, fanout=2),
+    'mixed': dict(files=1000, size=1024 * 1024, depth=3, fanout=4),
+}
+
+# The stand-in for pg_dump: writes the number of bytes in its first
+# argument, to the file after -f if there is one, or to stdout.
+FAKE_PG_DUMP = """
+import os, sys
+size = int(sys.argv[1])
+out = open(sys.argv[sys.argv.index('-f') + 1], 'wb') if '-f' in sys.argv else getattr(sys.stdout, 'buffer', sys.stdout)
+block = os.urandom(min(size, 1024 * 1024)) or b''
+while size > 0:
+    out.write(block[:size])
+    size -= len(block)
+out.close()
+"""
+
+class FakePostgres(Postgres):
+
+    """ Postgres with pg_dump replaced by a script writing size bytes. """
+
+    # not registered in place of Postgres
+    engine = None
+
+    def __init__(self, size):
+        self.backup_command = [sys.executable, "-c", FAKE_PG_DUMP, str(size)]
+
+    def connection(self, db):
+        return [], {}
+
+def write_tree(root, files, size, depth, fanout):
+    """ Fill root with files files of size bytes, spread round the leaves of
+    a tree of directories. Returns the names of the files, relative to root. """
+    leaves = [""]
+    for level in range(depth):
+        leaves = [os.path.join(l, "d%d" % i) for l in leaves for i in range(fanout)]
+    # half random, so compression has something to do but not everything
+    block = os.urandom(CHUNK_SIZE // 2) + b"\0" * (CHUNK_SIZE // 2)
+    names = []
+    for i in range(files):
+        name = os.path.join(leaves[i % len(leaves)], "f%d" % i)
+        path = os.path.join(root, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as f:
+            remaining = size
+            while remaining > 0:
+                f.write(block[:remaining])
+                remaining -= len(block)
+        names.append(name)
+    return names
+
+def io_counters():
+    """ The syscall and byte counters in /proc/self/io, or {} where there isn't one. """
+    counters = {}
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                key, value = line.split(":")
+                counters[key.strip()] = int(value)
+    except (IOError, OSError):
+        pass
+    return counters
+
+def peak_rss(usage):
+    """ The ru_maxrss of a resource usage, in bytes. """
+    if sys.platform == "darwin":
+        return usage.ru_maxrss
+    return usage.ru_maxrss * 1024
+
+def measure(func, files, size):
+    """ Call func, and return how long it took and what it cost. files and
+    size are how many files and bytes it handles, for the rates. """
+    before = io_counters()
+    started = time.time()
+    func()
+    elapsed = max(time.time() - started, 1e-9)
+    after = io_counters()
+    result = {
+        'seconds': elapsed,
+        'files': files,
+        'bytes': size,
+        'files_per_s': files / elapsed,
+        'mb_per_s': size / MB / elapsed,
+    }
+    for key in ('syscr', 'syscw', 'read_bytes', 'write_bytes'):
+        if key in after:
+            result[key] = after[key] - before.get(key, 0)
+    return result
+
+def isolated(func):
+    """ Call func in a child process and return what it returned, which must
+    be JSON, with the peak RSS of the child added. The high-water mark of
+    this process covers every benchmark run so far, so it can't be had here;
+    where there is no fork, func is called here and peak_rss is left out. """
+    if not hasattr(os, "fork") or resource is None:
+        return func()
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            os.close(read)
+            with os.fdopen(write, "w") as f:
+                json.dump(func(), f)
+            code = 0
+        except BaseException:
+            logger.exception("Benchmark failed")
+        finally:
+            os._exit(code)
+    os.close(write)
+    with os.fdopen(read) as f:
+        output = f.read()
+    _, status, usage = os.wait4(pid, 0)
+    if status != 0:
+        raise RuntimeError("Benchmark child exited with status %d" % status)
+    result = json.loads(output)
+    result['peak_rss'] = peak_rss(usage)
+    return result
+
+class Benchmark:
+
+    """ Runs every benchmark against one synthetic tree in workdir. """
+
+    formats = {
+        'zip': "archive.zip",
+        'tar': "archive.tar",
+        'directory': "archive",
+    }
+
+    def __init__(self, workdir, shape, format="zip", workers=1, databases=2, database_size=64 * 1024 * 1024, stream=False):
+        self.workdir = workdir
+        self.shape = shape
+        self.format = format
+        self.workers = workers
+        self.databases = databases
+        self.database_size = database_size
+        self.stream = stream
+        self.tree = os.path.join(workdir, "media")
+        self.names = []
+
+    def archive_name(self, name):
+        return os.path.join(self.workdir, name + "-" + self.formats[self.format])
+
+    def setup(self):
+        logger.info("Writing %(files)d files of %(size)d bytes" % self.shape)
+        self.names = write_tree(self.tree, **self.shape)
+        self.total = len(self.names) * self.shape['size']
+
+    def archive_write(self):
+        a = Archive.new(self.archive_name("write"), "w", backend=self.format)
+        for _ in imap_bounded(lambda n: a.write(os.path.join(self.tree, n), "data/" + n), self.names, self.workers):
+            pass
+        a.close()
+
+    def archive_read(self):
+        a = Archive.new(self.archive_name("write"), "r", backend=self.format)
+        def read(name):
+            with open(os.devnull, "wb") as null:
+                a.extractfile(name, null)
+        for _ in imap_bounded(read, a.namelist(), self.workers):
+            pass
+        a.close()
+
+    def media_dump(self):
+        from django.core.files.storage import FileSystemStorage
+        driver = MediaDriver(self.workdir, FileSystemStorage(location=self.tree), workers=self.workers, list_workers=self.workers)
+        a = Archive.new(self.archive_name("media"), "w", backend=self.format)
+        driver.dump(a.subarchive("media"))
+        a.close()
+
+    def media_restore(self):
+        from django.core.files.storage import FileSystemStorage
+        target = os.path.join(self.workdir, "restored")
+        os.mkdir(target)
+        driver = MediaDriver(self.workdir, FileSystemStorage(location=target), workers=self.workers, list_workers=self.workers)
+        a = Archive.new(self.archive_name("media"), "r", backend=self.format)
+        driver.restore(a.subarchive("media"))
+        a.close()
+
+    def database_dump(self):
+        driver = DatabaseDriver(self.workdir, stream=self.stream, workers=self.workers)
+        driver.databases = []
+        for i in range(self.databases):
+            name = "bench%d" % i
+            settings.DATABASES[name] = {'NAME': name}
+            driver.databases.append((name, FakePostgres(self.database_size)))
+        a = Archive.new(self.archive_name("database"), "w", backend=self.format)
+        driver.dump(a.subarchive("database"))
+        a.close()
+
+    def run(self, only=None):
+        """ Run the benchmarks named in only, or all of them, and return their results by name. """
+        database_total = self.databases * self.database_size
+        benchmarks = [
+            ('archive_write', self.archive_write, len(self.names), self.total),
+            ('archive_read', self.archive_read, len(self.names), self.total),
+            ('media_dump', self.media_dump, len(self.names), self.total),
+            ('media_restore', self.media_restore, len(self.names), self.total),
+            ('database_dump', self.database_dump, self.databases, database_total),
+        ]
+        results = {}
+        for name, func, files, size in benchmarks:
+            if only and name not in only:
+                continue
+            logger.info("Running %s" % name)
+            results[name] = isolated(lambda: measure(func, files, size))
+        return results
+
+def compare(old, new, threshold):
+    """ Print the change in each rate between two sets of results. Returns
+    the names of the benchmarks that slowed down by more than threshold. """
+    regressions = []
+    print("%-16s %-12s %12s %12s %8s" % ("benchmark", "metric", "before", "after", "change"))
+    for name in sorted(new):
+        if name not in old:
+            continue
+        for metric in ('files_per_s', 'mb_per_s', 'peak_rss', 'syscr', 'syscw'):
+            before, after = old[name].get(metric), new[name].get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / float(before)
+            print("%-16s %-12s %12.1f %12.1f %+7.1f%%" % (name, metric, before, after, change * 100))
+            if metric == 'mb_per_s' and change < -threshold:
+                regressions.append(name)
+    return regressions
+
+def main(argv=None):
+    parser = OptionParser(usage="python -m dumprestore.benchmark [options]")
+    parser.add_option('--shape', default='small', choices=sorted(shapes),
+                      help='Shape of the media tree: %s' % ", ".join(sorted(shapes)))
+    parser.add_option('--files', type='int', help='Number of media files, overriding the shape')
+    parser.add_option('--size', type='int', help='Size of each media file in bytes, overriding the shape')
+    parser.add_option('--depth', type='int', help='Depth of the directory tree, overriding the shape')
+    parser.add_option('--fanout', type='int', help='Directories in each directory, overriding the shape')
+    parser.add_option('--format', default='zip', choices=sorted(Benchmark.formats), help='Archive format')
+    parser.add_option('--workers', type='int', default=1, help='Threads for every driver and the archive paths')
+    parser.add_option('--databases', type='int', default=2, help='Number of databases to dump')
+    parser.add_option('--database-size', type='int', default=64 * 1024 * 1024, help='Bytes in each database dump')
+    parser.add_option('--stream', action='store_true', default=False, help='Stream database dumps into the archive')
+    parser.add_option('--only', action='append', help='Run only this benchmark, may be given more than once')
+    parser.add_option('--tempdir', default=None, help='Where to build the tree and archives')
+    parser.add_option('--output', help='Write the results to this JSON file')
+    parser.add_option('--compare', help='Compare against results written earlier with --output')
+    parser.add_option('--threshold', type='float', default=0.1,
+                      help='Exit with status 1 if MB/s drops by more than this fraction against --compare')
+    parser.add_option('--verbose', action='store_true', default=False)
+    options, args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if options.verbose else logging.WARNING)
+    if not settings.configured:
+        settings.configure()
+    shape = dict(shapes[options.shape])
+    for key in shape:
+        if getattr(options, key) is not None:
+            shape[key] = getattr(options, key)
+
+    workdir = tempfile.mkdtemp(dir=options.tempdir)
+    try:
+        benchmark = Benchmark(workdir, shape, options.format, options.workers,
+                              options.databases, options.database_size, options.stream)
+        benchmark.setup()
+        results = benchmark.run(options.only)
+    finally:
+        shutil.rmtree(workdir)
+
+    for name in sorted(results):
+        r = results[name]
+        print("%-16s %8.2fs %10.1f files/s %8.1f MB/s" % (name, r['seconds'], r['files_per_s'], r['mb_per_s']))
+    report = {
+        'shape': shape,
+        'format': options.format,
+        'workers': options.workers,
+        'python': platform.python_version(),
+        'results': results,
+    }
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as f:
+            old = json.load(f)
+        if compare(old['results'], results, options.threshold):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,10 @@
 
 import os
+import abc
+import errno
+import shutil
+import sqlite3
+import contextlib
 import subprocess
 import logging
 import tempfile
@@ -8,55 +13,436 @@ from django.conf import settings
 
 from . import registry
 from .backupset import BackupDriver
+from .parallel import imap_bounded
 
 logger = logging.getLogger("dumprestore")
 
 class DatabaseBackupException(Exception):
     pass
 
-databases = {}
+# the engine classes by ENGINE, which subclasses of DatabaseEngine fill in
+databases = registry.DriverRegistry.drivers
 
-class Postgres:
+class DatabaseEngine(object):
+
+    """ Dumps and restores the databases of one ENGINE in settings.DATABASES.
+    Defining a subclass with engine set registers it for that ENGINE.
+
+    An engine may also have dump_stream(db), a context manager yielding the
+    dump as a file, for DatabaseDriver's stream option, and verify(fileobj,
+    db), checking a dump read from fileobj. If directory_dumps is set, dump
+    with more than one job writes a directory, as for DatabaseDriver's
+    dump_jobs. """
+
+    __metaclass__ = registry.DriverRegistry
+
+    engine = None
+    directory_dumps = False
+
+    # set by DatabaseDriver to its throttle.Throttle, if it has one
+    throttle = None
+
+    def command(self, command):
+        """ command, run under nice and ionice if the throttle asks for them. """
+        if self.throttle is None:
+            return list(command)
+        return self.throttle.command(command)
+
+    @abc.abstractmethod
+    def dump(self, filename, db, jobs=1):
+        """ Dump db to filename. """
+
+    @abc.abstractmethod
+    def restore(self, filename, db, jobs=1):
+        """ Restore the dump in filename into db, using up to jobs processes. """
+
+class CommandEngine(DatabaseEngine):
+
+    """ An engine whose dumps are written by running backup_command. """
+
+    backup_command = []
+
+    @abc.abstractmethod
+    def connection(self, db):
+        """ Return the connection arguments and environment for db. """
+
+    @contextlib.contextmanager
+    def dump_stream(self, db):
+        """ Run backup_command for db, yielding its standard output as a
+        CommandOutput. Raises DatabaseBackupException, with whatever it
+        wrote to stderr, if it does not exit cleanly. """
+        logger.info("Streaming %s database %r" % (self.__class__.__name__.lower(), db))
+        conf = settings.DATABASES[db]
+        args, environment = self.connection(db)
+        command = self.command(self.backup_command + args)
+        if conf['NAME'] is not None:
+            command.append(conf['NAME'])
+        logger.debug("Executing %r" % " ".join(command))
+        # stderr goes to a file so a chatty dump can't block on a full pipe
+        errors = tempfile.TemporaryFile()
+        try:
+            process = subprocess.Popen(command, env=environment, stdout=subprocess.PIPE, stderr=errors)
+            output = CommandOutput(process, errors, "%s of %r" % (self.backup_command[0], db))
+            try:
+                yield output
+            except:
+                if output.returncode is None:
+                    process.kill()
+                    process.wait()
+                raise
+            output.wait()
+        finally:
+            errors.close()
+
+class CommandOutput:
+
+    """ The standard output of a dump command. Reading to the end of it
+    waits for the command, and raises DatabaseBackupException if it failed,
+    so whatever is copying the dump into an archive fails before the entry
+    is finished, instead of leaving a cut off dump that looks whole. """
+
+    def __init__(self, process, errors, name):
+        self.process = process
+        self.errors = errors
+        self.name = name
+        self.returncode = None
+
+    def read(self, size=-1):
+        buf = self.process.stdout.read(size)
+        if not buf and size != 0:
+            self.wait()
+        return buf
+
+    def wait(self):
+        """ Wait for the command to exit, raising if it failed. """
+        if self.returncode is None:
+            self.process.stdout.close()
+            self.returncode = self.process.wait()
+        if self.returncode != 0:
+            self.errors.seek(0)
+            raise DatabaseBackupException("%s exited with status %d: %s" % (
+                self.name, self.returncode, self.errors.read().strip()))
+
+    def __getattr__(self, name):
+        return getattr(self.process.stdout, name)
+
+class Postgres(CommandEngine):
+
+    engine = 'django.db.backends.postgresql_psycopg2'
+    directory_dumps = True
 
     backup_command = ['pg_dump', '-Fc', '-C', '-EUTF-8', '-b', '-o']
+    directory_command = ['pg_dump', '-Fd', '-C', '-EUTF-8', '-b', '-o']
+    restore_command = ['pg_restore', '-Fc']
+    directory_restore_command = ['pg_restore', '-Fd']
+    list_command = ['pg_restore', '--list']
 
-    def dump(self, filename, db):
-        logger.info("Backing up postgres database %r to %r" % (db, filename))
+    def connection(self, db):
+        """ Return the connection arguments and environment for db. """
         conf = settings.DATABASES[db]
         environment = {}
-        command = self.backup_command[:]
-        command.extend(['-f', filename])
+        args = []
         if conf['USER'] is not None:
-            command.extend(['-U', conf['USER']])
+            args.extend(['-U', conf['USER']])
         if conf['PASSWORD'] is not None:
             environment['PGPASSWORD'] = conf['PASSWORD']
         if conf['HOST'] is not None:
-            command.extend(['-h', conf['HOST']])
+            args.extend(['-h', conf['HOST']])
         if conf['PORT'] is not None:
-            command.extend(['-p', conf['PORT']])
+            args.extend(['-p', conf['PORT']])
+        return args, environment
+
+    def dump(self, filename, db, jobs=1):
+        """ Dump db to filename. With more than one job, filename is instead
+        a directory, which must not exist yet, that pg_dump fills with jobs
+        processes at once, all reading from one snapshot. """
+        logger.info("Backing up postgres database %r to %r" % (db, filename))
+        conf = settings.DATABASES[db]
+        args, environment = self.connection(db)
+        if jobs > 1:
+            command = self.command(self.directory_command + ['-j', str(jobs)])
+        else:
+            command = self.command(self.backup_command)
+        command.extend(['-f', filename])
+        command.extend(args)
         if conf['NAME'] is not None:
             command.append(conf['NAME'])
         logger.debug("Executing %r" % " ".join(command))
         subprocess.check_call(command, env=environment)
 
-databases['django.db.backends.postgresql_psycopg2'] = Postgres
+    def restore(self, filename, db, jobs=1):
+        """ Restore the dump in filename, a file or a directory, into db,
+        which must already exist, using jobs pg_restore processes. """
+        logger.info("Restoring postgres database %r from %r" % (db, filename))
+        conf = settings.DATABASES[db]
+        args, environment = self.connection(db)
+        if os.path.isdir(filename):
+            command = self.directory_restore_command[:]
+        else:
+            command = self.restore_command[:]
+        if jobs > 1:
+            command.extend(['-j', str(jobs)])
+        command.extend(args)
+        if conf['NAME'] is not None:
+            command.extend(['-d', conf['NAME']])
+        command.append(filename)
+        logger.debug("Executing %r" % " ".join(command))
+        subprocess.check_call(command, env=environment)
+
+    def verify(self, fileobj, db, chunk_size=1024 * 1024):
+        """ Check that fileobj holds a dump of db that pg_restore can read,
+        by piping it into pg_restore --list. fileobj is read to the end
+        whether pg_restore wants it all or not. Returns a list of the
+        problems found. """
+        logger.debug("Executing %r" % " ".join(self.list_command))
+        errors = tempfile.TemporaryFile()
+        devnull = open(os.devnull, "wb")
+        try:
+            process = subprocess.Popen(self.list_command, stdin=subprocess.PIPE, stdout=devnull, stderr=errors, bufsize=0)
+            listing = True
+            try:
+                while True:
+                    buf = fileobj.read(chunk_size)
+                    if not buf:
+                        break
+                    if not listing:
+                        continue
+                    try:
+                        process.stdin.write(buf)
+                    except (IOError, OSError) as e:
+                        if e.errno != errno.EPIPE:
+                            raise
+                        # pg_restore has read all it needs
+                        listing = False
+            except:
+                process.kill()
+                process.wait()
+                raise
+            finally:
+                process.stdin.close()
+            if process.wait() != 0:
+                errors.seek(0)
+                return ["%s: pg_restore --list exited with status %d: %s" % (
+                    db, process.returncode, errors.read().strip())]
+            return []
+        finally:
+            devnull.close()
+            errors.close()
+
+    def verify_directory(self, dirname, db):
+        """ Check that dirname holds a directory dump of db that pg_restore
+        can read. Returns a list of the problems found. """
+        command = self.list_command + [dirname]
+        logger.debug("Executing %r" % " ".join(command))
+        errors = tempfile.TemporaryFile()
+        devnull = open(os.devnull, "wb")
+        try:
+            if subprocess.call(command, stdout=devnull, stderr=errors) != 0:
+                errors.seek(0)
+                return ["%s: pg_restore --list exited with an error: %s" % (db, errors.read().strip())]
+            return []
+        finally:
+            devnull.close()
+            errors.close()
+
+# the name Django 1.9 and later give the same backend
+databases['django.db.backends.postgresql'] = Postgres
+
+class MySQL(CommandEngine):
+
+    """ Dumps with mysqldump in a single transaction, so InnoDB tables are
+    read from one snapshot without being locked, and rows are streamed
+    rather than held in memory a table at a time. A dump is restored by
+    feeding it to the mysql client, one database at a time, so jobs is
+    ignored. """
+
+    engine = 'django.db.backends.mysql'
+
+    backup_command = ['mysqldump', '--single-transaction', '--quick', '--routines', '--triggers', '--hex-blob']
+    restore_command = ['mysql']
+    # the last line mysqldump writes, unless it was cut short
+    trailer = b"-- Dump completed"
+
+    def connection(self, db):
+        conf = settings.DATABASES[db]
+        environment = {}
+        args = []
+        if conf.get('USER'):
+            args.extend(['-u', conf['USER']])
+        if conf.get('PASSWORD'):
+            environment['MYSQL_PWD'] = conf['PASSWORD']
+        if conf.get('HOST'):
+            args.extend(['-h', conf['HOST']])
+        if conf.get('PORT'):
+            args.extend(['-P', str(conf['PORT'])])
+        return args, environment
+
+    def dump(self, filename, db, jobs=1):
+        logger.info("Backing up mysql database %r to %r" % (db, filename))
+        conf = settings.DATABASES[db]
+        args, environment = self.connection(db)
+        command = self.command(self.backup_command + ['--result-file=%s' % filename] + args)
+        if conf['NAME'] is not None:
+            command.append(conf['NAME'])
+        logger.debug("Executing %r" % " ".join(command))
+        subprocess.check_call(command, env=environment)
+
+    def restore(self, filename, db, jobs=1):
+        logger.info("Restoring mysql database %r from %r" % (db, filename))
+        conf = settings.DATABASES[db]
+        args, environment = self.connection(db)
+        command = self.restore_command + args
+        if conf['NAME'] is not None:
+            command.append(conf['NAME'])
+        logger.debug("Executing %r" % " ".join(command))
+        with open(filename, "rb") as f:
+            subprocess.check_call(command, env=environment, stdin=f)
+
+    def verify(self, fileobj, db, chunk_size=1024 * 1024):
+        """ Check that the dump in fileobj was finished, by looking for the
+        line mysqldump ends with. """
+        tail = b""
+        while True:
+            buf = fileobj.read(chunk_size)
+            if not buf:
+                break
+            tail = (tail + buf)[-1024:]
+        if self.trailer not in tail:
+            return ["%s: the mysqldump output is incomplete" % (db,)]
+        return []
+
+class SQLite(DatabaseEngine):
+
+    """ Copies SQLite databases with the online backup API, pages at a time,
+    so writers are only held up while each step is copied. Where Python's
+    sqlite3 has no backup API, the dump is written as SQL inside one read
+    transaction instead, and a restore replaces the database file. There is
+    only ever one writer, so jobs is ignored. """
+
+    engine = 'django.db.backends.sqlite3'
+
+    pages = 1024
+
+    def copy(self, source, target):
+        """ Copy the database in the file source into the file target. """
+        src = sqlite3.connect(source)
+        dst = sqlite3.connect(target)
+        try:
+            if hasattr(src, 'backup'):
+                src.backup(dst, pages=self.pages)
+                return
+            src.isolation_level = None
+            dst.isolation_level = None
+            src.execute("BEGIN")
+            try:
+                for statement in src.iterdump():
+                    dst.execute(statement)
+            finally:
+                src.execute("ROLLBACK")
+        finally:
+            src.close()
+            dst.close()
+
+    def dump(self, filename, db, jobs=1):
+        source = settings.DATABASES[db]['NAME']
+        logger.info("Backing up sqlite database %r to %r" % (db, filename))
+        self.copy(source, filename)
+
+    def restore(self, filename, db, jobs=1):
+        target = settings.DATABASES[db]['NAME']
+        logger.info("Restoring sqlite database %r from %r" % (db, filename))
+        if hasattr(sqlite3.Connection, 'backup'):
+            self.copy(filename, target)
+            return
+        # copied beside the database and renamed over it, so it is never half there
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(target)), prefix=".restore")
+        os.close(fd)
+        try:
+            shutil.copyfile(filename, temp)
+            # mkstemp makes the file 0600, and the database keeps its own mode and owner
+            if os.path.exists(target):
+                shutil.copymode(target, temp)
+                if hasattr(os, 'geteuid') and os.geteuid() == 0:
+                    st = os.stat(target)
+                    os.chown(temp, st.st_uid, st.st_gid)
+            os.rename(temp, target)
+        except:
+            os.unlink(temp)
+            raise
+
+    def verify(self, fileobj, db, chunk_size=1024 * 1024):
+        """ Check the copy in fileobj with PRAGMA integrity_check. """
+        f = tempfile.NamedTemporaryFile(suffix=".sqlite3")
+        try:
+            shutil.copyfileobj(fileobj, f, chunk_size)
+            f.flush()
+            connection = sqlite3.connect(f.name)
+            try:
+                result = [row[0] for row in connection.execute("PRAGMA integrity_check")]
+            finally:
+                connection.close()
+        except sqlite3.DatabaseError as e:
+            return ["%s: %s" % (db, e)]
+        finally:
+            f.close()
+        if result != ["ok"]:
+            return ["%s: %s" % (db, r) for r in result]
+        return []
 
 class DatabaseDriver(BackupDriver):
 
-    def __init__(self, tempdir="/var/tmp"):
+    """ Dumps and restores every database in settings.DATABASES. """
+
+    selecting = ('database_names',)
+
+    def __init__(self, tempdir="/var/tmp", stream=False, jobs=1, workers=1, names=(), dump_jobs=1):
         self.tempdir = tempdir
+        self.stream = stream
+        self.jobs = jobs
+        self.workers = workers
+        self.names = list(names)
+        self.dump_jobs = dump_jobs
+
+    def configure(self, db_parallel=None, db_workers=None, database_names=None, db_dump_jobs=None, **options):
+        if db_parallel is not None:
+            self.jobs = db_parallel
+        if db_workers is not None:
+            self.workers = db_workers
+        if db_dump_jobs is not None:
+            self.dump_jobs = db_dump_jobs
+        if database_names is not None:
+            self.names = list(database_names)
+
+    def get_order(self):
+        """ DATABASE_BACKUP_ORDER as a list of groups of database names. """
+        groups = []
+        for o in getattr(settings, 'DATABASE_BACKUP_ORDER', ()):
+            if isinstance(o, (list, tuple)):
+                groups.append(list(o))
+            else:
+                groups.append([o])
+        return groups
 
     def get_databases(self):
-        order = getattr(settings, 'DATABASE_BACKUP_ORDER', ())
+        """ The (db, driver) pairs to back up, in DATABASE_BACKUP_ORDER, then
+        the rest. With names, only those databases. """
+        order = sum(self.get_order(), [])
         remaining = settings.DATABASES.keys()
         for o in order:
             remaining.remove(o)
+        for name in self.names:
+            if name not in settings.DATABASES:
+                raise DatabaseBackupException("No database called %r in settings.DATABASES" % name)
         for db in list(order) + list(remaining):
+            if self.names and db not in self.names:
+                continue
             engine = settings.DATABASES[db]['ENGINE']
             driver = databases.get(engine, None)
             if driver is None:
                 raise DatabaseBackupException("No driver for engine %r" % engine)
-            yield db, driver()
+            d = driver()
+            d.throttle = self.throttle
+            yield db, d
 
     def before_dump(self, archive):
         self.databases = list(self.get_databases())
@@ -64,23 +450,252 @@ class DatabaseDriver(BackupDriver):
         for db, driver in self.databases:
             logger.info("    %s (%s)" % (db, driver.__class__.__name__))
 
-    def before_restore(self):
+    def before_restore(self, archive):
         self.databases = list(self.get_databases())
-        log.info("Restoring to the following databases:")
+        logger.info("Restoring to the following databases:")
         for db, driver in self.databases:
-            log.info("    %s (%s)" % (db, driver.__class__.__name__))
+            logger.info("    %s (%s)" % (db, driver.__class__.__name__))
 
-    def dump(self, archive):
-        for db, driver in self.databases:
-            logger.info("Dumping database %r" % db)
+    def get_groups(self, databases):
+        """ Split the (db, driver) pairs in databases into groups that may be
+        dumped at the same time, in the order they must be dumped. A tuple in
+        DATABASE_BACKUP_ORDER is a group, and any databases not listed form
+        a final one. """
+        order = self.get_order()
+        position = {}
+        for i, group in enumerate(order):
+            for db in group:
+                position[db] = i
+        groups = [[] for i in range(len(order) + 1)]
+        for db, driver in databases:
+            groups[position.get(db, len(order))].append((db, driver))
+        return [g for g in groups if g]
+
+    def finished(self, db):
+        """ Whether db was finished by an earlier run that was interrupted. """
+        return self.checkpoint is not None and self.checkpoint.done(db)
+
+    def record(self, db):
+        if self.checkpoint is not None:
+            self.checkpoint.record(db)
+
+    def dumped(self, db, archive):
+        """ Whether archive holds a whole dump of db. A directory dump is
+        only whole once its toc.dat, which goes in last, is there. """
+        return archive.exists("%s.dmp" % (db,)) or archive.exists("%s.dir/toc.dat" % (db,))
+
+    def dumps_directory(self, driver):
+        return self.dump_jobs > 1 and driver.directory_dumps
+
+    def dump_file(self, db, driver):
+        """ Dump db to a new temporary file, or directory with dump_jobs,
+        and return its name. """
+        logger.info("Dumping database %r" % db)
+        if self.dumps_directory(driver):
+            # pg_dump makes the directory itself, so it goes in a new one
+            filename = os.path.join(tempfile.mkdtemp(dir=self.tempdir), db)
+            logger.debug("Writing to temporary directory %r" % filename)
+        else:
             f = tempfile.NamedTemporaryFile(dir=self.tempdir, delete=False)
             filename = f.name
             f.close()
             logger.debug("Writing to temporary file %r" % filename)
-            driver.dump(filename, db)
-            archive.write(filename, "%s.dmp" % (db,))
+        try:
+            if self.dumps_directory(driver):
+                driver.dump(filename, db, self.dump_jobs)
+            else:
+                driver.dump(filename, db)
+        except:
+            self.discard(driver, filename)
+            raise
+        return filename
+
+    def discard(self, driver, filename):
+        """ Remove the temporary dump in filename, made by dump_file, if it
+        is still there. """
+        if self.dumps_directory(driver):
+            shutil.rmtree(os.path.dirname(filename), ignore_errors=True)
+        elif os.path.exists(filename):
+            os.unlink(filename)
+
+    def archive_directory(self, db, dirname, archive):
+        # toc.dat last, so a dump cut short is never taken for a whole one
+        names = sorted(os.listdir(dirname), key=lambda n: (n == "toc.dat", n))
+        size = 0
+        for name in names:
+            path = os.path.join(dirname, name)
+            self.write_file(archive, path, "%s.dir/%s" % (db, name))
+            size += os.path.getsize(path)
+        self.count(1, size)
+        logger.debug("Removing temporary directory %r" % dirname)
+        shutil.rmtree(os.path.dirname(dirname))
+        self.record(db)
+
+    def archive_file(self, db, driver, filename, archive):
+        if self.dumps_directory(driver):
+            self.archive_directory(db, filename, archive)
+            return
+        self.write_file(archive, filename, "%s.dmp" % (db,))
+        self.count(1, os.path.getsize(filename))
+        logger.debug("Removing temporary file %r" % filename)
+        os.unlink(filename)
+        self.record(db)
+
+    def dump(self, archive):
+        """ Dump each group of databases, up to workers of a group at once,
+        each to its own temporary file, copied into the archive in order.
+
+        With dump_jobs, each database is dumped by pg_dump -Fd with that
+        many processes sharing one snapshot, and goes into the archive as
+        <db>.dir/, its toc.dat last. When resuming, databases the checkpoint
+        records are skipped, if their dump is in the archive. """
+        self.expect(len(self.databases))
+        for group in self.get_groups(self.databases):
+            for db, driver in list(group):
+                if self.finished(db) and self.dumped(db, archive):
+                    logger.info("Database %r already dumped, skipping" % db)
+                    group.remove((db, driver))
+            if self.workers > 1 and len(group) > 1:
+                logger.info("Dumping up to %d of %s at once" % (self.workers, ", ".join(db for db, driver in group)))
+                if self.stream:
+                    logger.info("Not streaming %s: databases dumped at once go through temporary files" % (
+                        ", ".join(db for db, driver in group)))
+                # dumps not yet archived, removed if another in the group fails
+                unarchived = []
+                def dump_file(d):
+                    filename = self.dump_file(*d)
+                    unarchived.append((d[1], filename))
+                    return d[0], d[1], filename
+                dumped = imap_bounded(dump_file, group, self.workers)
+                try:
+                    for db, driver, filename in dumped:
+                        self.archive_file(db, driver, filename, archive)
+                        unarchived.remove((driver, filename))
+                finally:
+                    # waits for the dumps still running
+                    dumped.close()
+                    for driver, filename in unarchived:
+                        self.discard(driver, filename)
+                continue
+            for db, driver in group:
+                if self.stream and not self.dumps_directory(driver) and hasattr(driver, 'dump_stream'):
+                    logger.info("Dumping database %r" % db)
+                    with driver.dump_stream(db) as f:
+                        archive.writefile("%s.dmp" % (db,), self.throttled(f))
+                    self.count(1)
+                    self.record(db)
+                else:
+                    filename = self.dump_file(db, driver)
+                    try:
+                        self.archive_file(db, driver, filename, archive)
+                    except:
+                        self.discard(driver, filename)
+                        raise
+
+    def extract_directory(self, db, archive, dirname):
+        """ Extract the directory dump of db into dirname. Returns its size. """
+        prefix = "%s.dir/" % (db,)
+        size = 0
+        for name in archive.namelist(prefix):
+            if "/" in name[len(prefix):]:
+                raise DatabaseBackupException("Unexpected entry %r in a directory dump" % name)
+            filename = os.path.join(dirname, name[len(prefix):])
+            archive.extract(name, filename)
+            size += os.path.getsize(filename)
+        return size
+
+    def restore_directory(self, db, driver, archive):
+        logger.info("Restoring database %r from a directory dump" % db)
+        dirname = tempfile.mkdtemp(dir=self.tempdir)
+        try:
+            logger.debug("Extracting to temporary directory %r" % dirname)
+            size = self.extract_directory(db, archive, dirname)
+            driver.restore(dirname, db, self.jobs)
+            self.count(1, size)
+            self.record(db)
+        finally:
+            logger.debug("Removing temporary directory %r" % dirname)
+            shutil.rmtree(dirname)
+
+    def restore_database(self, db, driver, archive):
+        if not archive.exists("%s.dmp" % (db,)) and archive.exists("%s.dir/toc.dat" % (db,)):
+            self.restore_directory(db, driver, archive)
+            return
+        logger.info("Restoring database %r" % db)
+        f = tempfile.NamedTemporaryFile(dir=self.tempdir, delete=False)
+        filename = f.name
+        try:
+            logger.debug("Extracting to temporary file %r" % filename)
+            archive.extractfile("%s.dmp" % (db,), f)
+            f.close()
+            driver.restore(filename, db, self.jobs)
+            self.count(1, os.path.getsize(filename))
+            self.record(db)
+        finally:
+            f.close()
             logger.debug("Removing temporary file %r" % filename)
             os.unlink(filename)
 
+    def verify_database(self, db, driver, archive):
+        """ Read the dump of db through, which checks its CRC in a zip, and
+        have driver check it if it knows how. Returns a list of the problems found. """
+        entry = "%s.dmp" % (db,)
+        if not archive.exists(entry) and archive.exists("%s.dir/toc.dat" % (db,)):
+            return self.verify_directory(db, driver, archive)
+        if not archive.exists(entry):
+            return ["%s: missing from the archive" % (entry,)]
+        logger.info("Verifying database %r" % db)
+        try:
+            with archive.open(entry) as f:
+                if hasattr(driver, 'verify'):
+                    problems = driver.verify(f, db)
+                else:
+                    problems = []
+                while f.read(1024 * 1024):
+                    pass
+        except Exception as e:
+            return ["%s: %s" % (entry, e)]
+        self.count(1, archive.size(entry))
+        return problems
+
+    def verify_directory(self, db, driver, archive):
+        """ Extract the directory dump of db, which checks the CRC of each
+        file in a zip, and have driver check it if it knows how. """
+        logger.info("Verifying database %r" % db)
+        dirname = tempfile.mkdtemp(dir=self.tempdir)
+        try:
+            size = self.extract_directory(db, archive, dirname)
+            problems = []
+            if hasattr(driver, 'verify_directory'):
+                problems = driver.verify_directory(dirname, db)
+        except Exception as e:
+            return ["%s.dir: %s" % (db, e)]
+        finally:
+            shutil.rmtree(dirname)
+        self.count(1, size)
+        return problems
+
+    def verify(self, archive):
+        databases = list(self.get_databases())
+        self.expect(len(databases))
+        problems = []
+        for found in imap_bounded(lambda d: self.verify_database(d[0], d[1], archive), databases, self.workers):
+            problems.extend(found)
+        return problems
+
     def restore(self, archive):
-        pass
+        """ Restore up to workers databases at once, each extracted to
+        tempdir, since parallel pg_restore needs a file it can seek in, and
+        loaded with jobs processes. When resuming, databases the checkpoint
+        records are left alone. """
+        databases = []
+        for db, driver in self.databases:
+            if self.finished(db):
+                logger.info("Database %r already restored, skipping" % db)
+            else:
+                databases.append((db, driver))
+        self.expect(len(databases))
+        if self.workers > 1:
+            logger.info("Restoring up to %d databases at once" % self.workers)
+        for _ in imap_bounded(lambda d: self.restore_database(d[0], d[1], archive), databases, self.workers):
+            pass
@@ -0,0 +1,223 @@
+
+""" Backs up a directory on the local filesystem """
+
+import os
+import json
+import stat
+import logging
+import tempfile
+
+from .archive import CHUNK_SIZE
+from .backupset import BackupDriver
+from .listing import scandir
+from .parallel import imap_bounded, iwalk
+
+logger = logging.getLogger("dumprestore")
+
+class FilesystemRestoreException(Exception):
+    pass
+
+class FilesystemDriver(BackupDriver):
+
+    """ Backs up the directory tree at path: the contents of every file, as
+    data/<name>, and the type, mode and modification time of every file,
+    directory and symlink, in manifest.jsonl. Anything else, like sockets,
+    is left out.
+
+    The tree is walked with os.scandir, listing up to list_workers
+    directories at once, and up to workers files are copied in or out at
+    once. Copies go through the archive's write and extract, which copy
+    inside the kernel for a directory archive.
+
+    A restore puts back the modes and modification times, and skips files
+    whose size and modification time already match, so restoring over an
+    earlier restore only copies what changed. Files that aren't in the
+    archive are left alone. """
+
+    def __init__(self, path, workers=1, list_workers=1):
+        self.path = path
+        self.workers = workers
+        self.list_workers = list_workers
+
+    def configure(self, fs_workers=None, list_workers=None, **options):
+        if fs_workers is not None:
+            self.workers = fs_workers
+        if list_workers is not None:
+            self.list_workers = list_workers
+
+    def full(self, name):
+        """ The full path of name in the tree. """
+        path = os.path.normpath(os.path.join(self.path, *name.split("/")))
+        if path != os.path.normpath(self.path) and not path.startswith(os.path.join(os.path.normpath(self.path), "")):
+            raise FilesystemRestoreException("%r is outside %s" % (name, self.path))
+        return path
+
+    def listdir(self, name):
+        """ Returns the names of the directories in name, and a (name, stat)
+        pair for every entry in it. """
+        root = self.full(name)
+        with self.request():
+            if scandir is None:
+                entries = [(n, os.lstat(os.path.join(root, n))) for n in os.listdir(root)]
+            else:
+                entries = [(e.name, e.stat(follow_symlinks=False)) for e in scandir(root)]
+        prefix = name + "/" if name else ""
+        entries = [(prefix + n, st) for n, st in entries]
+        return [n for n, st in entries if stat.S_ISDIR(st.st_mode)], entries
+
+    def entries(self):
+        """ Return a generator of the name and manifest record of everything
+        in the tree, directories before what is in them. """
+        for d, entries in iwalk(self.listdir, "", self.list_workers):
+            for name, st in entries:
+                record = {
+                    'name': name,
+                    'mode': stat.S_IMODE(st.st_mode),
+                    'mtime': st.st_mtime,
+                }
+                if stat.S_ISDIR(st.st_mode):
+                    record['type'] = "directory"
+                elif stat.S_ISLNK(st.st_mode):
+                    record['type'] = "symlink"
+                    record['target'] = os.readlink(self.full(name))
+                elif stat.S_ISREG(st.st_mode):
+                    record['type'] = "file"
+                    record['size'] = st.st_size
+                else:
+                    logger.warning("Not backing up %s, which is not a file, directory or symlink" % self.full(name))
+                    continue
+                yield record
+
+    def dump_file(self, record, archive):
+        """ Copy the file record describes into the archive. With a throttle
+        it is read through it, its first read a request, instead of being
+        copied in the kernel. """
+        arcname = "data/%s" % (record['name'],)
+        if self.throttle is None:
+            archive.write(self.full(record['name']), arcname)
+            return record
+        with open(self.full(record['name']), "rb") as f:
+            archive.writefile(arcname, self.opened(f))
+        return record
+
+    def dump(self, archive):
+        logger.info("Dumping %s" % self.path)
+        written = set()
+        if self.checkpoint is not None:
+            written = set(archive.namelist("data/"))
+        manifest = tempfile.SpooledTemporaryFile(max_size=CHUNK_SIZE)
+        files = []
+        for record in self.entries():
+            manifest.write((json.dumps(record) + "\n").encode("utf-8"))
+            if record['type'] != "file":
+                continue
+            if self.checkpoint is not None and self.checkpoint.done(record['name']) \
+                    and "data/%s" % (record['name'],) in written:
+                continue
+            files.append(record)
+        for record in imap_bounded(lambda r: self.dump_file(r, archive), files, self.workers):
+            self.count(1, record['size'])
+            if self.checkpoint is not None:
+                self.checkpoint.record(record['name'])
+        manifest.seek(0)
+        with manifest:
+            archive.writefile("manifest.jsonl", manifest)
+        logger.info("%d files written from %s" % (len(files), self.path))
+
+    def read_manifest(self, archive):
+        records = []
+        with archive.open("manifest.jsonl") as f:
+            for line in f:
+                records.append(json.loads(line))
+        return records
+
+    def unchanged(self, record):
+        """ Whether the file for record is already in the tree, with the same size and modification time. """
+        try:
+            st = os.lstat(self.full(record['name']))
+        except OSError:
+            return False
+        return stat.S_ISREG(st.st_mode) and st.st_size == record['size'] and abs(st.st_mtime - record['mtime']) < 0.001
+
+    def restore_file(self, record, archive):
+        """ Bring the file for record up to date. Returns True if it was copied. """
+        path = self.full(record['name'])
+        if self.unchanged(record):
+            os.chmod(path, record['mode'])
+            return False
+        # copied beside the file and renamed over it, so it is never half there
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".restore")
+        os.close(fd)
+        try:
+            archive.extract("data/%s" % (record['name'],), temp)
+            os.chmod(temp, record['mode'])
+            os.utime(temp, (record['mtime'], record['mtime']))
+            os.rename(temp, path)
+        except:
+            os.unlink(temp)
+            raise
+        return True
+
+    def restore_link(self, record):
+        path = self.full(record['name'])
+        if os.path.islink(path) and os.readlink(path) == record['target']:
+            return
+        if os.path.lexists(path):
+            os.unlink(path)
+        os.symlink(record['target'], path)
+
+    def restore(self, archive):
+        logger.info("Restoring %s" % self.path)
+        records = self.read_manifest(archive)
+        directories = [r for r in records if r['type'] == "directory"]
+        files = [r for r in records if r['type'] == "file"]
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        for r in directories:
+            path = self.full(r['name'])
+            if not os.path.isdir(path):
+                # writable until its files are in; its own mode is set at the end
+                os.mkdir(path, 0o700)
+        for r in records:
+            if r['type'] == "symlink":
+                self.restore_link(r)
+        self.expect(len(files), sum(r['size'] for r in files))
+        copied = 0
+        for record, written in imap_bounded(lambda r: (r, self.restore_file(r, archive)), files, self.workers):
+            self.count(1, record['size'] if written else 0)
+            copied += written
+        # copying files in changes the times of their directories, so they go last, deepest first
+        for r in reversed(directories):
+            path = self.full(r['name'])
+            os.chmod(path, r['mode'])
+            os.utime(path, (r['mtime'], r['mtime']))
+        logger.info("%d files copied to %s, %d already up to date" % (copied, self.path, len(files) - copied))
+
+    def verify_file(self, record, archive):
+        name = "data/%s" % (record['name'],)
+        if not archive.exists(name):
+            return ["%s: missing from the archive" % (name,)]
+        size = 0
+        try:
+            with archive.open(name) as f:
+                while True:
+                    buf = f.read(CHUNK_SIZE)
+                    if not buf:
+                        break
+                    size += len(buf)
+        except Exception as e:
+            return ["%s: %s" % (name, e)]
+        self.count(1, size)
+        if size != record['size']:
+            return ["%s: %d bytes where %d were expected" % (name, size, record['size'])]
+        return []
+
+    def verify(self, archive):
+        if not archive.exists("manifest.jsonl"):
+            return ["No manifest for %s" % (self.path,)]
+        files = [r for r in self.read_manifest(archive) if r['type'] == "file"]
+        self.expect(len(files), sum(r['size'] for r in files))
+        problems = []
+        for found in imap_bounded(lambda r: self.verify_file(r, archive), files, self.workers):
+            problems.extend(found)
+        return problems
@@ -0,0 +1,130 @@
+
+""" A journal of finished work, so an interrupted dump or restore can be resumed """
+
+import os
+import json
+import errno
+import logging
+import threading
+
+logger = logging.getLogger("dumprestore")
+
+def _text(s):
+    """ json gives back text, so keys are kept as text to match it. """
+    if isinstance(s, bytes):
+        return s.decode("utf-8")
+    return s
+
+class Journal:
+
+    """ Records which pieces of a dump or restore are finished, as one JSON
+    object per line in filename. Each piece is a unit within a scope: a
+    backup set's scope is its path, like "master/media", its drivers record
+    their own units (a database, a media file) within it, and the unit None
+    means the whole set is finished.
+
+    Lines are flushed as they are written, so the journal survives the
+    process dying. A line cut short by that is ignored when the journal is
+    read back. """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.finished = {}
+        self.f = None
+
+    @classmethod
+    def beside(klass, archive_filename, operation):
+        """ The journal of operation ("dump" or "restore") on archive_filename. """
+        return klass("%s.%s.journal" % (archive_filename.rstrip("/"), operation))
+
+    @classmethod
+    def for_archive(klass, archive_filename, operation, resume=False, filename=None):
+        """ Open the journal of operation on archive_filename, at filename if
+        one is given, and otherwise beside the archive. Returns None, with a
+        warning, if there is no filename and the archive is stdout or in a
+        directory that can't be written. """
+        if filename is not None:
+            journal = klass(filename)
+            journal.open(resume)
+            return journal
+        if archive_filename == "-":
+            return None
+        journal = klass.beside(archive_filename, operation)
+        try:
+            journal.open(resume)
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EACCES, errno.EPERM, errno.EROFS):
+                raise
+            logger.warning("Not keeping a journal, so the %s can't be resumed: %s" % (operation, e))
+            return None
+        return journal
+
+    def open(self, resume=False):
+        """ Start recording. If resume, the work already recorded counts as
+        finished, otherwise the journal starts again empty. """
+        if resume and os.path.exists(self.filename):
+            self.load()
+            logger.info("Resuming: %d pieces of work already finished" % len(self.finished))
+            self.f = open(self.filename, "a")
+        else:
+            self.f = open(self.filename, "w")
+
+    def load(self):
+        with open(self.filename) as f:
+            for line in f:
+                try:
+                    d = json.loads(line)
+                except ValueError:
+                    logger.warning("Ignoring incomplete journal line %r" % line)
+                    continue
+                self.finished[(d['scope'], d['unit'])] = d.get('info')
+
+    def done(self, scope, unit=None):
+        return (_text(scope), _text(unit)) in self.finished
+
+    def info(self, scope, unit=None):
+        """ Whatever was recorded along with unit, or None. """
+        return self.finished.get((_text(scope), _text(unit)))
+
+    def record(self, scope, unit=None, info=None):
+        """ Record that unit of scope is finished. info is anything json can
+        encode that is needed to resume without doing the unit again. """
+        key = (_text(scope), _text(unit))
+        line = json.dumps({'scope': key[0], 'unit': key[1], 'info': info})
+        with self.lock:
+            self.finished[key] = info
+            if self.f is not None:
+                self.f.write(line + "\n")
+                self.f.flush()
+
+    def checkpoint(self, scope):
+        return Checkpoint(self, scope)
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def remove(self):
+        """ Throw the journal away once everything is finished. """
+        self.close()
+        if os.path.exists(self.filename):
+            os.unlink(self.filename)
+
+class Checkpoint:
+
+    """ The part of a journal belonging to one backup set, as its driver sees it. """
+
+    def __init__(self, journal, scope):
+        self.journal = journal
+        self.scope = scope
+
+    def done(self, unit):
+        return self.journal.done(self.scope, unit)
+
+    def info(self, unit):
+        return self.journal.info(self.scope, unit)
+
+    def record(self, unit, info=None):
+        self.journal.record(self.scope, unit, info)
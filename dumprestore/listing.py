@@ -0,0 +1,74 @@
+
+""" Listers read a directory of a storage together with the stats of the files in it """
+
+import os
+from datetime import datetime
+
+from django.core.files.storage import FileSystemStorage
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+listers = {}
+
+def _stats(st):
+    """ The stats FileMetadata stores, from an os.stat result, as FileSystemStorage would report them. """
+    return {
+        'accessed_time': datetime.fromtimestamp(st.st_atime).isoformat(),
+        'created_time': datetime.fromtimestamp(st.st_ctime).isoformat(),
+        'modified_time': datetime.fromtimestamp(st.st_mtime).isoformat(),
+        'size': st.st_size,
+    }
+
+class StorageLister:
+
+    """ Lists any storage through the Storage API. This can't get stats
+    cheaply, so leaves them to be asked for one file at a time. """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def listdir(self, path):
+        """ Returns a list of the directories in path, and a list of the
+        files in path, each paired with a dict of whatever stats came with the
+        listing. """
+        directories, files = self.storage.listdir(path)
+        return directories, [(f, {}) for f in files]
+
+class FileSystemLister(StorageLister):
+
+    """ Lists a FileSystemStorage with os.scandir, which gives the stats of
+    every file in a directory for the cost of reading the directory. """
+
+    def listdir(self, path):
+        directories = []
+        files = []
+        root = self.storage.path(path)
+        if scandir is None:
+            for name in os.listdir(root):
+                full = os.path.join(root, name)
+                if os.path.isdir(full):
+                    directories.append(name)
+                else:
+                    files.append((name, _stats(os.stat(full))))
+            return directories, files
+        for entry in scandir(root):
+            if entry.is_dir():
+                directories.append(entry.name)
+            else:
+                files.append((entry.name, _stats(entry.stat())))
+        return directories, files
+
+listers[FileSystemStorage] = FileSystemLister
+
+def get_lister(storage):
+    """ Return the most specific lister registered for the class of storage. """
+    for klass in type(storage).__mro__:
+        if klass in listers:
+            return listers[klass](storage)
+    return StorageLister(storage)
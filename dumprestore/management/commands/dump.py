@@ -1,16 +1,56 @@
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
-from dumprestore.archive import Archive
+from dumprestore.archive import Archive, ArchiveException, CompressionPolicy
+from dumprestore.journal import Journal
+from dumprestore.progress import Monitor
+from dumprestore.throttle import Throttle
 from dumprestore.default import default_set
 from dumprestore import archive
 
 from logging import getLogger
+from optparse import make_option
 
 logger = getLogger("dumprestore")
 
 class Command(BaseCommand):
     args = '<filename>'
     help = "Backup to the specified zip filename"
+    option_list = BaseCommand.option_list + (
+        make_option('--list-workers', type='int', dest='list_workers', default=None,
+                    help='Number of media directories to list at once'),
+        make_option('--media-workers', type='int', dest='media_workers', default=None,
+                    help='Number of threads fetching media from the storage at once'),
+        make_option('--fs-workers', type='int', dest='fs_workers', default=None,
+                    help='Number of files to copy in at once for each filesystem backup'),
+        make_option('--db-workers', type='int', dest='db_workers', default=None,
+                    help='Number of databases to dump at once'),
+        make_option('--db-dump-jobs', type='int', dest='db_dump_jobs', default=None,
+                    help='Number of pg_dump processes for each database, dumping it as a directory'),
+        make_option('--base', dest='base', default=None,
+                    help='Only dump media that has changed since this earlier archive'),
+        make_option('--dedup', action='store_true', dest='dedup', default=None,
+                    help='Store media files with identical contents only once'),
+        make_option('--compression', dest='compression', default=None,
+                    help='How to compress entries: stored, deflated, bzip2, lzma or auto'),
+        make_option('--compress-level', type='int', dest='compress_level', default=None,
+                    help='Compression level, from 1 (fastest) to 9 (smallest)'),
+        make_option('--format', dest='format', default=None,
+                    help='Archive format: zip, tar or directory. Guessed from the filename by default, and "-" streams a tar to stdout'),
+        make_option('--resume', action='store_true', dest='resume', default=False,
+                    help='Carry on with an interrupted dump to a zip or directory, skipping whatever it finished'),
+        make_option('--max-rate', type='int', dest='max_rate', default=None,
+                    help='Read no more than this many bytes a second from the storage'),
+        make_option('--max-requests', type='float', dest='max_requests', default=None,
+                    help='Make no more than this many requests a second to the storage'),
+        make_option('--nice', action='store_true', dest='nice', default=False,
+                    help='Run pg_dump and the like under nice and ionice -c idle'),
+        make_option('--journal', dest='journal', default=None,
+                    help='Keep the journal for --resume here, instead of beside the archive'),
+        make_option('--report', dest='report', default=None,
+                    help='Write the JSON report here, instead of beside the archive'),
+        make_option('--prometheus', dest='prometheus', default=None,
+                    help='Keep this Prometheus textfile up to date with progress and timings'),
+    )
 
     def handle(self, *args, **options):
         if len(args) != 1:
@@ -22,9 +62,43 @@ class Command(BaseCommand):
         else:
             logger.debug("Using default backup set")
             s = default_set()
-        logger.info("Creating archive at %s" % archive_filename)
-        s.archive = Archive.new(archive_filename, "w")
-        if not s.before_dump():
-            raise SystemExit()
-        s.dump()
-        s.after_dump()
+        if options.get('max_rate') or options.get('max_requests') or options.get('nice'):
+            # overrides the throttle of the whole set, but not those of its children
+            nice = options.get('nice') or None
+            s.throttle = Throttle(options.get('max_rate'), options.get('max_requests'),
+                                  nice=nice and 19, ionice=nice and "idle")
+        compression = CompressionPolicy.from_settings(settings, options.get('compression'), options.get('compress_level'))
+        if options.get('resume'):
+            if archive_filename == "-":
+                raise CommandError("A dump to stdout cannot be resumed")
+            logger.info("Resuming the dump to %s" % archive_filename)
+            try:
+                s.archive = Archive.new(archive_filename, "a", compression, backend=options.get('format'))
+            except ArchiveException as e:
+                raise CommandError("Cannot resume the dump to %s: %s" % (archive_filename, e))
+        else:
+            logger.info("Creating archive at %s" % archive_filename)
+            try:
+                s.archive = Archive.new(archive_filename, "w", compression, backend=options.get('format'))
+            except ArchiveException as e:
+                raise CommandError("Cannot dump to %s: %s" % (archive_filename, e))
+        journal = Journal.for_archive(archive_filename, "dump", options.get('resume'), options.get('journal'))
+        s.journal = journal
+        s.monitor = Monitor.for_archive(archive_filename, "dump", options.get('prometheus') or
+                                        getattr(settings, 'DUMPRESTORE_PROMETHEUS_TEXTFILE', None),
+                                        report=options.get('report'))
+        success = False
+        try:
+            s.configure(**options)
+            if not s.before_dump():
+                raise SystemExit()
+            s.dump()
+            s.after_dump()
+            success = True
+        finally:
+            s.archive.close()
+            if journal is not None:
+                journal.close()
+            s.monitor.finish(success)
+        if journal is not None:
+            journal.remove()
@@ -2,12 +2,45 @@ from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
 from dumprestore.archive import Archive
 from dumprestore.default import default_set
+from dumprestore.journal import Journal
+from dumprestore.progress import Monitor
 from dumprestore import archive
+from optparse import make_option
 
 class Command(BaseCommand):
     args = '<filename>'
     help = "Backup to the specified zip filename"
-    
+    option_list = BaseCommand.option_list + (
+        make_option('--list-workers', type='int', dest='list_workers', default=None,
+                    help='Number of media directories to list at once'),
+        make_option('--media-workers', type='int', dest='media_workers', default=None,
+                    help='Number of threads checking and uploading media at once'),
+        make_option('--db-parallel', type='int', dest='db_parallel', default=None,
+                    help='Number of parallel pg_restore jobs for each database'),
+        make_option('--fs-workers', type='int', dest='fs_workers', default=None,
+                    help='Number of files to copy out at once for each filesystem backup'),
+        make_option('--db-workers', type='int', dest='db_workers', default=None,
+                    help='Number of databases to restore at once'),
+        make_option('--base-dir', dest='base_dir', default=None,
+                    help='Directory holding the base archives of an incremental dump'),
+        make_option('--format', dest='format', default=None,
+                    help='Archive format: zip, tar or directory. Guessed from the filename by default'),
+        make_option('--resume', action='store_true', dest='resume', default=False,
+                    help='Carry on with an interrupted restore, skipping whatever it finished'),
+        make_option('--set', action='append', dest='sets', default=None,
+                    help='Only restore this backup set, by name or path like master/media. May be given more than once'),
+        make_option('--database', action='append', dest='database_names', default=None,
+                    help='Only restore this database from settings.DATABASES. May be given more than once'),
+        make_option('--media-prefix', action='append', dest='media_prefixes', default=None,
+                    help='Only restore media whose names start with this. May be given more than once'),
+        make_option('--journal', dest='journal', default=None,
+                    help='Keep the journal for --resume here, instead of beside the archive'),
+        make_option('--report', dest='report', default=None,
+                    help='Write the JSON report here, instead of beside the archive'),
+        make_option('--prometheus', dest='prometheus', default=None,
+                    help='Keep this Prometheus textfile up to date with progress and timings'),
+    )
+
     def handle(self, *args, **options):
         if len(args) != 1:
             raise CommandError("Usage: restore <filename>")
@@ -15,9 +48,30 @@ class Command(BaseCommand):
             s = settings.DUMPRESTORE_SET
         else:
             s = default_set()
-        s.archive = archive.Archive.new(args[0], "r")
-        if not s.before_restore():
-            raise SystemExit()
-        s.restore()
-        s.after_restore()
+        s.archive = archive.Archive.new(args[0], "r", backend=options.get('format'))
+        journal = Journal.for_archive(args[0], "restore", options.get('resume'), options.get('journal'))
+        if journal is None and options.get('resume'):
+            raise CommandError("There is no journal of the restore of %s to resume from; name it with --journal" % args[0])
+        s.journal = journal
+        s.monitor = Monitor.for_archive(args[0], "restore", options.get('prometheus') or
+                                        getattr(settings, 'DUMPRESTORE_PROMETHEUS_TEXTFILE', None),
+                                        report=options.get('report'))
+        success = False
+        try:
+            s.configure(**options)
+            unknown = s.unknown(options.get('sets') or ())
+            if unknown:
+                raise CommandError("No backup set called %s" % ", ".join(unknown))
+            if not s.before_restore():
+                raise SystemExit()
+            s.restore()
+            s.after_restore()
+            success = True
+        finally:
+            s.archive.close()
+            if journal is not None:
+                journal.close()
+            s.monitor.finish(success)
+        if journal is not None:
+            journal.remove()
     
\ No newline at end of file
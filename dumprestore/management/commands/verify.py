@@ -0,0 +1,65 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from dumprestore.archive import Archive
+from dumprestore.default import default_set
+from dumprestore.progress import Monitor
+
+from logging import getLogger
+from optparse import make_option
+
+logger = getLogger("dumprestore")
+
+class Command(BaseCommand):
+    args = '<filename>'
+    help = "Check that the specified archive can be restored from"
+    option_list = BaseCommand.option_list + (
+        make_option('--media-workers', type='int', dest='media_workers', default=None,
+                    help='Number of media entries to check at once'),
+        make_option('--fs-workers', type='int', dest='fs_workers', default=None,
+                    help='Number of files to check at once for each filesystem backup'),
+        make_option('--db-workers', type='int', dest='db_workers', default=None,
+                    help='Number of database dumps to check at once'),
+        make_option('--hashes', action='store_true', dest='verify_hashes', default=None,
+                    help='Also compare the SHA-256 of media recorded by a --dedup dump'),
+        make_option('--base-dir', dest='base_dir', default=None,
+                    help='Directory holding the base archives of an incremental dump'),
+        make_option('--format', dest='format', default=None,
+                    help='Archive format: zip, tar or directory. Guessed from the filename by default'),
+        make_option('--set', action='append', dest='sets', default=None,
+                    help='Only check this backup set, by name or path like master/media. May be given more than once'),
+        make_option('--database', action='append', dest='database_names', default=None,
+                    help='Only check this database from settings.DATABASES. May be given more than once'),
+        make_option('--media-prefix', action='append', dest='media_prefixes', default=None,
+                    help='Only check media whose names start with this. May be given more than once'),
+        make_option('--report', dest='report', default=None,
+                    help='Write the JSON report here, instead of beside the archive'),
+        make_option('--prometheus', dest='prometheus', default=None,
+                    help='Keep this Prometheus textfile up to date with progress and timings'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Usage: verify <filename>")
+        if hasattr(settings, "DUMPRESTORE_SET"):
+            s = settings.DUMPRESTORE_SET
+        else:
+            s = default_set()
+        s.archive = Archive.new(args[0], "r", backend=options.get('format'))
+        s.monitor = Monitor.for_archive(args[0], "verify", options.get('prometheus') or
+                                        getattr(settings, 'DUMPRESTORE_PROMETHEUS_TEXTFILE', None),
+                                        report=options.get('report'))
+        problems = None
+        try:
+            s.configure(**options)
+            unknown = s.unknown(options.get('sets') or ())
+            if unknown:
+                raise CommandError("No backup set called %s" % ", ".join(unknown))
+            problems = s.verify()
+        finally:
+            s.archive.close()
+            s.monitor.finish(problems == [])
+        for p in problems:
+            logger.error(p)
+        if problems:
+            raise CommandError("%d problems found in %s" % (len(problems), args[0]))
+        logger.info("%s verified" % args[0])
@@ -1,15 +1,23 @@
 
 import os
+import time
+import errno
+import contextlib
 import zipfile
 import tempfile
 import logging
 import json
+import hashlib
 
 from django.core.files import storage as files_storage
+from django.core.files.base import File
 from django.conf import settings
 
 from . import registry
+from .archive import Archive, CHUNK_SIZE
 from .backupset import BackupDriver
+from .parallel import imap_bounded, iwalk
+from .listing import get_lister
 
 logger = logging.getLogger("dumprestore")
 
@@ -19,32 +27,74 @@ class MediaBackupException(Exception):
 class MediaRestoreException(Exception):
     pass
 
+WRITTEN = "written"
+SKIPPED = "skipped"
+FAILED = "failed"
+
+class StreamFile(File):
+
+    """ A File over a stream that can only be read forwards, such as a member
+    of an archive. Storage.save reads it chunk by chunk. """
+
+    def __init__(self, stream, name, size):
+        super(StreamFile, self).__init__(stream, name)
+        self.size = size
+
+    def chunks(self, chunk_size=None):
+        chunk_size = chunk_size or CHUNK_SIZE
+        while True:
+            data = self.read(chunk_size)
+            if not data:
+                break
+            yield data
+
+@contextlib.contextmanager
+def _request():
+    yield
+
 class FileMetadata:
 
-    """ We store all the metadata we've got, just in case. """
+    """ We store all the metadata we've got, just in case. Each call to the
+    storage is made inside request, a driver's BackupDriver.request. """
 
     datums = ['accessed_time', 'created_time', 'modified_time', 'size']
 
-    def __init__(self, storage):
+    def __init__(self, storage, request=_request):
         self.storage = storage
+        self.request = request
 
-    def _json(self, obj):
-        if hasattr(obj, 'isoformat'):
-            return obj.isoformat()
-        raise TypeError
-
-    def to_json(self, arcname):
+    def to_dict(self, arcname, stats=None):
+        """ The metadata for arcname, with times as ISO 8601 strings. Anything
+        already in stats, as given by a lister, is not asked of the storage. """
         d = {}
         for m in self.datums:
-            d[m] = getattr(self.storage, m)(arcname)
-        return json.dumps(d, default=self._json)
-
-    def has_changed(self, arcname, metadata):
-        """ Returns True if the file has changed since it was stored. """
-        modified = self.storage.modified_time(arcname).isoformat()
-        size = self.storage.size(arcname)
-        d = json.loads(metadata)
-        if modified < d['modified_time'] or size != d['size']:
+            if stats and m in stats:
+                d[m] = stats[m]
+                continue
+            with self.request():
+                value = getattr(self.storage, m)(arcname)
+            if hasattr(value, 'isoformat'):
+                value = value.isoformat()
+            d[m] = value
+        return d
+
+    @staticmethod
+    def unchanged(old, new):
+        """ Returns True if two parsed metadata dicts describe the same file contents. """
+        return old['modified_time'] == new['modified_time'] and old['size'] == new['size']
+
+    def has_changed(self, arcname, metadata, stats=None):
+        """ Returns True if the file has changed since it was stored with the
+        metadata dict given. The file's current modified_time and size are
+        taken from stats if they are there, or asked of the storage. """
+        if stats and 'modified_time' in stats and 'size' in stats:
+            modified, size = stats['modified_time'], stats['size']
+        else:
+            with self.request():
+                modified = self.storage.modified_time(arcname).isoformat()
+            with self.request():
+                size = self.storage.size(arcname)
+        if modified < metadata['modified_time'] or size != metadata['size']:
             return True
         return False
 
@@ -52,32 +102,120 @@ class MediaDriver(BackupDriver):
 
     """ Knows how to back up from the storage interface. """
 
-    def __init__(self, tempdir="/var/tmp", storage=None):
+    selecting = ('media_prefixes',)
+
+    def __init__(self, tempdir="/var/tmp", storage=None, workers=1, spool_size=CHUNK_SIZE, retries=3, retry_delay=1,
+                 base=None, base_dir=None, dedup=False, lister=None, list_workers=1, log_interval=30,
+                 verify_hashes=False, prefixes=()):
         self.tempdir = tempdir
         self.storage = storage
+        self.workers = workers
+        self.spool_size = spool_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.base = base
+        self.base_dir = base_dir
+        self.dedup = dedup
+        self.previous = {}
         if self.storage is None:
             self.storage = files_storage.get_storage_class()()
+        self.list_workers = list_workers
+        self.log_interval = log_interval
+        self.verify_hashes = verify_hashes
+        self.prefixes = list(prefixes)
+        self.lister = lister
+        if self.lister is None:
+            self.lister = get_lister(self.storage)
+
+    def configure(self, media_workers=None, list_workers=None, base=None, base_dir=None, dedup=None,
+                  verify_hashes=None, media_prefixes=None, **options):
+        if media_workers is not None:
+            self.workers = media_workers
+        if list_workers is not None:
+            self.list_workers = list_workers
+        if base is not None:
+            self.base = base
+        if base_dir is not None:
+            self.base_dir = base_dir
+        if dedup is not None:
+            self.dedup = dedup
+        if verify_hashes is not None:
+            self.verify_hashes = verify_hashes
+        if media_prefixes is not None:
+            self.prefixes = list(media_prefixes)
+
+    def listdir(self, d):
+        with self.request():
+            new_dirs, files = self.lister.listdir(d)
+        return [os.path.join(d, nd) for nd in new_dirs], files
+
+    def storage_entries(self, root="."):
+        """ Return a generator of the name and listed stats of every file in
+        the storage under root, by walking the lister (see
+        dumprestore.listing), list_workers directories at once. Files come
+        out in the order their directories were listed. A root that isn't in
+        the storage has no files. """
+        def listdir(d):
+            try:
+                return self.listdir(d)
+            except EnvironmentError as e:
+                if d != root or e.errno != errno.ENOENT:
+                    raise
+                return [], []
+        started = last = time.time()
+        directories = count = 0
+        for d, files in iwalk(listdir, root, self.list_workers):
+            directories = directories + 1
+            for f, stats in files:
+                arcname = os.path.normpath(os.path.join(d, f))
+                count = count + 1
+                yield arcname, stats
+            now = time.time()
+            if now - last >= self.log_interval:
+                last = now
+                logger.info("Listed %d directories and %d files (%.1f files/s)" % (
+                    directories, count, count / (now - started)))
+        elapsed = time.time() - started
+        logger.info("Listed %d directories and %d files in %.1fs" % (directories, count, elapsed))
 
     def storage_files(self):
-        """ Return a generator of all files in the storage, by walking storage.listdir """
-        directories = ["."]
-        while directories:
-            d = directories.pop(0)
-            new_dirs, files = self.storage.listdir(d)
-            for nd in new_dirs:
-                directories.append(os.path.join(d, nd))
-            for f in files:
-                arcname = os.path.join(d, f).lstrip("./")
-                yield arcname
-
-    def replace_file(self, name, archive):
+        """ Return a generator of all files in the storage """
+        for arcname, stats in self.storage_entries():
+            yield arcname
+
+    def storage_snapshot(self):
+        """ List the storage once. Returns a dict mapping the name of every
+        file to whatever stats the listing gave for it. With prefixes, only
+        the directories that could hold files starting with one are listed,
+        and only those files are included. """
+        if not self.prefixes:
+            return dict(self.storage_entries())
+        # named as a walk from the top would name them
+        roots = []
+        for root in sorted(set(os.path.join(".", os.path.dirname(p)).rstrip("/") for p in self.prefixes)):
+            if "." in roots or any(root.startswith(r + "/") for r in roots):
+                continue
+            roots.append(root)
+        snapshot = {}
+        for root in roots:
+            for name, stats in self.storage_entries(root):
+                if self.selected(name):
+                    snapshot[name] = stats
+        return snapshot
+
+    def selected(self, name):
+        """ Whether name starts with one of the prefixes, if there are any. """
+        return not self.prefixes or any(name.startswith(p) for p in self.prefixes)
+
+    def replace_file(self, name, metadata, stats):
         """ returns True if a file in the storage is different from the one
-        in the archive, by testing the dates and size. """
+        in the archive, by testing the dates and size against its metadata.
+        stats is the file's entry in the storage snapshot, or None if it
+        isn't in the storage. """
         replace = False
-        meta = FileMetadata(self.storage)
-        if self.storage.exists(name):
-            metadata = archive.open("meta/%s" % (name,)).read()
-            if meta.has_changed(name, metadata):
+        meta = FileMetadata(self.storage, self.request)
+        if stats is not None:
+            if metadata is None or meta.has_changed(name, metadata, stats):
                 logging.debug("Metadata changed for %r" % name)
                 replace = True
             else:
@@ -87,18 +225,24 @@ class MediaDriver(BackupDriver):
             replace = True
         return replace
 
-    def storage_only(self, names):
-        """ find files that are only present in the storage """
-        for f in self.storage_files():
-            if f not in names:
-                yield f
-
-    def filenames(self, archive):
-        """ Return the list of filenames in our zip. This knows that the files are in a media directory. """
-        for n in archive.namelist():
+    def filenames(self, archive, prefix=""):
+        """ Return the list of filenames in our zip starting with prefix. This knows that the files are in a media directory. """
+        for n in archive.namelist("data/" + prefix):
             if n.startswith("data/"):
                 yield n[len("data/"):]
 
+    def blobnames(self, archive):
+        """ Return the hashes of the deduplicated blobs in our zip. """
+        for n in archive.namelist("blobs/"):
+            if n.startswith("blobs/"):
+                yield n[len("blobs/"):]
+
+    def entry(self, name, metadata):
+        """ The name of the entry holding the contents of name. """
+        if metadata is not None and metadata.get('sha256'):
+            return "blobs/%s" % (metadata['sha256'],)
+        return "data/%s" % (name,)
+
     def before_dump(self, archive):
         """ Called on all drivers before dumping. """
         f = tempfile.NamedTemporaryFile(dir=self.tempdir, delete=False)
@@ -106,25 +250,293 @@ class MediaDriver(BackupDriver):
         self.filename = f.name
         logger.debug("Will create temporary file %r" % self.filename)
 
+    def read_metadata(self, archive):
+        """ Return a dict of the metadata for each file in archive. This is
+        read from manifest.jsonl, which has one JSON object per line, or from
+        the meta/ entry per file that older archives have. """
+        metadata = {}
+        if archive.exists("manifest.jsonl"):
+            with archive.open("manifest.jsonl") as f:
+                for line in f:
+                    d = json.loads(line)
+                    metadata[d.pop('name')] = d
+            return metadata
+        for n in archive.namelist("meta/"):
+            if n.startswith("meta/"):
+                with archive.open(n) as f:
+                    metadata[n[len("meta/"):]] = json.load(f)
+        return metadata
+
+    def fetch(self, arcname, stats=None, spool=False):
+        """ Returns arcname, an open file of its contents, or None if it is
+        unchanged since the base archive, and its metadata, starting from the
+        listed stats. With spool, or dedup, the contents are copied into a
+        spooled temporary file. """
+        metadata = FileMetadata(self.storage, self.request).to_dict(arcname, stats)
+        previous = self.previous.get(arcname)
+        if previous is not None and FileMetadata.unchanged(previous, metadata):
+            if previous.get('sha256'):
+                metadata['sha256'] = previous['sha256']
+            return arcname, None, metadata
+        source = self.opened(self.storage.open(arcname))
+        if not (spool or self.dedup):
+            return arcname, source, metadata
+        f = tempfile.SpooledTemporaryFile(max_size=self.spool_size, dir=self.tempdir)
+        digest = hashlib.sha256()
+        with source:
+            while True:
+                buf = source.read(CHUNK_SIZE)
+                if not buf:
+                    break
+                digest.update(buf)
+                f.write(buf)
+        f.seek(0)
+        if self.dedup:
+            metadata['sha256'] = digest.hexdigest()
+        return arcname, f, metadata
+
+    def unfinished(self, entries, written, resumed, blobs):
+        """ Filter out of entries the files an interrupted dump finished,
+        adding their names and metadata to resumed instead. written is the
+        set of names in the archive. """
+        for arcname, stats in entries:
+            done = self.checkpoint.info(arcname)
+            if done is not None and (done['entry'] is None or done['entry'] in written):
+                resumed.append((arcname, done['metadata']))
+                blobs.add(done['metadata'].get('sha256'))
+            else:
+                yield arcname, stats
+
     def dump(self, archive):
+        """ Write every file in the storage to archive, read by workers
+        threads, each spooled into memory, or tempdir past spool_size.
+
+        With a base archive, only files new or changed since it are written,
+        with metadata for all, and increment.json names the base and the
+        files deleted since. With dedup, contents are stored once per
+        distinct SHA-256 as blobs/<hash>, unless a base already has them.
+        When resuming, files the checkpoint records are not fetched again. """
         logger.info("Dumping media")
-        count = 0
-        meta = FileMetadata(self.storage)
-        for arcname in self.storage_files():
-            with self.storage.open(arcname) as f:
-                archive.writestr("data/%s" % (arcname,), f.read())
-            archive.writestr("meta/%s" % (arcname,), meta.to_json(arcname))
-            count = count + 1
+        count = unchanged = duplicates = 0
+        blobs = set()
+        if self.base is not None:
+            logger.info("Dumping changes since %s" % self.base)
+            base = Archive.new(self.base, "r").subarchive(archive.prefix)
+            self.previous = self.read_metadata(base)
+            if self.dedup:
+                for a in self.archive_chain(base):
+                    blobs.update(self.blobnames(a))
+        entries = self.storage_entries()
+        resumed = []
+        if self.checkpoint is not None:
+            entries = self.unfinished(entries, set(archive.namelist()), resumed, blobs)
+        if self.workers > 1:
+            logger.info("Fetching media with %d workers" % self.workers)
+            files = imap_bounded(lambda e: self.fetch(e[0], e[1], spool=True), entries, self.workers)
+        else:
+            files = (self.fetch(arcname, stats) for arcname, stats in entries)
+        seen = set()
+        # The zip takes one entry at a time, so the manifest is spooled until
+        # all the data has been written.
+        manifest = tempfile.SpooledTemporaryFile(max_size=self.spool_size, dir=self.tempdir)
+        for arcname, f, metadata in files:
+            entry = None
+            if f is None:
+                unchanged = unchanged + 1
+            elif self.dedup and metadata['sha256'] in blobs:
+                f.close()
+                duplicates = duplicates + 1
+            else:
+                entry = self.entry(arcname, metadata)
+                with f as data:
+                    archive.writefile(entry, data)
+                blobs.add(metadata.get('sha256'))
+                count = count + 1
+            self.count(1, metadata['size'] if entry is not None else 0)
+            if self.checkpoint is not None:
+                self.checkpoint.record(arcname, {'entry': entry, 'metadata': metadata})
+            metadata['name'] = arcname
+            manifest.write(json.dumps(metadata) + "\n")
+            seen.add(arcname)
+        if resumed:
+            logger.info("%d files already dumped" % len(resumed))
+        for arcname, metadata in resumed:
+            metadata['name'] = arcname
+            manifest.write(json.dumps(metadata) + "\n")
+            seen.add(arcname)
+        manifest.seek(0)
+        with manifest:
+            archive.writefile("manifest.jsonl", manifest)
+        if self.base is not None:
+            deleted = sorted(set(self.previous) - seen)
+            archive.writestr("increment.json", json.dumps({
+                'base': os.path.abspath(self.base),
+                'deleted': deleted,
+            }))
+            logger.info("%d files unchanged, %d deleted since the base" % (unchanged, len(deleted)))
+        if self.dedup:
+            logger.info("%d duplicate files not stored again" % duplicates)
         logger.info("%d files written" % count)
 
+    def locate(self, chain, entries):
+        """ Map each of entries to the newest archive in chain that holds it.
+        Entries that none of them hold are left out. """
+        sources = {}
+        for e in entries:
+            for a in chain:
+                if a.exists(e):
+                    sources[e] = a
+                    break
+        return sources
+
+    def selected_metadata(self, archive):
+        """ The metadata of the files in archive that start with one of the
+        prefixes, or of every file if there are none. Archives without
+        metadata give None for each of their files. """
+        metadata = self.read_metadata(archive)
+        if metadata:
+            return dict((n, m) for n, m in metadata.items() if self.selected(n))
+        return dict((n, None) for p in (self.prefixes or [""]) for n in self.filenames(archive, p))
+
+    def archive_chain(self, archive):
+        """ Return archive followed by the bases it was incrementally dumped
+        against, newest first, looked for in base_dir if that is set, for
+        bases that have moved since. """
+        chain = [archive]
+        while chain[-1].exists("increment.json"):
+            with chain[-1].open("increment.json") as f:
+                base = json.load(f)['base']
+            if self.base_dir is not None:
+                base = os.path.join(self.base_dir, os.path.basename(base))
+            logger.info("Reading unchanged files from %s" % base)
+            chain.append(Archive.new(base, "r").subarchive(archive.prefix))
+        return chain
+
+    def restore_file(self, name, archive, metadata, stats=None):
+        """ Bring name in the storage up to date with its contents in archive
+        and the metadata stored for it. stats is as for replace_file. Returns
+        the name and one of WRITTEN, SKIPPED or FAILED. """
+        exists = stats is not None
+        for attempt in range(1, self.retries + 1):
+            try:
+                if not self.replace_file(name, metadata, stats):
+                    return name, SKIPPED
+                logger.info("Writing %r" % name)
+                self.save_file(name, archive, self.entry(name, metadata), exists)
+                return name, WRITTEN
+            except Exception:
+                logger.warning("Attempt %d of %d to restore %r failed" % (attempt, self.retries, name), exc_info=True)
+                # a failed save may have left part of the file behind
+                exists = None
+                if attempt < self.retries:
+                    time.sleep(self.retry_delay * attempt)
+        return name, FAILED
+
     def restore(self, archive, force=False):
-        names = set(self.filenames(archive))
-        storage_only = list(self.storage_only(names))
+        """ Bring the storage up to date with archive, following its chain
+        of bases, with workers threads trying each file up to retries times.
+        With prefixes, only the files starting with one are looked up and
+        restored. When resuming, files the checkpoint records are skipped. """
+        chain = self.archive_chain(archive)
+        metadata = self.selected_metadata(archive)
+        names = set(metadata)
+        if self.prefixes:
+            logger.info("Restoring the %d files starting with %s" % (len(names), ", ".join(self.prefixes)))
+        entries = dict((n, self.entry(n, metadata[n])) for n in names)
+        sources = self.locate(chain, set(entries.values()))
+        missing = sorted(n for n in names if entries[n] not in sources)
+        if missing:
+            raise MediaRestoreException("Files missing from the archives", missing)
+        snapshot = self.storage_snapshot()
+        storage_only = sorted(set(snapshot) - names)
         if storage_only and not force:
             raise MediaRestoreException("Files present in storage that are not in the backup", storage_only)
-        meta = FileMetadata(self.storage)
-        for n in names:
-            if self.replace_file(n, archive):
-                logging.info("Writing %r" % n)
-                data = archive.open("data/%s" % (n,)).read()
-                self.storage.open(n, "w").write(data)
+        logger.info("%d files to add, %d to check against the storage" % (
+            len(names - set(snapshot)), len(names & set(snapshot))))
+        if self.workers > 1:
+            logger.info("Restoring media with %d workers" % self.workers)
+        # Each open of a zip member reads through its own file handle, so the
+        # workers can share the archive.
+        results = {WRITTEN: [], SKIPPED: [], FAILED: []}
+        if self.checkpoint is not None:
+            done = set(n for n in names if self.checkpoint.done(n))
+            if done:
+                logger.info("%d files already restored" % len(done))
+            results[SKIPPED].extend(done)
+            names = names - done
+        self.expect(len(names), sum(metadata[n]['size'] for n in names if metadata[n]))
+        for name, result in imap_bounded(lambda n: self.restore_file(n, sources[entries[n]], metadata[n], snapshot.get(n)), names, self.workers):
+            results[result].append(name)
+            self.count(1, metadata[name]['size'] if metadata[name] and result == WRITTEN else 0)
+            if result != FAILED and self.checkpoint is not None:
+                self.checkpoint.record(name)
+        logger.info("%d files written, %d skipped, %d failed" % (
+            len(results[WRITTEN]), len(results[SKIPPED]), len(results[FAILED])))
+        if results[FAILED]:
+            raise MediaRestoreException("Files could not be restored", sorted(results[FAILED]))
+        return results
+
+    def verify_entry(self, entry, archive, metadata):
+        """ Read entry through and check it against the metadata of a file
+        stored in it. Returns a list of the problems found. """
+        size = 0
+        digest = None
+        if self.verify_hashes and metadata.get('sha256'):
+            digest = hashlib.sha256()
+        try:
+            with archive.open(entry) as f:
+                while True:
+                    buf = f.read(CHUNK_SIZE)
+                    if not buf:
+                        break
+                    size += len(buf)
+                    if digest is not None:
+                        digest.update(buf)
+        except Exception as e:
+            return ["%s: %s" % (entry, e)]
+        self.count(1, size)
+        if size != metadata['size']:
+            return ["%s: %d bytes where %d were expected" % (entry, size, metadata['size'])]
+        if digest is not None and digest.hexdigest() != metadata['sha256']:
+            return ["%s: SHA-256 %s where %s was expected" % (entry, digest.hexdigest(), metadata['sha256'])]
+        return []
+
+    def verify(self, archive):
+        """ Read every entry through, with workers threads, checking its size
+        against the metadata, and with verify_hashes its SHA-256 where the
+        dump recorded one. Returns a list of the problems found. """
+        chain = self.archive_chain(archive)
+        metadata = self.selected_metadata(archive)
+        problems = []
+        if None in metadata.values():
+            problems.append("No media metadata")
+        # files with identical contents share an entry, which only needs reading once
+        entries = {}
+        for name, m in metadata.items():
+            if m is not None:
+                entries[self.entry(name, m)] = m
+        sources = self.locate(chain, entries)
+        for entry in sorted(entries):
+            if entry not in sources:
+                problems.append("%s: missing from the archives" % (entry,))
+                del entries[entry]
+        logger.info("Verifying %d media entries" % len(entries))
+        self.expect(len(entries), sum(m['size'] for m in entries.values()))
+        for found in imap_bounded(lambda e: self.verify_entry(e, sources[e], entries[e]), sorted(entries), self.workers):
+            problems.extend(found)
+        return problems
+
+    def save_file(self, name, archive, arcname=None, exists=None):
+        """ Replace name in the storage with its contents in the archive,
+        streamed through Storage.save from arcname, by default data/<name>.
+        exists says whether name is in the storage already, if known. """
+        if arcname is None:
+            arcname = "data/%s" % (name,)
+        if exists is None:
+            exists = self.storage.exists(name)
+        if exists:
+            self.storage.delete(name)
+        with archive.open(arcname) as f:
+            saved = self.storage.save(name, StreamFile(f, name, archive.size(arcname)))
+        if saved != name:
+            raise MediaRestoreException("Storage saved %r as %r" % (name, saved))
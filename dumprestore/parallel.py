@@ -0,0 +1,111 @@
+
+""" Helpers for spreading driver work over a pool of threads """
+
+import collections
+import threading
+from multiprocessing.pool import ThreadPool
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+def imap_bounded(func, iterable, workers, backlog=None):
+    """ Like itertools.imap, but calls func on up to workers threads at once.
+
+    Results are yielded in the order of iterable. No more than backlog calls
+    are outstanding at any time, so a slow consumer holds back the workers
+    rather than letting results pile up in memory. """
+    if workers <= 1:
+        for item in iterable:
+            yield func(item)
+        return
+    if backlog is None:
+        backlog = workers * 2
+    pool = ThreadPool(workers)
+    pending = collections.deque()
+    try:
+        for item in iterable:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= backlog:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def iwalk(func, root, workers):
+    """ Walk a tree breadth first, calling func on up to workers nodes at once.
+
+    func(node) returns a list of child nodes and a result. Yields each node
+    and its result as soon as it is ready, so the caller can get on with the
+    results while the rest of the tree is still being walked. """
+    if workers <= 1:
+        nodes = collections.deque([root])
+        while nodes:
+            node = nodes.popleft()
+            children, result = func(node)
+            nodes.extend(children)
+            yield node, result
+        return
+    done = queue.Queue()
+    def run(node):
+        try:
+            done.put((node, func(node), None))
+        except Exception as e:
+            done.put((node, None, e))
+    pool = ThreadPool(workers)
+    try:
+        pool.apply_async(run, (root,))
+        outstanding = 1
+        while outstanding:
+            node, value, error = done.get()
+            outstanding -= 1
+            if error is not None:
+                raise error
+            children, result = value
+            for child in children:
+                pool.apply_async(run, (child,))
+                outstanding += 1
+            yield node, result
+    finally:
+        pool.terminate()
+        pool.join()
+
+def run_graph(tasks):
+    """ Run tasks, a list of (name, func, dependencies) in which every task
+    depends only on tasks listed before it. Each func is started on its own
+    thread as soon as all of its dependencies have finished. If a task
+    fails no more are started, and its exception is raised once the running
+    tasks have finished. """
+    done = queue.Queue()
+    def run(name, func):
+        try:
+            func()
+            done.put((name, None))
+        except Exception as e:
+            done.put((name, e))
+    started = set()
+    finished = set()
+    running = 0
+    error = None
+    while True:
+        if error is None:
+            for name, func, dependencies in tasks:
+                if name not in started and set(dependencies) <= finished:
+                    started.add(name)
+                    t = threading.Thread(target=run, args=(name, func))
+                    t.daemon = True
+                    t.start()
+                    running += 1
+        if not running:
+            break
+        name, e = done.get()
+        running -= 1
+        if e is None:
+            finished.add(name)
+        elif error is None:
+            error = e
+    if error is not None:
+        raise error
@@ -0,0 +1,259 @@
+
+""" Timings, counters and progress reports for dumps and restores """
+
+import os
+import json
+import errno
+import time
+import logging
+import tempfile
+import threading
+import contextlib
+
+logger = logging.getLogger("dumprestore")
+
+def _replace(filename, text):
+    """ Write text to filename in one go, so a reader never sees half of it. """
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), prefix=".report")
+    with os.fdopen(fd, "w") as f:
+        f.write(text)
+    os.chmod(temp, 0o644)
+    os.rename(temp, filename)
+
+class Progress:
+
+    """ Counts the files and bytes one backup set's driver has dealt with.
+    If the driver says how many to expect, the rate gives an ETA. """
+
+    def __init__(self, monitor, path):
+        self.monitor = monitor
+        self.path = path
+        self.lock = threading.Lock()
+        self.files = 0
+        self.bytes = 0
+        self.total_files = None
+        self.total_bytes = None
+        self.started = time.time()
+
+    def expect(self, files=None, bytes=None):
+        with self.lock:
+            if files is not None:
+                self.total_files = files
+            if bytes is not None:
+                self.total_bytes = bytes
+
+    def add(self, files=0, bytes=0):
+        with self.lock:
+            self.files += files
+            self.bytes += bytes
+        self.monitor.tick()
+
+    def rates(self):
+        """ Files and bytes per second so far. """
+        elapsed = max(float(time.time() - self.started), 1e-9)
+        return self.files / elapsed, self.bytes / elapsed
+
+    def eta(self):
+        """ Seconds until the expected work is done, going by bytes if they
+        are expected and by files otherwise, or None if nothing is expected. """
+        files_rate, bytes_rate = self.rates()
+        if self.total_bytes and bytes_rate:
+            return max(self.total_bytes - self.bytes, 0) / bytes_rate
+        if self.total_files and files_rate:
+            return max(self.total_files - self.files, 0) / files_rate
+        return None
+
+    def as_dict(self):
+        files_rate, bytes_rate = self.rates()
+        return {
+            'files': self.files,
+            'bytes': self.bytes,
+            'total_files': self.total_files,
+            'total_bytes': self.total_bytes,
+            'files_per_s': files_rate,
+            'bytes_per_s': bytes_rate,
+            'eta': self.eta(),
+        }
+
+class Monitor:
+
+    """ Collects how long each phase of each backup set takes, and the
+    Progress of each driver, during one dump or restore, and passes them to
+    the reporters: as each phase finishes, every interval seconds while
+    work is counted, and once at the end. """
+
+    def __init__(self, operation, reporters=(), interval=30):
+        self.operation = operation
+        self.reporters = list(reporters)
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.last = self.started
+        self.finished = None
+        self.success = None
+        self.phases = []
+        self.progresses = {}
+
+    @classmethod
+    def for_archive(klass, archive_filename, operation, textfile=None, interval=30, report=None):
+        """ A monitor that logs, writes a JSON report to report, or beside
+        archive_filename unless it is stdout, and a Prometheus textfile if
+        one is named. A report beside the archive is left out, with a
+        warning, if it can't be written there. """
+        reporters = [LogReporter()]
+        if report is not None:
+            reporters.append(JSONReporter(report))
+        elif archive_filename != "-":
+            reporters.append(JSONReporter("%s.%s.report.json" % (archive_filename.rstrip("/"), operation), optional=True))
+        if textfile is not None:
+            reporters.append(PrometheusReporter(textfile))
+        return klass(operation, reporters, interval)
+
+    def progress(self, path):
+        """ The Progress of the driver of the backup set at path. """
+        with self.lock:
+            if path not in self.progresses:
+                self.progresses[path] = Progress(self, path)
+            return self.progresses[path]
+
+    @contextlib.contextmanager
+    def phase(self, path, phase):
+        """ Time phase ("before_dump", "dump" and so on) of the backup set at path. """
+        started = time.time()
+        try:
+            yield
+        finally:
+            seconds = time.time() - started
+            with self.lock:
+                self.phases.append((path, phase, seconds))
+            for r in self.reporters:
+                r.phase(self, path, phase, seconds)
+
+    def tick(self):
+        """ Report progress if it hasn't been for interval seconds. """
+        now = time.time()
+        with self.lock:
+            if now - self.last < self.interval:
+                return
+            self.last = now
+        for r in self.reporters:
+            r.progress(self)
+
+    def finish(self, success):
+        self.finished = time.time()
+        self.success = success
+        for r in self.reporters:
+            r.finish(self)
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'operation': self.operation,
+                'started': self.started,
+                'finished': self.finished,
+                'success': self.success,
+                'seconds': (self.finished or time.time()) - self.started,
+                'phases': [{'set': path, 'phase': phase, 'seconds': seconds} for path, phase, seconds in self.phases],
+                'progress': dict((path, p.as_dict()) for path, p in self.progresses.items()),
+            }
+
+class Reporter:
+
+    """ Receives what a Monitor collects. """
+
+    def phase(self, monitor, path, phase, seconds):
+        """ phase of the backup set at path has finished. """
+
+    def progress(self, monitor):
+        """ Some time has passed since the last report. """
+
+    def finish(self, monitor):
+        """ The dump or restore is over, successfully or not. """
+
+class LogReporter(Reporter):
+
+    """ Logs a line for each phase, and the rate and ETA of each driver. """
+
+    def phase(self, monitor, path, phase, seconds):
+        logger.info("%s finished %s in %.1fs" % (path, phase, seconds))
+
+    def progress(self, monitor):
+        for path, p in sorted(monitor.progresses.items()):
+            files_rate, bytes_rate = p.rates()
+            eta = p.eta()
+            logger.info("%s: %d files, %.1f MB (%.1f files/s, %.1f MB/s)%s" % (
+                path, p.files, p.bytes / 1048576.0, files_rate, bytes_rate / 1048576.0,
+                "" if eta is None else ", about %ds to go" % eta))
+
+    def finish(self, monitor):
+        logger.info("%s %s after %.1fs" % (
+            monitor.operation, "finished" if monitor.success else "failed", monitor.finished - monitor.started))
+
+class JSONReporter(Reporter):
+
+    """ Keeps filename up to date with everything the monitor knows, as JSON.
+    If optional, a filename that can't be written is given up on with a
+    warning rather than failing the dump or restore. """
+
+    def __init__(self, filename, optional=False):
+        self.filename = filename
+        self.optional = optional
+        self.failed = False
+
+    def write(self, monitor):
+        if self.failed:
+            return
+        try:
+            _replace(self.filename, json.dumps(monitor.as_dict(), indent=2, sort_keys=True))
+        except (IOError, OSError) as e:
+            if not self.optional or e.errno not in (errno.EACCES, errno.EPERM, errno.EROFS):
+                raise
+            logger.warning("Not writing a report to %s: %s" % (self.filename, e))
+            self.failed = True
+
+    progress = write
+    finish = write
+
+class PrometheusReporter(Reporter):
+
+    """ Keeps filename up to date in the Prometheus text format, for the
+    node exporter's textfile collector. """
+
+    def __init__(self, filename, prefix="dumprestore"):
+        self.filename = filename
+        self.prefix = prefix
+
+    def metrics(self, monitor):
+        d = monitor.as_dict()
+        operation = d['operation']
+        lines = []
+        def metric(name, value, kind, **labels):
+            if value is None:
+                return
+            name = "%s_%s" % (self.prefix, name)
+            if kind is not None:
+                lines.append("# TYPE %s %s" % (name, kind))
+            labels['operation'] = operation
+            label = ",".join('%s="%s"' % (k, labels[k]) for k in sorted(labels))
+            lines.append("%s{%s} %s" % (name, label, value))
+        metric("seconds", d['seconds'], "gauge")
+        metric("started_timestamp_seconds", d['started'], "gauge")
+        if d['finished'] is not None:
+            metric("success", int(bool(d['success'])), "gauge")
+            metric("finished_timestamp_seconds", d['finished'], "gauge")
+        kind = "gauge"
+        for p in d['phases']:
+            metric("phase_seconds", p['seconds'], kind, set=p['set'], phase=p['phase'])
+            kind = None
+        for key in ('files', 'bytes', 'files_per_s', 'bytes_per_s', 'total_files', 'total_bytes', 'eta'):
+            kind = "gauge"
+            for path, p in sorted(d['progress'].items()):
+                metric(key, p[key], kind, set=path)
+                kind = None
+        return "\n".join(lines) + "\n"
+
+    def write(self, monitor):
+        _replace(self.filename, self.metrics(monitor))
+
+    progress = write
+    finish = write
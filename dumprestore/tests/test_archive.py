@@ -0,0 +1,284 @@
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import zipfile
+from StringIO import StringIO
+from unittest import TestCase
+from mock import MagicMock, patch
+
+from dumprestore import archive
+
+
+class TestArchive(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, "test.zip")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_writefile(self):
+        data = "".join(chr(i % 256) for i in range(10000))
+        a = archive.Archive.new(self.filename, "w")
+        a.subarchive("media").writefile("data/foo", StringIO(data), chunk_size=1000)
+        a.writestr("bar", "bar")
+        a.close()
+        z = zipfile.ZipFile(self.filename)
+        self.assertEqual(z.testzip(), None)
+        self.assertEqual(z.read("media/data/foo"), data)
+        self.assertEqual(z.read("bar"), "bar")
+
+    def test_writefile_deflated(self):
+        data = "x" * 100000
+        a = archive.Archive(zipfile.ZipFile(self.filename, "w", zipfile.ZIP_DEFLATED, True))
+        a.writefile("foo", StringIO(data), chunk_size=1000)
+        a.close()
+        z = zipfile.ZipFile(self.filename)
+        self.assertEqual(z.read("foo"), data)
+        self.assert_(z.getinfo("foo").compress_size < len(data))
+
+    def test_resume_unclosed(self):
+        class Interrupted(object):
+            def __init__(self):
+                self.reads = 0
+            def read(self, size):
+                self.reads += 1
+                if self.reads > 2:
+                    raise IOError()
+                return "c" * size
+        data = "".join(chr(i % 256) for i in range(10000))
+        a = archive.Archive.new(self.filename, "w")
+        a.writefile("a", StringIO(data), chunk_size=1000)
+        a.writestr("b", "b data")
+        self.assertRaises(IOError, a.writefile, "c", Interrupted(), chunk_size=1000)
+        # as the process left it when killed, before the central directory
+        a.backend.zipfile.fp.flush()
+        killed = os.path.join(self.tempdir, "killed.zip")
+        shutil.copyfile(self.filename, killed)
+        a.close()
+        self.assertFalse(zipfile.is_zipfile(killed))
+
+        a = archive.Archive.new(killed, "a")
+        self.assertEqual(sorted(a.backend.names()), ["a", "b"])
+        a.writestr("d", "d data")
+        a.close()
+        z = zipfile.ZipFile(killed)
+        self.assertEqual(z.testzip(), None)
+        self.assertEqual(z.namelist(), ["a", "b", "d"])
+        self.assertEqual(z.read("a"), data)
+        self.assertEqual(z.read("d"), "d data")
+        self.assertEqual(z.infolist()[0].header_offset, 0)
+
+        with open(killed, "wb") as f:
+            f.write("not a zip")
+        self.assertRaises(archive.ArchiveException, archive.Archive.new, killed, "a")
+
+    def test_extractfile(self):
+        z = zipfile.ZipFile(self.filename, "w")
+        z.writestr("media/foo", "foo data")
+        z.close()
+        a = archive.Archive.new(self.filename, "r").subarchive("media")
+        out = StringIO()
+        a.extractfile("foo", out, chunk_size=3)
+        self.assertEqual(out.getvalue(), "foo data")
+        self.assertEqual(a.size("foo"), 8)
+
+    def test_compression_policy(self):
+        policy = archive.CompressionPolicy("auto", 6, rules=[("database/*", "stored")])
+        a = archive.Archive.new(self.filename, "w", policy)
+        text = "some text " * 10000
+        noise = os.urandom(100000)
+        a.writestr("media/data/foo.txt", text)
+        a.writestr("media/data/foo.jpg", text)
+        a.writestr("media/data/foo.bin", noise)
+        a.subarchive("database").writestr("foo.sql", text)
+        a.writestr("mysql/default.dmp", text)
+        a.close()
+        z = zipfile.ZipFile(self.filename)
+        self.assertEqual(z.testzip(), None)
+        self.assertEqual(z.getinfo("media/data/foo.txt").compress_type, zipfile.ZIP_DEFLATED)
+        self.assertEqual(z.getinfo("media/data/foo.jpg").compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(z.getinfo("media/data/foo.bin").compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(z.getinfo("database/foo.sql").compress_type, zipfile.ZIP_STORED)
+        # a dump of SQL text is left to the probe
+        self.assertEqual(z.getinfo("mysql/default.dmp").compress_type, zipfile.ZIP_DEFLATED)
+        self.assertEqual(z.read("media/data/foo.txt"), text)
+        self.assertEqual(z.read("media/data/foo.bin"), noise)
+
+    def test_compression_policy_unsupported(self):
+        self.assertRaises(archive.ArchiveException, archive.CompressionPolicy, "zstd")
+
+    def test_compression_policy_settings(self):
+        settings = MagicMock()
+        settings.DUMPRESTORE_COMPRESSION = "deflated"
+        settings.DUMPRESTORE_COMPRESSION_LEVEL = 1
+        settings.DUMPRESTORE_COMPRESSION_RULES = [("*.log", "stored")]
+        policy = archive.CompressionPolicy.from_settings(settings, level=9)
+        self.assertEqual(policy.choose("foo.txt", ""), (zipfile.ZIP_DEFLATED, 9))
+        self.assertEqual(policy.choose("foo.log", ""), (zipfile.ZIP_STORED, 9))
+
+    def test_namelist(self):
+        z = zipfile.ZipFile(self.filename, "w")
+        for n in ["media/data/a", "media/data/b", "media/manifest.jsonl", "media2/data/c", "database/one.dmp"]:
+            z.writestr(n, n)
+        z.close()
+        a = archive.Archive.new(self.filename, "r")
+        media = a.subarchive("media")
+        self.assertEqual(list(media.namelist()), ["data/a", "data/b", "manifest.jsonl"])
+        self.assertEqual(list(media.namelist("data/")), ["data/a", "data/b"])
+        self.assertEqual(len(list(a.namelist())), 5)
+        self.assert_(media.exists("manifest.jsonl"))
+        self.assert_(not media.exists("data"))
+        self.assert_(a.subarchive("media2").exists("data/c"))
+        self.assertEqual(a.index, media.index)
+
+    def test_concurrent_writers(self):
+        a = archive.Archive.new(self.filename, "w")
+        def write(prefix):
+            sub = a.subarchive(prefix)
+            for i in range(20):
+                sub.writefile("f%d" % i, StringIO(prefix * 10000), chunk_size=100)
+        threads = [threading.Thread(target=write, args=(p,)) for p in "abcd"]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        a.close()
+        z = zipfile.ZipFile(self.filename)
+        self.assertEqual(z.testzip(), None)
+        self.assertEqual(len(z.namelist()), 80)
+        self.assertEqual(z.read("c/f7"), "c" * 10000)
+
+    def test_staged_write(self):
+        policy = archive.CompressionPolicy("deflated")
+        a = archive.Archive.new(self.filename, "w", policy, tempdir=self.tempdir)
+        a.backend.writer.spool_size = 1000
+        data = "staged " * 10000
+        def write():
+            a.writestr("staged", data)
+        # hold the zip so the writer has to stage its entry
+        with a.backend.writer.lock:
+            t = threading.Thread(target=write)
+            t.start()
+            t.join(0.5)
+            self.assert_(t.is_alive())
+            self.assertEqual(list(a.namelist()), [])
+        t.join()
+        a.writestr("direct", "direct")
+        a.close()
+        z = zipfile.ZipFile(self.filename)
+        self.assertEqual(z.testzip(), None)
+        self.assertEqual(z.read("staged"), data)
+        self.assertEqual(z.read("direct"), "direct")
+        self.assert_(z.getinfo("staged").compress_size < len(data))
+
+    def test_stream_staged(self):
+        a = archive.Archive.new(self.filename, "w")
+        r, w = os.pipe()
+        pipe = os.fdopen(r, "rb")
+        stream = threading.Thread(target=a.writefile, args=("stream", pipe, 100))
+        try:
+            # a stream of unknown length doesn't hold the zip while it is produced
+            os.write(w, "head " * 100)
+            stream.start()
+            t = threading.Thread(target=a.writestr, args=("other", "other"))
+            t.start()
+            t.join(1)
+            self.assert_(not t.is_alive())
+            self.assert_(stream.is_alive())
+            os.write(w, "tail")
+        finally:
+            os.close(w)
+            stream.join()
+            pipe.close()
+        a.close()
+        z = zipfile.ZipFile(self.filename)
+        self.assertEqual(z.namelist(), ["other", "stream"])
+        self.assertEqual(z.read("stream"), "head " * 100 + "tail")
+
+    def test_staging_bounded(self):
+        a = archive.Archive.new(self.filename, "w")
+        a.backend.writer.staging = threading.BoundedSemaphore(1)
+        a.backend.writer.staging.acquire()
+        t = threading.Thread(target=a.writestr, args=("foo", "foo"))
+        with a.backend.writer.lock:
+            t.start()
+            t.join(0.2)
+        # no staging slot was free, so nothing could be written
+        self.assert_(t.is_alive())
+        self.assertEqual(list(a.namelist()), [])
+        a.backend.writer.staging.release()
+        t.join()
+        self.assertEqual(list(a.namelist()), ["foo"])
+
+    def roundtrip(self, filename, **kw):
+        a = archive.Archive.new(filename, "w", **kw)
+        media = a.subarchive("media")
+        media.writestr("data/foo", "foo data")
+        r, w = os.pipe()
+        os.write(w, "piped " * 1000)
+        os.close(w)
+        with os.fdopen(r, "rb") as pipe:
+            media.writefile("data/bar/baz", pipe, chunk_size=100)
+        a.subarchive("database").writestr("default.dmp", "dump")
+        self.assertEqual(list(media.namelist("data/")), ["data/bar/baz", "data/foo"])
+        a.close()
+        a = archive.Archive.new(filename, "r", **kw)
+        media = a.subarchive("media")
+        self.assertEqual(list(media.namelist()), ["data/bar/baz", "data/foo"])
+        self.assert_(a.exists("database/default.dmp"))
+        self.assertEqual(media.size("data/bar/baz"), 6000)
+        with media.open("data/foo") as f:
+            self.assertEqual(f.read(), "foo data")
+        with a.open("database/default.dmp") as f:
+            self.assertEqual(list(f), ["dump"])
+        out = StringIO()
+        media.extractfile("data/bar/baz", out, chunk_size=7)
+        self.assertEqual(out.getvalue(), "piped " * 1000)
+        a.close()
+
+    def test_tar(self):
+        filename = os.path.join(self.tempdir, "test.tar")
+        self.roundtrip(filename)
+        self.assert_(isinstance(archive.Archive.new(filename, "r").backend, archive.TarBackend))
+
+    def test_tar_compressed(self):
+        filename = os.path.join(self.tempdir, "test.tgz")
+        a = archive.Archive.new(filename, "w")
+        a.writestr("foo", "foo " * 1000)
+        a.close()
+        self.assert_(os.path.getsize(filename) < 1000)
+        self.assertRaises(archive.ArchiveException, archive.Archive.new, filename, "r")
+
+    def test_tar_stdout(self):
+        out = tempfile.TemporaryFile()
+        with patch("sys.stdout", out):
+            a = archive.Archive.new("-", "w")
+            a.writestr("foo", "foo data")
+            a.close()
+        out.seek(0)
+        t = tarfile.open(fileobj=out, mode="r|")
+        member = t.next()
+        self.assertEqual(member.name, "foo")
+        self.assertEqual(t.extractfile(member).read(), "foo data")
+
+    def test_directory(self):
+        filename = os.path.join(self.tempdir, "test")
+        self.roundtrip(filename, backend="directory")
+        with open(os.path.join(filename, "media", "data", "foo")) as f:
+            self.assertEqual(f.read(), "foo data")
+        self.assert_(isinstance(archive.Archive.new(filename, "r").backend, archive.DirectoryBackend))
+        # a new dump doesn't mix with an old one, but a resumed one carries on
+        self.assertRaises(archive.ArchiveException, archive.Archive.new, filename, "w")
+        a = archive.Archive.new(filename, "a")
+        a.writestr("media/data/qux", "qux data")
+        a.close()
+        self.assertEqual(archive.Archive.new(filename, "r").size("media/data/foo"), 8)
+        a = archive.Archive.new(os.path.join(self.tempdir, "empty"), "w", backend="directory")
+        self.assertRaises(archive.ArchiveException, a.writestr, "../escape", "foo")
+
+    def test_unknown_backend(self):
+        self.assertRaises(archive.ArchiveException, archive.Archive.new, self.filename, "w", backend="cpio")
@@ -0,0 +1,130 @@
+import time
+import threading
+from unittest import TestCase
+from mock import MagicMock, call
+
+from django.conf import settings
+if not settings.configured:
+    settings.configure()
+
+from dumprestore import backupset
+from dumprestore.database import DatabaseDriver
+from dumprestore.media import MediaDriver
+
+
+class RecordingDriver(backupset.BackupDriver):
+
+    def __init__(self, name, events, delay=0, started=None, wait=None):
+        self.name = name
+        self.events = events
+        self.delay = delay
+        self.started = started
+        self.wait = wait
+
+    def dump(self, archive):
+        self.events.append(("start", self.name))
+        if self.started is not None:
+            self.started.set()
+        if self.wait is not None:
+            self.wait.wait(1)
+        time.sleep(self.delay)
+        self.events.append(("end", self.name))
+
+    restore = dump
+
+
+class TestBackupSet(TestCase):
+
+    def setUp(self):
+        self.events = []
+
+    def make_set(self, parallel):
+        s = backupset.BackupSet(parallel=parallel)
+        s.archive = MagicMock()
+        # files doesn't finish until database has started, however the threads are scheduled
+        started = threading.Event()
+        s.addChild(backupset.BackupSet("database", RecordingDriver("database", self.events, 0.05, started=started)))
+        s.addChild(backupset.BackupSet("files", RecordingDriver("files", self.events, 0.01, wait=started)))
+        s.addChild(backupset.BackupSet("media", RecordingDriver("media", self.events)), after=["database"])
+        return s
+
+    def test_serial(self):
+        self.make_set(False).dump()
+        self.assertEqual(self.events, [
+            ("start", "database"), ("end", "database"),
+            ("start", "files"), ("end", "files"),
+            ("start", "media"), ("end", "media"),
+            ])
+
+    def test_parallel(self):
+        self.make_set(True).restore()
+        self.assertEqual(sorted(self.events[:2]), [("start", "database"), ("start", "files")])
+        self.assert_(self.events.index(("end", "database")) < self.events.index(("start", "media")))
+        self.assertEqual(len(self.events), 6)
+
+    def test_parallel_failure(self):
+        s = self.make_set(True)
+        s.children[0].driver.dump = MagicMock(side_effect=IOError())
+        self.assertRaises(IOError, s.dump)
+        self.assert_(("start", "media") not in self.events)
+        self.assert_(("end", "files") in self.events)
+
+    def test_after_unknown(self):
+        s = backupset.BackupSet()
+        self.assertRaises(ValueError, s.addChild, backupset.BackupSet("media"), after=["database"])
+
+    def test_configure(self):
+        s = backupset.BackupSet()
+        driver = MagicMock()
+        s.addChild(backupset.BackupSet("media", driver))
+        s.configure(media_workers=2)
+        self.assertEqual(driver.configure.mock_calls, [call(media_workers=2)])
+
+    def test_resume(self):
+        s = self.make_set(False)
+        s.journal = MagicMock()
+        s.journal.done.side_effect = lambda path: path == "master/database"
+        s.dump()
+        self.assertEqual(self.events, [
+            ("start", "files"), ("end", "files"),
+            ("start", "media"), ("end", "media"),
+            ])
+        self.assertEqual(s.journal.record.mock_calls, [
+            call("master/files"), call("master/media"), call("master"),
+            ])
+        self.assertEqual(s.children[2].driver.checkpoint, s.journal.checkpoint("master/media"))
+
+    def test_selected(self):
+        s = self.make_set(False)
+        s.journal = MagicMock()
+        s.journal.done.return_value = False
+        s.configure(sets=["master/media", "files"])
+        s.restore()
+        self.assertEqual(self.events, [
+            ("start", "files"), ("end", "files"),
+            ("start", "media"), ("end", "media"),
+            ])
+        self.assertEqual(s.journal.record.mock_calls, [call("master/files"), call("master/media")])
+        self.assertEqual(s.children[0].verify(), [])
+
+    def test_implied(self):
+        media = MediaDriver(storage=MagicMock(), lister=MagicMock())
+        database = DatabaseDriver()
+        database.restore = MagicMock()
+        s = backupset.BackupSet()
+        s.archive = MagicMock()
+        s.addChild(backupset.BackupSet("media", media))
+        s.addChild(backupset.BackupSet("database", database))
+        s.configure(sets=None, database_names=["default"], media_prefixes=None)
+        self.assertEqual(s.sets, ["master/database"])
+        s.restore()
+        self.assertEqual(media.storage.mock_calls, [])
+        self.assertEqual(len(database.restore.mock_calls), 1)
+        # --set wins over what the options imply
+        s.configure(sets=["media"], database_names=["default"], media_prefixes=["a/"])
+        self.assertEqual(s.sets, ["media"])
+        self.assertEqual(s.implied({'media_prefixes': ["a/"]}), ["master/media"])
+
+    def test_unknown(self):
+        s = self.make_set(False)
+        self.assertEqual(s.unknown(["media", "master/files", "master/static", "static"]), ["master/static", "static"])
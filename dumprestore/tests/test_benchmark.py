@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+from unittest import TestCase
+from mock import patch
+
+from django.conf import settings
+if not settings.configured:
+    settings.configure()
+
+from dumprestore import benchmark
+
+
+class TestBenchmark(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_write_tree(self):
+        names = benchmark.write_tree(self.tempdir, files=5, size=100, depth=2, fanout=2)
+        self.assertEqual(len(names), 5)
+        self.assertEqual(names[1], os.path.join("d0", "d1", "f1"))
+        self.assertEqual(os.path.getsize(os.path.join(self.tempdir, names[4])), 100)
+
+    def test_run(self):
+        b = benchmark.Benchmark(self.tempdir, dict(files=10, size=1000, depth=1, fanout=3),
+                                workers=2, databases=2, database_size=5000)
+        b.setup()
+        results = b.run()
+        self.assertEqual(sorted(results), ["archive_read", "archive_write", "database_dump", "media_dump", "media_restore"])
+        self.assertEqual(results["media_dump"]["files"], 10)
+        self.assertEqual(results["database_dump"]["bytes"], 10000)
+        self.assert_(results["archive_write"]["peak_rss"] > 0)
+        with open(os.path.join(self.tempdir, "restored", "d2", "f5"), "rb") as f:
+            self.assertEqual(len(f.read()), 1000)
+
+    def test_isolated(self):
+        # what the child allocates stays out of the parent
+        hog = []
+        result = benchmark.isolated(lambda: {"size": len(hog.append(b"x" * 64 * 1024 * 1024) or hog)})
+        self.assertEqual(result["size"], 1)
+        self.assertEqual(hog, [])
+        self.assert_(result["peak_rss"] >= 64 * 1024 * 1024)
+        with patch("dumprestore.benchmark.logger"):
+            self.assertRaises(RuntimeError, benchmark.isolated, lambda: 1 / 0)
+
+    def test_compare(self):
+        old = {"media_dump": {"mb_per_s": 100.0, "files_per_s": 10.0}}
+        new = {"media_dump": {"mb_per_s": 80.0, "files_per_s": 8.0}}
+        with patch("sys.stdout", StringIO()):
+            self.assertEqual(benchmark.compare(old, new, 0.1), ["media_dump"])
+            self.assertEqual(benchmark.compare(old, new, 0.3), [])
@@ -1,7 +1,15 @@
+import os
+import sys
+import copy
+import time
+import shutil
+import sqlite3
+import tempfile
+from io import BytesIO
 from unittest import TestCase
-from mock import MagicMock, call, patch
+from mock import ANY, MagicMock, call, patch
 
-from dumprestore import database
+from dumprestore import archive, database
 
 
 DATABASES = {
@@ -36,10 +44,18 @@ class TestPostgres(TestCase):
                  , env = {'PGPASSWORD': 'xxpasswordxx'})
         ])
 
+    @patch("dumprestore.database.subprocess")
+    @patch("dumprestore.database.settings")
+    def test_dump_directory(self, settings, subprocess):
+        settings.DATABASES = DATABASES
+        self.driver.dump("/var/tmp/foo", "test", 4)
+        self.assertEqual(subprocess.check_call.mock_calls[0][1][0][:10], [
+            'pg_dump', '-Fd', '-C', '-EUTF-8', '-b', '-o', '-j', '4', '-f', '/var/tmp/foo'])
+
     @patch("dumprestore.database.subprocess")
     @patch("dumprestore.database.settings")
     def test_dump_nouser(self, settings, subprocess):
-        settings.DATABASES = DATABASES.copy()
+        settings.DATABASES = copy.deepcopy(DATABASES)
         settings.DATABASES['test']['USER'] = None
         self.driver.dump("/var/tmp/foo", "test")
         self.assertEqual(subprocess.check_call.mock_calls, [
@@ -50,6 +66,162 @@ class TestPostgres(TestCase):
                 ], env = {'PGPASSWORD': 'xxpasswordxx'})
         ])
 
+    @patch("dumprestore.database.subprocess")
+    @patch("dumprestore.database.settings")
+    def test_dump_stream(self, settings, subprocess):
+        settings.DATABASES = DATABASES
+        subprocess.Popen.return_value.wait.return_value = 0
+        with self.driver.dump_stream("test") as f:
+            self.assert_(f.process is subprocess.Popen.return_value)
+        self.assertEqual(subprocess.Popen.call_args, call(
+            ['pg_dump', '-Fc', '-C', '-EUTF-8', '-b', '-o',
+             '-U', 'xxuserxx',
+             '-h', 'xxhostxx',
+             '-p', 'xxportxx',
+             'xxnamexx'],
+            env = {'PGPASSWORD': 'xxpasswordxx'},
+            stdout=subprocess.PIPE,
+            stderr=ANY))
+        self.assert_(subprocess.Popen.return_value.stdout.close.called)
+
+    @patch("dumprestore.database.subprocess")
+    @patch("dumprestore.database.settings")
+    def test_dump_stream_failed(self, settings, subprocess):
+        settings.DATABASES = DATABASES
+        subprocess.Popen.return_value.wait.return_value = 1
+        def consume():
+            with self.driver.dump_stream("test") as f:
+                pass
+        self.assertRaises(database.DatabaseBackupException, consume)
+
+    @patch("dumprestore.database.subprocess")
+    @patch("dumprestore.database.settings")
+    def test_dump_stream_interrupted(self, settings, subprocess):
+        settings.DATABASES = DATABASES
+        def consume():
+            with self.driver.dump_stream("test") as f:
+                raise IOError()
+        self.assertRaises(IOError, consume)
+        self.assert_(subprocess.Popen.return_value.kill.called)
+
+    @patch("dumprestore.database.subprocess")
+    @patch("dumprestore.database.settings")
+    def test_restore(self, settings, subprocess):
+        settings.DATABASES = DATABASES
+        self.driver.restore("/var/tmp/foo", "test", 4)
+        self.assertEqual(subprocess.check_call.mock_calls, [
+            call(['pg_restore', '-Fc', '-j', '4',
+                  '-U', 'xxuserxx',
+                  '-h', 'xxhostxx',
+                  '-p', 'xxportxx',
+                  '-d', 'xxnamexx',
+                  '/var/tmp/foo'],
+                 env = {'PGPASSWORD': 'xxpasswordxx'})
+        ])
+
+    def test_verify(self):
+        self.driver.list_command = [sys.executable, "-c", "import sys; sys.stdin.read(10)"]
+        f = BytesIO("x" * 1000000)
+        self.assertEqual(self.driver.verify(f, "test", chunk_size=1000), [])
+        self.assertEqual(f.read(), "")
+
+    def test_verify_failed(self):
+        self.driver.list_command = [sys.executable, "-c", "import sys; sys.stderr.write('bad dump'); sys.exit(1)"]
+        problems = self.driver.verify(BytesIO("x" * 1000), "test")
+        self.assertEqual(problems, ["test: pg_restore --list exited with status 1: bad dump"])
+
+class TestMySQL(TestCase):
+
+    def setUp(self):
+        self.driver = database.MySQL()
+
+    @patch("dumprestore.database.subprocess")
+    @patch("dumprestore.database.settings")
+    def test_dump(self, settings, subprocess):
+        settings.DATABASES = DATABASES
+        self.driver.dump("/var/tmp/foo", "test")
+        self.assertEqual(subprocess.check_call.mock_calls, [
+            call(['mysqldump', '--single-transaction', '--quick', '--routines', '--triggers', '--hex-blob',
+                  '--result-file=/var/tmp/foo',
+                  '-u', 'xxuserxx',
+                  '-h', 'xxhostxx',
+                  '-P', 'xxportxx',
+                  'xxnamexx']
+                 , env = {'MYSQL_PWD': 'xxpasswordxx'})
+        ])
+
+    @patch("dumprestore.database.settings")
+    def test_dump_stream(self, settings):
+        settings.DATABASES = {'test': {'NAME': None}}
+        self.driver.backup_command = [sys.executable, "-c", "print('-- Dump completed')"]
+        with self.driver.dump_stream("test") as f:
+            self.assertEqual(self.driver.verify(f, "test"), [])
+        self.driver.backup_command = [sys.executable, "-c", "import sys; sys.stderr.write('denied'); sys.exit(2)"]
+        with self.assertRaises(database.DatabaseBackupException) as cm:
+            with self.driver.dump_stream("test") as f:
+                f.read()
+        self.assert_("denied" in str(cm.exception))
+
+    def test_verify_incomplete(self):
+        self.assertEqual(self.driver.verify(BytesIO("INSERT INTO"), "test"), ["test: the mysqldump output is incomplete"])
+
+class TestSQLite(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.p = patch("dumprestore.database.settings")
+        self.settings = self.p.start()
+        self.addCleanup(self.p.stop)
+        self.name = os.path.join(self.tempdir, "db.sqlite3")
+        self.settings.DATABASES = {'test': {'NAME': self.name}}
+        self.driver = database.SQLite()
+
+    def rows(self):
+        c = sqlite3.connect(self.name)
+        try:
+            return list(c.execute("SELECT * FROM t ORDER BY x"))
+        finally:
+            c.close()
+
+    def test_dump_restore(self):
+        c = sqlite3.connect(self.name)
+        c.executescript("CREATE TABLE t (x INTEGER); INSERT INTO t VALUES (1); INSERT INTO t VALUES (2);")
+        c.close()
+        dump = os.path.join(self.tempdir, "dump")
+        open(dump, "w").close()
+        self.driver.dump(dump, "test")
+        with open(dump, "rb") as f:
+            self.assertEqual(self.driver.verify(f, "test"), [])
+        c = sqlite3.connect(self.name)
+        c.execute("DELETE FROM t")
+        c.commit()
+        c.close()
+        self.driver.restore(dump, "test", 4)
+        self.assertEqual(self.rows(), [(1,), (2,)])
+
+    def test_restore_mode(self):
+        c = sqlite3.connect(self.name)
+        c.executescript("CREATE TABLE t (x INTEGER); INSERT INTO t VALUES (1);")
+        c.close()
+        dump = os.path.join(self.tempdir, "dump")
+        open(dump, "w").close()
+        self.driver.dump(dump, "test")
+        os.chmod(self.name, 0o664)
+        self.driver.restore(dump, "test")
+        self.assertEqual(os.stat(self.name).st_mode & 0o777, 0o664)
+        self.assertEqual(self.rows(), [(1,)])
+
+    def test_verify_bad(self):
+        problems = self.driver.verify(BytesIO("x" * 4096), "test")
+        self.assertEqual(len(problems), 1)
+        self.assert_(problems[0].startswith("test: "))
+
+    def test_registered(self):
+        self.assertEqual(database.databases['django.db.backends.sqlite3'], database.SQLite)
+        self.assertEqual(database.databases['django.db.backends.mysql'], database.MySQL)
+        self.assertEqual(database.databases['django.db.backends.postgresql_psycopg2'], database.Postgres)
+
 class TestDatabaseDriver(TestCase):
 
     def setUp(self):
@@ -83,6 +255,79 @@ class TestDatabaseDriver(TestCase):
         self.assert_('one' in [x[0] for x in databases])
         self.assert_('three' in [x[0] for x in databases])
 
+    def test_get_databases_grouped(self):
+        self.settings.DATABASE_BACKUP_ORDER = ['two', ('one', 'three')]
+        databases = list(self.driver.get_databases())
+        self.assertEqual([x[0] for x in databases], ['two', 'one', 'three'])
+
+    def test_get_databases_named(self):
+        self.driver.configure(database_names=['three', 'one'])
+        self.assertEqual(sorted(x[0] for x in self.driver.get_databases()), ['one', 'three'])
+        self.driver.configure(database_names=['four'])
+        self.assertRaises(database.DatabaseBackupException, list, self.driver.get_databases())
+
+    def test_get_groups(self):
+        self.settings.DATABASE_BACKUP_ORDER = [('one', 'three'), 'two']
+        databases = [(db, None) for db in ['two', 'four', 'three', 'one', 'five']]
+        self.assertEqual([[db for db, driver in g] for g in self.driver.get_groups(databases)], [
+            ['three', 'one'],
+            ['two'],
+            ['four', 'five'],
+            ])
+
+    @patch("tempfile.NamedTemporaryFile")
+    @patch("dumprestore.database.os")
+    def test_dump_concurrent(self, os, ntf):
+        ntf.return_value = MagicMock()
+        ntf.return_value.name = "/var/tmp/foo"
+        os.unlink = MagicMock()
+        self.settings.DATABASE_BACKUP_ORDER = ['one']
+        drivers = dict((db, MagicMock()) for db in ['one', 'two', 'three'])
+        self.driver.databases = sorted(drivers.items())
+        self.driver.workers = 2
+        self.driver.dump(self.archive)
+        for db, d in drivers.items():
+            self.assertEqual(d.dump.mock_calls, [call(ntf().name, db)])
+        self.assertEqual(self.archive.write.mock_calls, [
+            call(ntf().name, 'one.dmp'),
+            call(ntf().name, 'three.dmp'),
+            call(ntf().name, 'two.dmp'),
+            ])
+
+    def test_dump_concurrent_failed(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        def dump(filename, db):
+            with open(filename, "wb") as f:
+                f.write(db)
+            if db == "two":
+                raise IOError()
+        drivers = dict((db, MagicMock(directory_dumps=False)) for db in ['one', 'two', 'three'])
+        for d in drivers.values():
+            d.dump.side_effect = dump
+        self.driver.databases = sorted(drivers.items())
+        self.driver.tempdir = tempdir
+        self.driver.workers = 3
+        self.archive.write.side_effect = lambda filename, arcname: time.sleep(0.1)
+        self.assertRaises(IOError, self.driver.dump, self.archive)
+        # neither the failed dump nor those it cut short are left behind
+        self.assertEqual(os.listdir(tempdir), [])
+
+    @patch("dumprestore.database.logger")
+    @patch("tempfile.NamedTemporaryFile")
+    @patch("dumprestore.database.os")
+    def test_dump_concurrent_stream(self, os, ntf, logger):
+        ntf.return_value = MagicMock()
+        ntf.return_value.name = "/var/tmp/foo"
+        os.unlink = MagicMock()
+        d = MagicMock()
+        self.driver.databases = [("one", d), ("two", d)]
+        self.driver.workers = 2
+        self.driver.stream = True
+        self.driver.dump(self.archive)
+        self.assertEqual(d.dump_stream.mock_calls, [])
+        self.assert_(any("Not streaming one, two" in c[1][0] for c in logger.info.mock_calls))
+
     @patch("tempfile.NamedTemporaryFile")
     @patch("dumprestore.database.os")
     def test_dump(self, os, ntf):
@@ -90,3 +335,128 @@ class TestDatabaseDriver(TestCase):
         self.driver.databases = [("one", d)]
         self.driver.dump(self.archive)
         self.assertEqual(d.dump.mock_calls, [call(ntf().name, 'one')])
+
+    def test_dump_stream(self):
+        d = MagicMock()
+        self.driver.stream = True
+        self.driver.databases = [("one", d)]
+        self.driver.dump(self.archive)
+        self.assertEqual(self.archive.writefile.mock_calls, [
+            call("one.dmp", d.dump_stream().__enter__())])
+        self.assertEqual(d.dump.mock_calls, [])
+
+    def test_dump_stream_failed(self):
+        self.settings.DATABASES = {'one': {'NAME': None}, 'two': {'NAME': None}}
+        failing = database.MySQL()
+        failing.backup_command = [sys.executable, "-c", "import sys; sys.stdout.write('x' * 100000); sys.exit(1)"]
+        good = database.MySQL()
+        good.backup_command = [sys.executable, "-c", "print('-- Dump completed')"]
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        for name in ["dump.zip", "dump.tar", "dump/"]:
+            filename = os.path.join(tempdir, name)
+            self.driver.stream = True
+            self.driver.databases = [("two", good), ("one", failing)]
+            self.driver.checkpoint = MagicMock()
+            a = archive.Archive.new(filename, "w")
+            self.assertRaises(database.DatabaseBackupException, self.driver.dump, a)
+            a.close()
+            # the dump cut short is neither in the archive nor recorded as done
+            self.assertEqual(list(archive.Archive.new(filename, "r").namelist()), ["two.dmp"], name)
+            self.assertEqual(self.driver.checkpoint.record.mock_calls, [call("two")])
+
+    @patch("tempfile.NamedTemporaryFile")
+    @patch("dumprestore.database.os")
+    def test_restore(self, os, ntf):
+        # mock attributes are created on first use, which races between threads
+        ntf.return_value = MagicMock()
+        ntf.return_value.name = "/var/tmp/foo"
+        os.unlink = MagicMock()
+        self.archive.extractfile = MagicMock()
+        one, two = MagicMock(), MagicMock()
+        self.driver.databases = [("one", one), ("two", two)]
+        self.driver.configure(db_parallel=3, db_workers=2)
+        self.driver.restore(self.archive)
+        self.assertEqual(sorted(c[1][0] for c in self.archive.extractfile.mock_calls), ["one.dmp", "two.dmp"])
+        self.assertEqual(one.restore.mock_calls, [call(ntf().name, 'one', 3)])
+        self.assertEqual(two.restore.mock_calls, [call(ntf().name, 'two', 3)])
+        self.assertEqual(os.unlink.mock_calls, [call(ntf().name), call(ntf().name)])
+
+    def test_dump_resume(self):
+        d = MagicMock()
+        self.driver.stream = True
+        self.driver.databases = [("one", d), ("two", d)]
+        self.driver.checkpoint = MagicMock()
+        self.driver.checkpoint.done.side_effect = lambda db: db == "one"
+        self.archive.exists.return_value = True
+        self.driver.dump(self.archive)
+        self.assertEqual(self.archive.writefile.mock_calls, [
+            call("two.dmp", d.dump_stream().__enter__())])
+        self.assertEqual(self.driver.checkpoint.record.mock_calls, [call("two")])
+
+    @patch("tempfile.NamedTemporaryFile")
+    @patch("dumprestore.database.os")
+    def test_restore_resume(self, os, ntf):
+        one, two = MagicMock(), MagicMock()
+        self.driver.databases = [("one", one), ("two", two)]
+        self.driver.checkpoint = MagicMock()
+        self.driver.checkpoint.done.side_effect = lambda db: db == "one"
+        self.driver.restore(self.archive)
+        self.assertEqual(one.restore.mock_calls, [])
+        self.assertEqual(two.restore.mock_calls, [call(ntf().name, 'two', 1)])
+        self.assertEqual(self.driver.checkpoint.record.mock_calls, [call("two")])
+
+    def test_verify(self):
+        one, two = MagicMock(), MagicMock()
+        one.verify.return_value = []
+        two.verify.return_value = ["two: bad"]
+        self.driver.get_databases = MagicMock(return_value=[("one", one), ("two", two), ("three", one)])
+        self.archive.exists.side_effect = lambda name: name in ("one.dmp", "two.dmp")
+        self.archive.open.side_effect = lambda name: BytesIO("")
+        self.assertEqual(self.driver.verify(self.archive), ["two: bad", "three.dmp: missing from the archive"])
+
+    def test_dump_directory(self):
+        d = MagicMock()
+        d.dump.side_effect = lambda dirname, db, jobs: self.write_directory(dirname)
+        self.driver.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.driver.tempdir)
+        self.driver.configure(db_dump_jobs=4)
+        self.driver.databases = [("one", d)]
+        self.driver.stream = True
+        self.driver.dump(self.archive)
+        self.assertEqual(d.dump.mock_calls[0][1][1:], ("one", 4))
+        self.assertEqual([c[1][1] for c in self.archive.write.mock_calls], [
+            "one.dir/3000.dat.gz", "one.dir/3001.dat.gz", "one.dir/toc.dat"])
+        self.assertEqual(os.listdir(self.driver.tempdir), [])
+
+    def write_directory(self, dirname):
+        os.mkdir(dirname)
+        for name in ["toc.dat", "3001.dat.gz", "3000.dat.gz"]:
+            with open(os.path.join(dirname, name), "w") as f:
+                f.write(name)
+
+    def test_restore_directory(self):
+        self.driver.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.driver.tempdir)
+        entries = {"one.dir/toc.dat": "toc", "one.dir/3000.dat.gz": "data"}
+        self.archive.exists.side_effect = lambda name: name in entries
+        self.archive.namelist.side_effect = lambda prefix: sorted(n for n in entries if n.startswith(prefix))
+        def extract(name, filename):
+            with open(filename, "w") as f:
+                f.write(entries[name])
+        self.archive.extract.side_effect = extract
+        restored = []
+        d = MagicMock()
+        d.restore.side_effect = lambda dirname, db, jobs: restored.append((sorted(os.listdir(dirname)), db, jobs))
+        d.verify_directory.side_effect = lambda dirname, db: []
+        self.driver.databases = [("one", d)]
+        self.driver.configure(db_parallel=3)
+        self.driver.restore(self.archive)
+        self.assertEqual(restored, [(["3000.dat.gz", "toc.dat"], "one", 3)])
+        self.driver.get_databases = MagicMock(return_value=[("one", d)])
+        self.assertEqual(self.driver.verify(self.archive), [])
+        self.assertEqual(os.listdir(self.driver.tempdir), [])
+
+    def test_before_restore(self):
+        self.driver.before_restore(self.archive)
+        self.assertEqual(len(self.driver.databases), 3)
@@ -0,0 +1,93 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from mock import MagicMock
+
+from dumprestore import archive, filesystem, throttle
+
+
+class TestFilesystemDriver(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tempdir, "source")
+        os.makedirs(os.path.join(self.source, "d1", "d2"))
+        for name, data, mode in [("f1", "1", 0o600), ("d1/f2", "22", 0o644), ("d1/d2/f3", "333", 0o755)]:
+            path = os.path.join(self.source, name)
+            with open(path, "w") as f:
+                f.write(data)
+            os.chmod(path, mode)
+            os.utime(path, (1000000000.5, 1000000000.5))
+        os.symlink("d1/f2", os.path.join(self.source, "link"))
+        os.chmod(os.path.join(self.source, "d1", "d2"), 0o750)
+        os.utime(os.path.join(self.source, "d1"), (1000000000, 1000000000))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def dump(self, name, **kw):
+        filename = os.path.join(self.tempdir, name)
+        a = archive.Archive.new(filename, "w", **kw)
+        filesystem.FilesystemDriver(self.source, workers=2, list_workers=2).dump(a.subarchive("foofiles"))
+        a.close()
+        return archive.Archive.new(filename, "r", **kw).subarchive("foofiles")
+
+    def check_restore(self, a):
+        target = os.path.join(self.tempdir, "target")
+        driver = filesystem.FilesystemDriver(target, workers=2)
+        driver.restore(a)
+        for name, data in [("f1", "1"), ("d1/f2", "22"), ("d1/d2/f3", "333"), ("link", "22")]:
+            with open(os.path.join(target, name)) as f:
+                self.assertEqual(f.read(), data)
+        for name in ["f1", "d1/f2", "d1/d2/f3", "d1/d2", "d1"]:
+            source, restored = os.stat(os.path.join(self.source, name)), os.stat(os.path.join(target, name))
+            self.assertEqual(source.st_mode, restored.st_mode)
+            self.assertAlmostEqual(source.st_mtime, restored.st_mtime, 3)
+        self.assertEqual(os.readlink(os.path.join(target, "link")), "d1/f2")
+        return driver, target
+
+    def test_zip(self):
+        a = self.dump("test.zip")
+        self.assertEqual(sorted(a.namelist()), ["data/d1/d2/f3", "data/d1/f2", "data/f1", "manifest.jsonl"])
+        self.check_restore(a)
+
+    def test_directory(self):
+        a = self.dump("test", backend="directory")
+        self.check_restore(a)
+
+    def test_throttled(self):
+        a = archive.Archive.new(os.path.join(self.tempdir, "test.zip"), "w")
+        driver = filesystem.FilesystemDriver(self.source, workers=2, list_workers=2)
+        driver.throttle = throttle.Throttle(requests_per_s=1000)
+        driver.throttle.requests = MagicMock()
+        driver.dump(a.subarchive("foofiles"))
+        a.close()
+        # a listing of each of the 3 directories and the first read of each of the 3 files
+        self.assertEqual(len(driver.throttle.requests.take.mock_calls), 6)
+        self.check_restore(archive.Archive.new(os.path.join(self.tempdir, "test.zip"), "r").subarchive("foofiles"))
+
+    def test_restore_unchanged(self):
+        a = self.dump("test.zip")
+        driver, target = self.check_restore(a)
+        with open(os.path.join(target, "d1", "f2"), "w") as f:
+            f.write("changed")
+        os.chmod(os.path.join(target, "f1"), 0o666)
+        a.extract = MagicMock(side_effect=a.extract)
+        driver.restore(a)
+        self.assertEqual([c[1][0] for c in a.extract.mock_calls], ["data/d1/f2"])
+        with open(os.path.join(target, "d1", "f2")) as f:
+            self.assertEqual(f.read(), "22")
+        self.assertEqual(os.stat(os.path.join(target, "f1")).st_mode & 0o777, 0o600)
+
+    def test_verify(self):
+        a = self.dump("test", backend="directory")
+        driver = filesystem.FilesystemDriver(self.source)
+        self.assertEqual(driver.verify(a), [])
+        os.unlink(os.path.join(self.tempdir, "test", "foofiles", "data", "f1"))
+        self.assertEqual(driver.verify(archive.Archive.new(os.path.join(self.tempdir, "test"), "r").subarchive("foofiles")),
+                         ["data/f1: missing from the archive"])
+
+    def test_outside(self):
+        driver = filesystem.FilesystemDriver(self.source)
+        self.assertRaises(filesystem.FilesystemRestoreException, driver.full, "../etc/passwd")
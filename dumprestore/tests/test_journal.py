@@ -0,0 +1,65 @@
+import os
+import errno
+import shutil
+import tempfile
+from unittest import TestCase
+from mock import patch
+
+from dumprestore import journal
+
+
+class TestJournal(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.j = journal.Journal.beside(os.path.join(self.tempdir, "test.zip"), "dump")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_beside(self):
+        self.assertEqual(self.j.filename, os.path.join(self.tempdir, "test.zip.dump.journal"))
+        d = journal.Journal.beside(os.path.join(self.tempdir, "backup/"), "restore")
+        self.assertEqual(d.filename, os.path.join(self.tempdir, "backup.restore.journal"))
+
+    def test_resume(self):
+        self.j.open()
+        c = self.j.checkpoint("master/media")
+        c.record("foo", {"entry": "data/foo"})
+        self.j.record("master/database")
+        self.j.close()
+        with open(self.j.filename, "a") as f:
+            f.write('{"scope": "master/media", "un')
+        j = journal.Journal(self.j.filename)
+        j.open(resume=True)
+        c = j.checkpoint("master/media")
+        self.assert_(c.done("foo"))
+        self.assertEqual(c.info("foo"), {"entry": "data/foo"})
+        self.assert_(not c.done("bar"))
+        self.assert_(j.done("master/database"))
+        self.assert_(not j.done("master/media"))
+        j.close()
+
+    def test_fresh(self):
+        self.j.open()
+        self.j.record("master")
+        self.j.close()
+        j = journal.Journal(self.j.filename)
+        j.open()
+        self.assert_(not j.done("master"))
+        j.remove()
+        self.assert_(not os.path.exists(self.j.filename))
+
+    def test_for_archive(self):
+        archive_filename = os.path.join(self.tempdir, "test.zip")
+        j = journal.Journal.for_archive(archive_filename, "restore")
+        self.assertEqual(j.filename, archive_filename + ".restore.journal")
+        j.close()
+        self.assertEqual(journal.Journal.for_archive("-", "dump"), None)
+        elsewhere = os.path.join(self.tempdir, "elsewhere.journal")
+        with patch("dumprestore.journal.open", create=True, side_effect=IOError(errno.EACCES, "Permission denied")):
+            self.assertEqual(journal.Journal.for_archive(archive_filename, "restore"), None)
+            self.assertRaises(IOError, journal.Journal.for_archive, archive_filename, "restore", filename=elsewhere)
+        j = journal.Journal.for_archive(archive_filename, "restore", filename=elsewhere)
+        self.assertEqual(j.filename, elsewhere)
+        j.close()
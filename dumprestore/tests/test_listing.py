@@ -0,0 +1,55 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from mock import MagicMock, patch
+
+from django.conf import settings
+if not settings.configured:
+    settings.configure()
+
+from django.core.files.storage import FileSystemStorage
+
+from dumprestore import listing, media
+
+
+class TestListing(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.tempdir, "d1", "d2"))
+        for name, data in [("f1", "1"), ("d1/f2", "22"), ("d1/d2/f3", "333")]:
+            with open(os.path.join(self.tempdir, name), "w") as f:
+                f.write(data)
+        self.storage = FileSystemStorage(location=self.tempdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_get_lister(self):
+        class MyStorage(FileSystemStorage):
+            pass
+        self.assert_(isinstance(listing.get_lister(MyStorage(location=self.tempdir)), listing.FileSystemLister))
+        lister = listing.get_lister(MagicMock())
+        self.assertEqual(lister.__class__, listing.StorageLister)
+
+    def check_listing(self):
+        driver = media.MediaDriver(storage=self.storage)
+        entries = dict(driver.storage_entries())
+        self.assertEqual(sorted(entries), ["d1/d2/f3", "d1/f2", "f1"])
+        meta = media.FileMetadata(self.storage)
+        for name, stats in entries.items():
+            self.assertEqual(stats, meta.to_dict(name))
+
+    def test_filesystem_lister(self):
+        self.check_listing()
+
+    @patch("dumprestore.listing.scandir", None)
+    def test_filesystem_lister_no_scandir(self):
+        self.check_listing()
+
+    def test_to_dict_uses_stats(self):
+        storage = MagicMock()
+        stats = {"accessed_time": "a", "created_time": "c", "modified_time": "m", "size": 1}
+        self.assertEqual(media.FileMetadata(storage).to_dict("foo", stats), stats)
+        self.assertEqual(storage.mock_calls, [])
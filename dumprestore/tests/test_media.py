@@ -1,9 +1,21 @@
+import os
+import errno
+import shutil
+import tempfile
 import zipfile
 from unittest import TestCase
 from mock import MagicMock, call, patch
 from datetime import datetime
-from dumprestore import media
+
+from django.conf import settings
+if not settings.configured:
+    settings.configure()
+
+from dumprestore import archive, journal, media, throttle
 import json
+import hashlib
+from StringIO import StringIO
+from io import BytesIO
 
 fake_media = {
     ".": (["d1", "d2"], ["f1", "f2"]),
@@ -19,6 +31,7 @@ class TestMediaDriver(TestCase):
 
     def setUp(self):
         self.archive = MagicMock()
+        self.archive.exists.return_value = False
         self.storage = self._storage()
         self.driver = media.MediaDriver(storage=self.storage)
 
@@ -46,17 +59,38 @@ class TestMediaDriver(TestCase):
             "y",
         ])
 
+    def test_storage_files_concurrent(self):
+        self.driver.list_workers = 3
+        self.assertEqual(sorted(self.driver.storage_files()), ["d1/d3/f4", "d1/f3", "f1", "f2"])
+
+    def test_storage_files_hidden(self):
+        self.storage.listdir.side_effect = [([".d"], [".f"]), ([], [".g"])]
+        self.assertEqual(list(self.driver.storage_files()), [".f", ".d/.g"])
+
+    def test_storage_snapshot_prefixes(self):
+        self.driver.prefixes = ["d1/d3/", "d1/f", "d2/x"]
+        self.storage.listdir.side_effect = lambda x: fake_media[x] if x != "./d2" else self._missing()
+        self.assertEqual(sorted(self.driver.storage_snapshot()), ["d1/d3/f4", "d1/f3"])
+        self.assertEqual(sorted(c[1][0] for c in self.storage.listdir.mock_calls), ["./d1", "./d1/d3", "./d2"])
+        self.assertEqual(self.storage.exists.mock_calls, [])
+        # only a missing root is empty
+        self.driver.prefixes = ["d1/"]
+        self.storage.listdir.side_effect = lambda x: fake_media[x] if x != "./d1/d3" else self._missing()
+        self.assertRaises(OSError, self.driver.storage_snapshot)
+
+    def _missing(self):
+        raise OSError(errno.ENOENT, "No such file or directory")
+
     @patch("dumprestore.media.FileMetadata")
     def test_replace_file(self, fmd):
-        archive = MagicMock()
+        metadata = {}
         for exists, changed, result in [
             (True, True, True),
             (True, False, False),
             (False, True, True),
             (False, False, True)]:
-            self.storage.exists.return_value = exists
             fmd().has_changed.return_value = changed
-            rv = self.driver.replace_file("foo", archive)
+            rv = self.driver.replace_file("foo", metadata, {} if exists else None)
             self.assertEqual(rv , result, msg="exists=%r changed=%r result=%r" % (exists, changed, result))
 
     def test_filenames(self):
@@ -65,19 +99,77 @@ class TestMediaDriver(TestCase):
 
     @patch('dumprestore.media.settings')
     def test_dump(self, *mocks):
-        self.storage.open().__enter__().read.return_value = "data"
+        f = self.storage.open().__enter__()
+        manifest = []
+        def writefile(name, data):
+            if name == "manifest.jsonl":
+                manifest.extend(json.loads(line) for line in data)
+        self.archive.writefile.side_effect = writefile
         self.driver.dump(self.archive)
-        md =  '{"created_time": "2001-01-01T00:00:00", "accessed_time": "2001-01-01T00:00:00", "modified_time": "2001-01-01T00:00:00", "size": 100}'
-        self.assertEqual(self.archive.mock_calls, [
-            call.writestr('data/f1', "data"),
-            call.writestr('meta/f1', md),
-            call.writestr('data/f2', "data"),
-            call.writestr('meta/f2', md),
-            call.writestr('data/d1/f3', "data"),
-            call.writestr('meta/d1/f3', md),
-            call.writestr('data/d1/d3/f4', "data"),
-            call.writestr('meta/d1/d3/f4', md),
+        self.assertEqual(self.archive.writefile.mock_calls[:-1], [
+            call('data/f1', f),
+            call('data/f2', f),
+            call('data/d1/f3', f),
+            call('data/d1/d3/f4', f),
             ])
+        md = {"created_time": "2001-01-01T00:00:00", "accessed_time": "2001-01-01T00:00:00", "modified_time": "2001-01-01T00:00:00", "size": 100}
+        self.assertEqual(manifest, [
+            dict(md, name='f1'),
+            dict(md, name='f2'),
+            dict(md, name='d1/f3'),
+            dict(md, name='d1/d3/f4'),
+            ])
+        self.assertEqual(self.archive.writestr.mock_calls, [])
+
+    def test_dump_throttled(self):
+        self.driver.throttle = throttle.Throttle(requests_per_s=1000, latency=1)
+        self.driver.throttle.requests = MagicMock()
+        self.driver.throttle.backoff = MagicMock(delay=0)
+        self.storage.open.side_effect = lambda name: BytesIO(b"x" * 100)
+        contents = {}
+        def writefile(name, data):
+            contents[name] = data.read()
+        self.archive.writefile.side_effect = writefile
+        self.driver.dump(self.archive)
+        self.assertEqual(contents['data/d1/d3/f4'], b"x" * 100)
+        # a listing of each of the 4 directories, and for each of the 4
+        # files, its 4 metadata calls and its first read
+        self.assertEqual(len(self.driver.throttle.requests.take.mock_calls), 4 + 4 * 5)
+        self.assertEqual(len(self.driver.throttle.backoff.observe.mock_calls), 4 + 4 * 5)
+
+    def test_read_metadata(self):
+        md = {"modified_time": "2001-01-01T00:00:00", "size": 100}
+        a = MagicMock()
+        a.exists.return_value = True
+        a.open().__enter__.return_value = BytesIO(json.dumps(dict(md, name="foo")) + "\n")
+        self.assertEqual(self.driver.read_metadata(a), {"foo": md})
+
+    def test_read_metadata_per_file(self):
+        md = {"modified_time": "2001-01-01T00:00:00", "size": 100}
+        a = MagicMock()
+        a.exists.return_value = False
+        a.namelist.return_value = ["meta/foo"]
+        a.open().__enter__.return_value = BytesIO(json.dumps(md))
+        self.assertEqual(self.driver.read_metadata(a), {"foo": md})
+
+    def test_dump_parallel(self):
+        self.storage.open.side_effect = lambda name: BytesIO("data:" + name)
+        written = []
+        self.archive.writefile.side_effect = lambda name, f: written.append((name, f.read()))
+        self.driver.workers = 3
+        self.driver.dump(self.archive)
+        self.assertEqual(written[:-1], [
+            ('data/f1', 'data:f1'),
+            ('data/f2', 'data:f2'),
+            ('data/d1/f3', 'data:d1/f3'),
+            ('data/d1/d3/f4', 'data:d1/d3/f4'),
+            ])
+
+    def test_configure(self):
+        self.driver.configure(media_workers=4, verbosity=1)
+        self.assertEqual(self.driver.workers, 4)
+        self.driver.configure(media_workers=None)
+        self.assertEqual(self.driver.workers, 4)
 
     @patch('tempfile.NamedTemporaryFile')
     def test_before_dump(self, tmp):
@@ -88,13 +180,304 @@ class TestMediaDriver(TestCase):
     @patch("dumprestore.media.FileMetadata")
     def test_restore(self, fmd):
         self.driver.filenames = MagicMock(return_value=["foo", "bar"])
-        self.driver.storage_only = MagicMock(return_value=["baz"])
+        self.archive.exists.side_effect = lambda name: name.startswith("data/")
+        self.driver.storage_snapshot = MagicMock(return_value={"baz": {}})
         fmd().replace_file.return_value = True
         self.assertRaises(media.MediaRestoreException, self.driver.restore, self.archive)
-        writer = self.storage.open()
-        reader = self.archive.open()
+        self.storage.save.side_effect = lambda name, content: name
+        self.archive.size.return_value = 4
         self.driver.restore(self.archive, True)
-        self.assertEqual(writer.mock_calls, [
-            call.write(reader.read()),
-            call.write(reader.read())
-        ])
+        saved = [(c[1][0], c[1][1]) for c in self.storage.save.mock_calls]
+        self.assertEqual([name for name, content in saved], ["foo", "bar"])
+        for name, content in saved:
+            self.assertEqual(content.file, self.archive.open().__enter__())
+            self.assertEqual(content.size, 4)
+
+    def test_restore_parallel(self):
+        self.driver.filenames = MagicMock(return_value=["a", "b", "c", "d"])
+        self.archive.exists.side_effect = lambda name: name.startswith("data/")
+        self.driver.storage_snapshot = MagicMock(return_value={})
+        self.driver.replace_file = MagicMock(side_effect=lambda name, metadata, stats: name != "b")
+        self.driver.save_file = MagicMock()
+        self.driver.workers = 3
+        results = self.driver.restore(self.archive)
+        self.assertEqual(sorted(results[media.WRITTEN]), ["a", "c", "d"])
+        self.assertEqual(results[media.SKIPPED], ["b"])
+        self.assertEqual(sorted(c[1][0] for c in self.driver.save_file.mock_calls), ["a", "c", "d"])
+
+    def test_restore_file_retries(self):
+        self.driver.retry_delay = 0
+        self.driver.replace_file = MagicMock(return_value=True)
+        self.driver.save_file = MagicMock(side_effect=[IOError(), None])
+        self.assertEqual(self.driver.restore_file("foo", self.archive, {}), ("foo", media.WRITTEN))
+        self.driver.save_file = MagicMock(side_effect=IOError())
+        self.assertEqual(self.driver.restore_file("foo", self.archive, {}), ("foo", media.FAILED))
+        self.assertEqual(len(self.driver.save_file.mock_calls), 3)
+
+    def test_restore_file_partly_written(self):
+        from django.core.files.storage import FileSystemStorage
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        self.driver.storage = FileSystemStorage(location=tempdir)
+        self.driver.retry_delay = 0
+        self.driver.replace_file = MagicMock(return_value=True)
+        attempts = []
+        def open_entry(arcname):
+            attempts.append(arcname)
+            if len(attempts) > 1:
+                return BytesIO(b"whole")
+            f = MagicMock()
+            f.__enter__().read.side_effect = [b"part", IOError()]
+            return f
+        self.archive.open.side_effect = open_entry
+        self.archive.size.return_value = 5
+        self.assertEqual(self.driver.restore_file("new.txt", self.archive, {}), ("new.txt", media.WRITTEN))
+        self.assertEqual(os.listdir(tempdir), ["new.txt"])
+        with open(os.path.join(tempdir, "new.txt"), "rb") as f:
+            self.assertEqual(f.read(), b"whole")
+
+    def test_restore_failed(self):
+        self.driver.filenames = MagicMock(return_value=["a", "b"])
+        self.archive.exists.side_effect = lambda name: name.startswith("data/")
+        self.driver.storage_snapshot = MagicMock(return_value={})
+        self.driver.restore_file = MagicMock(side_effect=lambda name, archive, metadata, stats: (name, media.FAILED if name == "a" else media.WRITTEN))
+        self.assertRaises(media.MediaRestoreException, self.driver.restore, self.archive)
+
+    def test_restore_reconcile(self):
+        self.driver.filenames = MagicMock(return_value=["same", "changed", "new"])
+        self.archive.exists.side_effect = lambda name: name.startswith("data/")
+        md = {"modified_time": "2001-01-01T00:00:00", "size": 100}
+        self.driver.read_metadata = MagicMock(return_value={"same": md, "changed": md, "new": md})
+        self.driver.storage_snapshot = MagicMock(return_value={
+            "same": {"modified_time": "2001-01-01T00:00:00", "size": 100},
+            "changed": {"modified_time": "2001-01-01T00:00:00", "size": 99},
+        })
+        self.driver.save_file = MagicMock()
+        results = self.driver.restore(self.archive)
+        self.assertEqual(sorted(results[media.WRITTEN]), ["changed", "new"])
+        self.assertEqual(results[media.SKIPPED], ["same"])
+        self.assertEqual(self.storage.exists.mock_calls, [])
+        self.assertEqual(sorted((c[1][0], c[1][3]) for c in self.driver.save_file.mock_calls), [
+            ("changed", True), ("new", False)])
+
+    def test_save_file_renamed(self):
+        self.storage.save.return_value = "foo_1"
+        self.assertRaises(media.MediaRestoreException, self.driver.save_file, "foo", self.archive)
+
+class TestIncremental(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.sizes = {"f1": 1, "f2": 2, "d1/f3": 3, "d1/d3/f4": 4}
+        self.storage = MagicMock()
+        self.storage.accessed_time.return_value = datetime(2001, 1, 1)
+        self.storage.created_time.return_value = datetime(2001, 1, 1)
+        self.storage.modified_time.return_value = datetime(2001, 1, 1)
+        self.storage.size.side_effect = lambda name: self.sizes[name]
+        self.storage.listdir.side_effect = lambda x: fake_media[x]
+        self.storage.open.side_effect = lambda name: BytesIO("%s:%d" % (name, self.sizes[name]))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def dump(self, name, base=None, dedup=False):
+        filename = os.path.join(self.tempdir, name)
+        a = archive.Archive.new(filename, "w")
+        media.MediaDriver(storage=self.storage, base=base, dedup=dedup).dump(a.subarchive("media"))
+        a.close()
+        return filename
+
+    def test_incremental(self):
+        base = self.dump("base.zip")
+        self.sizes["f2"] = 20
+        fake_media["."] = (["d1", "d2"], ["f2"])
+        try:
+            increment = self.dump("increment.zip", base)
+        finally:
+            fake_media["."] = (["d1", "d2"], ["f1", "f2"])
+        z = zipfile.ZipFile(increment)
+        self.assertEqual(sorted(n for n in z.namelist() if n.startswith("media/data/")), ["media/data/f2"])
+        self.assertEqual(json.loads(z.read("media/increment.json")), {
+            "base": base,
+            "deleted": ["f1"],
+        })
+
+        driver = media.MediaDriver(storage=self.storage, base_dir=self.tempdir)
+        driver.storage_snapshot = MagicMock(return_value={})
+        driver.replace_file = MagicMock(return_value=True)
+        saved = {}
+        def save_file(name, source, arcname, exists):
+            with source.open(arcname) as f:
+                saved[name] = f.read()
+        driver.save_file = save_file
+        driver.restore(archive.Archive.new(increment, "r").subarchive("media"))
+        self.assertEqual(saved, {
+            "f2": "f2:20",
+            "d1/f3": "d1/f3:3",
+            "d1/d3/f4": "d1/d3/f4:4",
+        })
+
+    def test_dedup(self):
+        self.storage.open.side_effect = lambda name: BytesIO("x" * self.sizes[name])
+        self.sizes["f2"] = 1
+        base = self.dump("base.zip", dedup=True)
+        z = zipfile.ZipFile(base)
+        self.assertEqual(len([n for n in z.namelist() if n.startswith("media/blobs/")]), 3)
+        self.assertEqual([n for n in z.namelist() if n.startswith("media/data/")], [])
+
+        self.sizes["d1/f3"] = 1
+        self.storage.modified_time.return_value = datetime(2002, 1, 1)
+        increment = self.dump("increment.zip", base, dedup=True)
+        z = zipfile.ZipFile(increment)
+        self.assertEqual([n for n in z.namelist() if n.startswith("media/blobs/")], [])
+
+        driver = media.MediaDriver(storage=self.storage)
+        driver.storage_snapshot = MagicMock(return_value={})
+        driver.replace_file = MagicMock(return_value=True)
+        saved = {}
+        def save_file(name, source, arcname, exists):
+            with source.open(arcname) as f:
+                saved[name] = f.read()
+        driver.save_file = save_file
+        driver.restore(archive.Archive.new(increment, "r").subarchive("media"))
+        self.assertEqual(saved, {
+            "f1": "x",
+            "f2": "x",
+            "d1/f3": "x",
+            "d1/d3/f4": "xxxx",
+        })
+
+    def test_resume(self):
+        self.resume(False)
+
+    def test_resume_unclosed(self):
+        self.resume(True)
+
+    def resume(self, unclosed):
+        """ Dump, interrupted part way, and resume. If unclosed, the
+        interrupted dump is left as if killed, without a central directory. """
+        filename = os.path.join(self.tempdir, "resumed.zip")
+        j = journal.Journal.beside(filename, "dump")
+        j.open()
+        opened = []
+        def open_file(name):
+            if name == "d1/f3" and "interrupted" not in opened:
+                raise IOError()
+            opened.append(name)
+            return BytesIO("%s:%d" % (name, self.sizes[name]))
+        self.storage.open.side_effect = open_file
+        driver = media.MediaDriver(storage=self.storage)
+        driver.checkpoint = j.checkpoint("master/media")
+        a = archive.Archive.new(filename, "w")
+        try:
+            self.assertRaises(IOError, driver.dump, a.subarchive("media"))
+            if unclosed:
+                a.backend.zipfile.fp.flush()
+                killed = os.path.join(self.tempdir, "killed.zip")
+                shutil.copyfile(filename, killed)
+        finally:
+            a.close()
+            j.close()
+        if unclosed:
+            os.rename(killed, filename)
+        self.assertEqual(sorted(opened), ["f1", "f2"])
+        opened.append("interrupted")
+
+        j = journal.Journal.beside(filename, "dump")
+        j.open(resume=True)
+        driver.checkpoint = j.checkpoint("master/media")
+        a = archive.Archive.new(filename, "a")
+        driver.dump(a.subarchive("media"))
+        a.close()
+        j.close()
+        self.assertEqual(sorted(opened[3:]), ["d1/d3/f4", "d1/f3"])
+        a = archive.Archive.new(filename, "r").subarchive("media")
+        self.assertEqual(sorted(driver.read_metadata(a)), ["d1/d3/f4", "d1/f3", "f1", "f2"])
+        self.assertEqual(list(driver.filenames(a)), ["d1/d3/f4", "d1/f3", "f1", "f2"])
+
+    def test_restore_resume(self):
+        filename = self.dump("base.zip")
+        driver = media.MediaDriver(storage=self.storage)
+        driver.storage_snapshot = MagicMock(return_value={})
+        driver.save_file = MagicMock()
+        driver.checkpoint = MagicMock()
+        driver.checkpoint.done.side_effect = lambda name: name in ("f1", "d1/f3")
+        results = driver.restore(archive.Archive.new(filename, "r").subarchive("media"))
+        self.assertEqual(sorted(c[1][0] for c in driver.save_file.mock_calls), ["d1/d3/f4", "f2"])
+        self.assertEqual(sorted(results[media.SKIPPED]), ["d1/f3", "f1"])
+        self.assertEqual(sorted(c[1][0] for c in driver.checkpoint.record.mock_calls), ["d1/d3/f4", "f2"])
+
+    def test_non_ascii(self):
+        for name, backend in [("media.tar", "tar"), ("media", "directory")]:
+            filename = os.path.join(self.tempdir, name)
+            self.storage.listdir.side_effect = lambda x: ([], [u"caf\xe9.txt", "f1"])
+            self.storage.open.side_effect = lambda name: BytesIO(name.encode("utf-8"))
+            self.sizes.update({u"caf\xe9.txt": 9, "f1": 2})
+            a = archive.Archive.new(filename, "w", backend=backend)
+            media.MediaDriver(storage=self.storage).dump(a.subarchive("media"))
+            a.close()
+            a = archive.Archive.new(filename, "r", backend=backend).subarchive("media")
+            self.assertEqual(sorted(a.namelist("data/")), [u"data/caf\xe9.txt", u"data/f1"])
+            driver = media.MediaDriver(storage=self.storage)
+            driver.storage_snapshot = MagicMock(return_value={})
+            saved = {}
+            def save(name, content):
+                saved[name] = content.read()
+                return name
+            self.storage.save.side_effect = save
+            driver.restore(a)
+            self.assertEqual(saved, {u"caf\xe9.txt": u"caf\xe9.txt".encode("utf-8"), "f1": b"f1"}, backend)
+            self.assertEqual(driver.verify(a), [])
+
+    def test_restore_prefixes(self):
+        self.storage.open.side_effect = lambda name: BytesIO("x" * self.sizes[name])
+        filename = self.dump("base.zip")
+        driver = media.MediaDriver(storage=self.storage, prefixes=["d1/"])
+        driver.storage_snapshot = MagicMock(return_value={})
+        driver.save_file = MagicMock()
+        a = archive.Archive.new(filename, "r").subarchive("media")
+        a.open = MagicMock(side_effect=a.open)
+        driver.restore(a)
+        self.assertEqual(sorted(c[1][0] for c in driver.save_file.mock_calls), ["d1/d3/f4", "d1/f3"])
+        self.assertEqual(driver.verify(a), [])
+        self.assertEqual([c[1][0] for c in a.open.mock_calls if c[1][0].startswith("data/")], ["data/d1/d3/f4", "data/d1/f3"])
+
+    def test_verify(self):
+        self.storage.open.side_effect = lambda name: BytesIO("x" * self.sizes[name])
+        filename = self.dump("base.zip", dedup=True)
+        driver = media.MediaDriver(storage=self.storage, workers=2, verify_hashes=True)
+        self.assertEqual(driver.verify(archive.Archive.new(filename, "r").subarchive("media")), [])
+
+        with open(filename, "rb") as f:
+            data = f.read()
+        with open(filename, "wb") as f:
+            f.write(data.replace("xxxx", "xxxy"))
+        problems = driver.verify(archive.Archive.new(filename, "r").subarchive("media"))
+        self.assertEqual(len(problems), 1)
+        self.assert_("CRC" in problems[0])
+
+    def test_verify_metadata(self):
+        filename = os.path.join(self.tempdir, "bad.zip")
+        z = zipfile.ZipFile(filename, "w")
+        z.writestr("media/data/f1", "f1 data")
+        z.writestr("media/blobs/abc", "blob")
+        z.writestr("media/manifest.jsonl", "\n".join(json.dumps(d) for d in [
+            {"name": "f1", "size": 3},
+            {"name": "f2", "size": 4, "sha256": "abc"},
+            {"name": "f3", "size": 4},
+            ]))
+        z.close()
+        driver = media.MediaDriver(storage=self.storage, verify_hashes=True)
+        problems = driver.verify(archive.Archive.new(filename, "r").subarchive("media"))
+        self.assertEqual(sorted(problems), [
+            "blobs/abc: SHA-256 %s where abc was expected" % hashlib.sha256("blob").hexdigest(),
+            "data/f1: 7 bytes where 3 were expected",
+            "data/f3: missing from the archives",
+            ])
+
+class TestStreamFile(TestCase):
+
+    def test_chunks(self):
+        f = media.StreamFile(StringIO("abcdefg"), "foo", 7)
+        self.assertEqual(list(f.chunks(3)), ["abc", "def", "g"])
+        self.assertEqual(f.size, 7)
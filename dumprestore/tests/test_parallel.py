@@ -0,0 +1,67 @@
+import threading
+import time
+from unittest import TestCase
+
+from dumprestore import parallel
+
+
+class TestImapBounded(TestCase):
+
+    def test_serial(self):
+        self.assertEqual(list(parallel.imap_bounded(lambda x: x * 2, range(5), 1)), [0, 2, 4, 6, 8])
+
+    def test_ordered(self):
+        def slow(x):
+            time.sleep(0.01 * (5 - x))
+            return x
+        self.assertEqual(list(parallel.imap_bounded(slow, range(5), 4)), [0, 1, 2, 3, 4])
+
+    def test_bounded(self):
+        lock = threading.Lock()
+        started = []
+        def record(x):
+            with lock:
+                started.append(x)
+            return x
+        results = parallel.imap_bounded(record, range(100), 2, backlog=3)
+        self.assertEqual(next(results), 0)
+        time.sleep(0.05)
+        self.assertEqual(len(started), 3)
+        self.assertEqual(list(results), range(1, 100))
+
+    def test_exception(self):
+        def fail(x):
+            if x == 3:
+                raise ValueError(x)
+            return x
+        self.assertRaises(ValueError, list, parallel.imap_bounded(fail, range(10), 3))
+
+class TestIwalk(TestCase):
+
+    tree = {
+        "a": ["b", "c"],
+        "b": ["d"],
+        "c": [],
+        "d": ["e", "f"],
+        "e": [],
+        "f": [],
+    }
+
+    def listdir(self, node):
+        time.sleep(0.001)
+        return self.tree[node], node.upper()
+
+    def test_serial(self):
+        self.assertEqual(list(parallel.iwalk(self.listdir, "a", 1)), [
+            ("a", "A"), ("b", "B"), ("c", "C"), ("d", "D"), ("e", "E"), ("f", "F")])
+
+    def test_concurrent(self):
+        self.assertEqual(sorted(parallel.iwalk(self.listdir, "a", 4)), [
+            ("a", "A"), ("b", "B"), ("c", "C"), ("d", "D"), ("e", "E"), ("f", "F")])
+
+    def test_exception(self):
+        def fail(node):
+            if node == "d":
+                raise OSError(node)
+            return self.listdir(node)
+        self.assertRaises(OSError, list, parallel.iwalk(fail, "a", 4))
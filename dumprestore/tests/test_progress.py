@@ -0,0 +1,104 @@
+import os
+import json
+import errno
+import shutil
+import tempfile
+from unittest import TestCase
+from mock import MagicMock, patch
+
+from dumprestore import backupset, progress
+
+
+class CountingDriver(backupset.BackupDriver):
+
+    def dump(self, archive):
+        self.expect(files=4, bytes=400)
+        self.count(1, 100)
+        self.count(1, 100)
+
+
+class TestProgress(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    @patch("dumprestore.progress.time")
+    def test_eta(self, time):
+        time.time.return_value = 100
+        p = progress.Monitor("dump").progress("master/media")
+        self.assertEqual(p.eta(), None)
+        p.expect(files=10)
+        time.time.return_value = 110
+        p.add(5, 500)
+        self.assertEqual(p.rates(), (0.5, 50))
+        self.assertEqual(p.eta(), 10)
+        p.expect(bytes=2000)
+        self.assertEqual(p.eta(), 30)
+
+    def test_tick(self):
+        reporter = MagicMock()
+        m = progress.Monitor("dump", [reporter], interval=0)
+        m.progress("master").add(1)
+        self.assertEqual(reporter.progress.call_count, 1)
+        m.interval = 3600
+        m.progress("master").add(1)
+        self.assertEqual(reporter.progress.call_count, 1)
+
+    def test_backupset(self):
+        reporter = MagicMock()
+        s = backupset.BackupSet()
+        s.archive = MagicMock()
+        s.addChild(backupset.BackupSet("media", CountingDriver()))
+        s.monitor = progress.Monitor("dump", [reporter])
+        s.before_dump()
+        s.dump()
+        s.after_dump()
+        s.monitor.finish(True)
+        phases = [(p, ph) for p, ph, seconds in s.monitor.phases]
+        self.assertEqual(phases, [
+            ("master/media", "before_dump"), ("master", "before_dump"),
+            ("master/media", "dump"), ("master", "dump"),
+            ("master/media", "after_dump"), ("master", "after_dump"),
+            ])
+        self.assertEqual(reporter.phase.call_count, 6)
+        d = s.monitor.as_dict()
+        self.assertEqual(d['success'], True)
+        self.assertEqual(d['progress']['master/media']['files'], 2)
+        self.assertEqual(d['progress']['master/media']['total_bytes'], 400)
+
+    def test_reports(self):
+        archive_filename = os.path.join(self.tempdir, "test.zip")
+        textfile = os.path.join(self.tempdir, "dumprestore.prom")
+        m = progress.Monitor.for_archive(archive_filename, "dump", textfile)
+        with m.phase("master", "dump"):
+            m.progress("master/media").add(3, 300)
+        m.finish(False)
+        with open(archive_filename + ".dump.report.json") as f:
+            report = json.load(f)
+        self.assertEqual(report['success'], False)
+        self.assertEqual(report['phases'][0]['set'], "master")
+        self.assertEqual(report['progress']['master/media']['bytes'], 300)
+        with open(textfile) as f:
+            metrics = f.read().splitlines()
+        self.assert_('dumprestore_success{operation="dump"} 0' in metrics)
+        self.assert_('dumprestore_files{operation="dump",set="master/media"} 3' in metrics)
+        self.assert_('# TYPE dumprestore_phase_seconds gauge' in metrics)
+        self.assertEqual(sorted(os.listdir(self.tempdir)), ["dumprestore.prom", "test.zip.dump.report.json"])
+
+    def test_report_unwritable(self):
+        archive_filename = os.path.join(self.tempdir, "test.zip")
+        report = os.path.join(self.tempdir, "report.json")
+        denied = OSError(errno.EACCES, "Permission denied")
+        with patch("dumprestore.progress.tempfile.mkstemp", side_effect=denied) as mkstemp:
+            m = progress.Monitor.for_archive(archive_filename, "verify")
+            m.finish(True)
+            m.finish(True)
+            self.assertEqual(mkstemp.call_count, 1)
+            m = progress.Monitor.for_archive(archive_filename, "verify", report=report)
+            self.assertRaises(OSError, m.finish, True)
+        m = progress.Monitor.for_archive(archive_filename, "verify", report=report)
+        m.finish(True)
+        self.assertEqual(os.listdir(self.tempdir), ["report.json"])
@@ -0,0 +1,104 @@
+from io import BytesIO
+from unittest import TestCase
+from mock import MagicMock, patch
+
+from dumprestore import backupset, throttle
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class TestTokenBucket(TestCase):
+
+    def test_take(self):
+        clock = FakeClock()
+        bucket = throttle.TokenBucket(10, 20, clock=clock, sleep=clock.sleep)
+        self.assertEqual(bucket.take(20), 0)
+        self.assertEqual(bucket.take(5), 0.5)
+        clock.now += 1
+        self.assertEqual(bucket.take(10), 0)
+        # more than the burst goes into debt
+        self.assertEqual(bucket.take(30), 3)
+        self.assertEqual(clock.slept, [0.5, 3])
+
+
+class TestBackoff(TestCase):
+
+    def test_observe(self):
+        backoff = throttle.Backoff(0.1, initial=0.01, maximum=0.05, weight=1)
+        backoff.observe(0.05)
+        self.assertEqual(backoff.delay, 0)
+        delays = []
+        for latency in [0.2, 0.2, 0.2, 0.2, 0.05, 0.05, 0.05, 0.05]:
+            backoff.observe(latency)
+            delays.append(backoff.delay)
+        self.assertEqual(delays, [0.01, 0.02, 0.04, 0.05, 0.025, 0.0125, 0.00625, 0])
+
+
+class TestThrottle(TestCase):
+
+    def test_reader(self):
+        t = throttle.Throttle(bytes_per_s=1000)
+        t.bytes = MagicMock()
+        f = t.reader(BytesIO(b"x" * 100))
+        with f:
+            self.assertEqual(f.read(60), b"x" * 60)
+            self.assertEqual(f.read(), b"x" * 40)
+            self.assertEqual(f.tell(), 100)
+        self.assertEqual([c[1][0] for c in t.bytes.take.mock_calls], [60, 40])
+        self.assert_(f.closed)
+        bare = BytesIO()
+        self.assert_(throttle.Throttle(requests_per_s=5).reader(bare) is bare)
+
+    def test_opened(self):
+        t = throttle.Throttle(requests_per_s=100)
+        t.requests = MagicMock()
+        f = t.opened(BytesIO(b"x" * 100))
+        with f:
+            self.assertEqual(len(t.requests.take.mock_calls), 0)
+            f.read(10)
+            f.read()
+        # only the first read goes to the storage
+        self.assertEqual(len(t.requests.take.mock_calls), 1)
+        bare = BytesIO()
+        self.assert_(throttle.Throttle(bytes_per_s=5).opened(bare).fileobj is bare)
+
+    def test_request(self):
+        t = throttle.Throttle(requests_per_s=100, latency=1)
+        t.requests = MagicMock()
+        with t.request():
+            pass
+        self.assertEqual(len(t.requests.take.mock_calls), 1)
+        self.assert_(t.backoff.latency < 1)
+
+    @patch("dumprestore.throttle.which")
+    def test_command(self, which):
+        which.side_effect = lambda name: "/usr/bin/" + name
+        t = throttle.Throttle(nice=19, ionice="best-effort", ionice_level=7)
+        self.assertEqual(t.command(["pg_dump", "db"]), [
+            "/usr/bin/nice", "-n", "19", "/usr/bin/ionice", "-c", "2", "-n", "7", "pg_dump", "db"])
+        which.side_effect = lambda name: None
+        self.assertEqual(t.command(["pg_dump", "db"]), ["pg_dump", "db"])
+        self.assertRaises(ValueError, throttle.Throttle, ionice="lazy")
+
+    def test_backup_set(self):
+        t, own = throttle.Throttle(), throttle.Throttle()
+        s = backupset.BackupSet(throttle=t)
+        s.archive = MagicMock()
+        media, database = MagicMock(), MagicMock()
+        s.addChild(backupset.BackupSet("media", media))
+        s.addChild(backupset.BackupSet("database", database, throttle=own))
+        s.dump()
+        self.assert_(media.throttle is t)
+        self.assert_(database.throttle is own)
@@ -0,0 +1,187 @@
+
+""" Limits on how hard a dump works the storage, the network and the CPU,
+so it can run beside live traffic """
+
+import time
+import logging
+import threading
+import contextlib
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+logger = logging.getLogger("dumprestore")
+
+class TokenBucket:
+
+    """ Allows rate units a second on average, in bursts of up to burst. """
+
+    def __init__(self, rate, burst=None, clock=time.time, sleep=time.sleep):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.tokens = self.burst
+        self.last = clock()
+
+    def take(self, n=1):
+        """ Take n units, waiting until the rate allows them. Returns how
+        long that was. Taking more than burst at once is allowed, by going
+        into debt that those taking after have to wait out. """
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            self.sleep(wait)
+        return wait
+
+class Backoff:
+
+    """ A delay before each request, which doubles while the average latency
+    of requests is over target and halves as it comes back under, so the
+    dump gives way when the storage is struggling. """
+
+    def __init__(self, target, initial=0.01, maximum=5.0, weight=0.2):
+        self.target = target
+        self.initial = initial
+        self.maximum = maximum
+        self.weight = weight
+        self.lock = threading.Lock()
+        self.latency = None
+        self.delay = 0
+
+    def observe(self, latency):
+        with self.lock:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += self.weight * (latency - self.latency)
+            if self.latency > self.target:
+                if self.delay == 0:
+                    logger.info("Storage latency %.3fs is over %.3fs, backing off" % (self.latency, self.target))
+                self.delay = min(self.maximum, max(self.initial, self.delay * 2))
+            elif self.delay > self.initial:
+                self.delay = self.delay / 2
+            else:
+                self.delay = 0
+
+class ThrottledFile:
+
+    """ Reads from fileobj no faster than throttle allows. """
+
+    def __init__(self, fileobj, throttle):
+        self.fileobj = fileobj
+        self.throttle = throttle
+
+    def read(self, size=-1):
+        buf = self.fileobj.read(size)
+        self.throttle.transfer(len(buf))
+        return buf
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.fileobj.close()
+
+class RequestFile(ThrottledFile):
+
+    """ A file just opened from the storage, whose first read is made as a
+    request to it. Storages that open lazily only go to the network then. """
+
+    def __init__(self, fileobj, throttle):
+        ThrottledFile.__init__(self, fileobj, throttle)
+        self.requested = False
+
+    def read(self, size=-1):
+        if self.requested:
+            return self.fileobj.read(size)
+        self.requested = True
+        with self.throttle.request():
+            return self.fileobj.read(size)
+
+class Throttle:
+
+    """ Limits the drivers of a backup set, and the sets inside it, to
+    bytes_per_s read from the storage and requests_per_s made to it, in
+    bursts of up to burst seconds' worth. With latency, requests are spaced
+    out by a Backoff whenever they take longer than that on average.
+
+    Commands the drivers run, like pg_dump, are started under nice with the
+    given niceness, and ionice with the given class ("idle", or
+    "best-effort" at ionice_level), where those are installed. """
+
+    ionice_classes = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+    def __init__(self, bytes_per_s=None, requests_per_s=None, burst=1.0, latency=None, max_delay=5.0,
+                 nice=None, ionice=None, ionice_level=None):
+        self.bytes = None
+        if bytes_per_s:
+            self.bytes = TokenBucket(bytes_per_s, bytes_per_s * burst)
+        self.requests = None
+        if requests_per_s:
+            self.requests = TokenBucket(requests_per_s, max(requests_per_s * burst, 1))
+        self.backoff = None
+        if latency:
+            self.backoff = Backoff(latency, maximum=max_delay)
+        if ionice is not None and ionice not in self.ionice_classes:
+            raise ValueError("ionice must be one of %s" % ", ".join(sorted(self.ionice_classes)))
+        self.nice = nice
+        self.ionice = ionice
+        self.ionice_level = ionice_level
+
+    @contextlib.contextmanager
+    def request(self):
+        """ Wait until another request is allowed, then time the request
+        made inside the block for the backoff. """
+        if self.requests is not None:
+            self.requests.take(1)
+        if self.backoff is not None and self.backoff.delay:
+            time.sleep(self.backoff.delay)
+        started = time.time()
+        yield
+        if self.backoff is not None:
+            self.backoff.observe(time.time() - started)
+
+    def transfer(self, size):
+        """ Wait until size more bytes are allowed. """
+        if self.bytes is not None:
+            self.bytes.take(size)
+
+    def reader(self, fileobj):
+        if self.bytes is None:
+            return fileobj
+        return ThrottledFile(fileobj, self)
+
+    def opened(self, fileobj):
+        """ fileobj, just opened from the storage: its first read is a
+        request, and it is read no faster than bytes allows. """
+        if self.requests is not None or self.backoff is not None:
+            fileobj = RequestFile(fileobj, self)
+        return self.reader(fileobj)
+
+    def command(self, command):
+        """ command, run under nice and ionice as configured. """
+        prefix = []
+        if self.nice is not None:
+            if which("nice"):
+                prefix.extend([which("nice"), "-n", str(self.nice)])
+            else:
+                logger.warning("nice is not installed, running %s at normal priority" % command[0])
+        if self.ionice is not None:
+            if which("ionice"):
+                prefix.extend([which("ionice"), "-c", str(self.ionice_classes[self.ionice])])
+                if self.ionice_level is not None:
+                    prefix.extend(["-n", str(self.ionice_level)])
+            else:
+                logger.warning("ionice is not installed, running %s at normal IO priority" % command[0])
+        return prefix + list(command)